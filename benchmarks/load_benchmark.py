@@ -0,0 +1,302 @@
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.segment_benchmark import generate_video
+from models.AsyncServer import AsyncServer
+from models.Client import Client
+from models.GifEncoder import GifEncoder
+from models.JobScheduler import AsyncJobScheduler, JobScheduler
+from models.Metrics import Metrics
+from models.ResultCache import ResultCache
+from models.Server import Server
+from models.TCPConnection import TCPConnection
+from models.VideoProcessor import VideoProcessor
+
+# 操作ごとのリクエストのパラメータ
+PARAMS = {
+    VideoProcessor.COMPRESS: dict(compressRate='0.5'),
+    VideoProcessor.RESOLUTION: dict(width=320, height=180),
+    VideoProcessor.ASPECT_RATIO: dict(aspectRatio='4:3'),
+    VideoProcessor.AUDIO: dict(),
+    VideoProcessor.GIF: dict(startSec=0, endSec=2),
+}
+PERCENTILES = (50, 95, 99)
+
+
+# 送受信の各段階の時刻を記録するクライアント
+# phases: connect、precheck（ハッシュの問い合わせ）、upload、wait（変換が終わり応答が届くまで）、download
+class BenchmarkClient(Client):
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int, precheck: bool):
+        super().__init__(host, port, logger, chunk_size, precheck)
+        self.started = time.perf_counter()
+        self.marks = {}
+        self.response = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # receive_responseで受け取った変換結果のパス
+        self.received = []
+
+    def mark(self, name: str):
+        self.marks[name] = time.perf_counter()
+
+    def run(self):
+        super().run()
+        self.mark('connected')
+
+    def upload(self, params: dict, request: dict, offset: int = 0, session: dict = None) -> dict:
+        self.mark('upload')
+        self.bytes_out += os.path.getsize(params['file_name']) - offset
+        return super().upload(params, request, offset, session)
+
+    def send_body(self, sock, media_type: str, request: dict, file_path: str, offset: int = 0):
+        super().send_body(sock, media_type, request, file_path, offset)
+        self.mark('uploaded')
+
+    def receive_header(self, sock) -> tuple[int, int, int]:
+        header = super().receive_header(sock)
+        self.mark('response')
+        return header
+
+    def receive_file(self, sock, request: dict, media_type: str, payload_size: int, hasher=None,
+                     file_name: str = None, offset: int = 0) -> str:
+        file_name = super().receive_file(sock, request, media_type, payload_size, hasher, file_name, offset)
+        self.received.append(os.path.join(TCPConnection.DEST_DIR, file_name))
+        return file_name
+
+    def receive_response(self, session: dict = None) -> dict:
+        self.received = []
+        self.response = super().receive_response(session)
+        # 受け取った変換結果は、precheckの有無にかかわらず大きさだけ数えて削除する
+        for file_path in self.received:
+            if os.path.exists(file_path):
+                self.bytes_in += os.path.getsize(file_path)
+                os.remove(file_path)
+        return self.response
+
+    def phases(self) -> dict:
+        marks = dict(self.marks, started=self.started)
+        phases = {}
+        for name, start, end in (('connect', 'started', 'connected'), ('precheck', 'connected', 'upload'),
+                                 ('upload', 'upload', 'uploaded'), ('wait', 'uploaded', 'response'),
+                                 ('download', 'response', 'finished')):
+            if start in marks and end in marks:
+                phases[name] = marks[end] - marks[start]
+        return phases
+
+
+# サーバーのJobRecordが出力するJSONのログを集める
+class JobLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.records = []
+
+    def emit(self, record: logging.LogRecord):
+        message = record.getMessage()
+        if message.startswith('{"event": "job"'):
+            self.records.append(json.loads(message))
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def summarize(samples: dict) -> dict:
+    # phase -> 値のリストを、phase -> p50/p95/p99などに変換する
+    summary = {}
+    for name, values in samples.items():
+        if not values:
+            continue
+        summary[name] = {f'p{p}': round(percentile(values, p), 4) for p in PERCENTILES}
+        summary[name].update(mean=round(sum(values) / len(values), 4), max=round(max(values), 4), count=len(values))
+    return summary
+
+
+def parse_video(value: str) -> tuple[str, int]:
+    size, _, duration = value.partition(':')
+    return size, int(duration or 5)
+
+
+# ベンチマーク用のサーバーを別スレッドで起動し、ポート番号を返す
+def start_server(args, cache_dir: str, handler: JobLogHandler) -> int:
+    logger = logging.getLogger('benchmark.server')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    logger.addHandler(stderr_handler)
+    # キャッシュを使うと同じ入力と操作の2回目以降は変換しないため、既定では無効にする
+    cache = ResultCache(logger, cache_dir, ResultCache.MAX_BYTES if args.cache else 0)
+    if args.mode == 'thread':
+        scheduler = JobScheduler(logger, args.encode_workers, args.threads_per_job, args.max_queue)
+        server = Server('127.0.0.1', 0, logger, args.chunk_size, cache, scheduler, Metrics())
+    else:
+        scheduler = AsyncJobScheduler(logger, args.encode_workers, args.threads_per_job, args.max_queue)
+        server = AsyncServer('127.0.0.1', 0, logger, args.chunk_size, cache, scheduler, Metrics())
+    threading.Thread(target=server.run, name='server', daemon=True).start()
+    return server.sock.getsockname()[1]
+
+
+def run_job(args, port: int, video_path: str, operation: str, logger: logging.Logger) -> dict:
+    client = BenchmarkClient(args.host, port, logger, args.chunk_size, not args.no_precheck)
+    result = dict(operation=operation, video=os.path.basename(video_path))
+    try:
+        client.run()
+        client.process_video(dict(file_name=video_path, media_type='mp4',
+                                  request=dict(operation=operation, params=PARAMS[operation])))
+        client.mark('finished')
+        response = client.response or {}
+        result['status'] = response.get('status')
+    except Exception as e:
+        logger.warning(f'{operation} on {video_path} failed: {e}')
+        result['status'] = None
+        result['error'] = str(e)
+    finally:
+        client.sock.close()
+    result.update(seconds=time.perf_counter() - client.started, phases=client.phases(), bytes_out=client.bytes_out,
+                  bytes_in=client.bytes_in)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run concurrent clients against a server and report throughput, '
+                                                 'per-phase latency and error rates')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=5, help='requests per client')
+    parser.add_argument('--videos', nargs='+', default=['640x360:5', '1280x720:10'],
+                        help='synthetic inputs as WIDTHxHEIGHT:SECONDS')
+    parser.add_argument('--operations', nargs='+', default=list(PARAMS), choices=list(PARAMS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='use a running server instead of starting one')
+    parser.add_argument('--mode', default='async', choices=['async', 'thread'])
+    parser.add_argument('--encode-workers', type=int, default=0)
+    parser.add_argument('--threads-per-job', type=int, default=JobScheduler.THREADS_PER_JOB)
+    parser.add_argument('--max-queue', type=int, default=JobScheduler.MAX_QUEUE)
+    parser.add_argument('--chunk-size', type=int, default=TCPConnection.CHUNK_SIZE)
+    parser.add_argument('--cache', action='store_true', help='keep the result cache enabled')
+    parser.add_argument('--no-precheck', action='store_true', help='upload without the hash pre-check')
+    parser.add_argument('--json', help='write the results as JSON to this path (- for stdout)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    client_logger = logging.getLogger('benchmark.client')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 送受信したファイルは一時ディレクトリに置く
+        TCPConnection.DEST_DIR = os.path.join(tmp_dir, 'dest')
+        GifEncoder.PALETTE_DIR = os.path.join(tmp_dir, 'palettes')
+        videos = []
+        for value in args.videos:
+            size, duration = parse_video(value)
+            video_path = os.path.join(tmp_dir, f'input_{size}_{duration}s.mp4')
+            generate_video(video_path, duration, size, 30, 60)
+            videos.append(video_path)
+
+        handler = JobLogHandler()
+        port = args.port or start_server(args, os.path.join(tmp_dir, 'cache'), handler)
+
+        # 入力と操作の組み合わせを順に割り当てる
+        workload = list(itertools.product(videos, args.operations))
+        random.Random(args.seed).shuffle(workload)
+        jobs = itertools.cycle(workload)
+        assignments = [[next(jobs) for _ in range(args.requests)] for _ in range(args.clients)]
+
+        results = []
+        lock = threading.Lock()
+
+        def run_client(assignment):
+            for video_path, operation in assignment:
+                result = run_job(args, port, video_path, operation, client_logger)
+                with lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=run_client, args=(assignment,)) for assignment in assignments]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    report = build_report(args, results, handler.records, elapsed)
+    print_report(report)
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def build_report(args, results: list[dict], server_records: list[dict], elapsed: float) -> dict:
+    errors = [result for result in results if result['status'] != 200]
+    bytes_out = sum(result['bytes_out'] for result in results)
+    bytes_in = sum(result['bytes_in'] for result in results)
+    client_phases = collections.defaultdict(list)
+    operations = collections.defaultdict(lambda: dict(jobs=0, errors=0, seconds=[]))
+    for result in results:
+        operation = operations[result['operation']]
+        operation['jobs'] += 1
+        if result['status'] != 200:
+            operation['errors'] += 1
+            continue
+        operation['seconds'].append(result['seconds'])
+        client_phases['total'].append(result['seconds'])
+        for name, seconds in result['phases'].items():
+            client_phases[name].append(seconds)
+    server_phases = collections.defaultdict(list)
+    for record in server_records:
+        for name, seconds in record['phases'].items():
+            server_phases[name].append(seconds)
+
+    try:
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        version = ''
+    return dict(
+        version=version, python=platform.python_version(), cpus=os.cpu_count(), config=vars(args),
+        seconds=round(elapsed, 3), jobs=len(results), errors=len(errors),
+        error_rate=round(len(errors) / len(results), 4) if results else 0,
+        statuses=dict(collections.Counter(str(result['status']) for result in results)),
+        jobs_per_sec=round((len(results) - len(errors)) / elapsed, 3),
+        upload_mb_per_sec=round(bytes_out / 1024 ** 2 / elapsed, 3),
+        download_mb_per_sec=round(bytes_in / 1024 ** 2 / elapsed, 3),
+        mb_per_sec=round((bytes_out + bytes_in) / 1024 ** 2 / elapsed, 3),
+        latency=dict(client=summarize(client_phases), server=summarize(server_phases)),
+        operations={name: dict(jobs=operation['jobs'], errors=operation['errors'],
+                               **summarize(dict(seconds=operation['seconds'])).get('seconds', {}))
+                    for name, operation in sorted(operations.items())},
+    )
+
+
+def print_report(report: dict):
+    print(f'{report["jobs"]} jobs in {report["seconds"]:.2f}s ({report["version"]}, {report["cpus"]} cores): '
+          f'{report["jobs_per_sec"]:.2f} jobs/s, {report["mb_per_sec"]:.2f} MB/s '
+          f'(up {report["upload_mb_per_sec"]:.2f}, down {report["download_mb_per_sec"]:.2f}), '
+          f'errors {report["errors"]} ({report["error_rate"]:.1%}) {report["statuses"]}')
+    header = f'{"":<10}{"phase":<18}' + ''.join(f'{f"p{p} (s)":>10}' for p in PERCENTILES) + f'{"count":>8}'
+    print(header)
+    for side in ('client', 'server'):
+        for name, summary in report['latency'][side].items():
+            print(f'{side:<10}{name:<18}' + ''.join(f'{summary[f"p{p}"]:>10.3f}' for p in PERCENTILES) +
+                  f'{summary["count"]:>8}')
+    for name, operation in report['operations'].items():
+        if 'p50' in operation:
+            print(f'{"operation":<10}{name:<18}' + ''.join(f'{operation[f"p{p}"]:>10.3f}' for p in PERCENTILES) +
+                  f'{operation["count"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+from benchmarks.segment_benchmark import generate_video
+from models.EncoderPreset import EncoderPreset
+from models.MediaProbe import MediaProbe
+from models.VideoProcessor import VideoProcessor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare encode time and output size of the encoder presets')
+    parser.add_argument('--duration', type=int, default=30)
+    parser.add_argument('--size', default='1280x720')
+    parser.add_argument('--rate', type=int, default=30)
+    parser.add_argument('--gop', type=int, default=60)
+    parser.add_argument('--presets', nargs='+', default=list(EncoderPreset.PRESETS),
+                        choices=list(EncoderPreset.PRESETS))
+    parser.add_argument('--threads', type=int, nargs='+', default=[2], help='ffmpeg threads per job')
+    parser.add_argument('--crf', help='encode with this CRF instead of each codec default')
+    parser.add_argument('--target-size-mb', type=float, help='two-pass encode to this size instead of CRF')
+    parser.add_argument('--input', help='use this video instead of a generated one')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = args.input
+        if input_path is None:
+            input_path = os.path.join(tmp_dir, 'input.mp4')
+            generate_video(input_path, args.duration, args.size, args.rate, args.gop)
+        output_path = os.path.join(tmp_dir, 'output.mp4')
+        duration = MediaProbe.probe(input_path)['duration']
+        print(f'input: {duration:.1f}s ({os.path.getsize(input_path) / 1024 ** 2:.1f} MB), {os.cpu_count()} cores')
+
+        # 出力1MBあたりのエンコード速度（実時間の何倍か）が大きいほど、同じ台数で多く、小さく変換できる
+        print(f'{"preset":>12}{"threads":>9}{"time (s)":>10}{"speed":>8}{"size (MB)":>11}{"kbps":>8}{"speed/MB":>10}')
+        for preset in args.presets:
+            for threads in args.threads:
+                params = dict(preset=preset)
+                if args.target_size_mb:
+                    params['targetSizeMB'] = args.target_size_mb
+                else:
+                    params['crf'] = args.crf or EncoderPreset.DEFAULT_CRF[EncoderPreset.codec(preset)]
+                request = dict(operation=VideoProcessor.COMPRESS, params=params)
+                start = time.perf_counter()
+                VideoProcessor.process(request, input_path, output_path, threads)
+                elapsed = time.perf_counter() - start
+                size = os.path.getsize(output_path) / 1024 ** 2
+                speed = duration / elapsed
+                print(f'{preset:>12}{threads:>9}{elapsed:>10.2f}{speed:>8.2f}{size:>11.2f}'
+                      f'{size * 1024 ** 2 * 8 / 1000 / duration:>8.0f}{speed / size:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import ffmpeg
+import logging
+import os
+import tempfile
+import time
+from models.SegmentEncoder import SegmentEncoder
+from models.VideoProcessor import VideoProcessor
+
+
+# ffmpegのtestsrcで音声付きのテスト動画を作る
+def generate_video(file_path: str, duration: int, size: str, rate: int, gop: int):
+    video = ffmpeg.input(f'testsrc=size={size}:rate={rate}', format='lavfi', t=duration)
+    audio = ffmpeg.input('sine=frequency=440', format='lavfi', t=duration)
+    ffmpeg.output(video, audio, file_path, vcodec='libx264', acodec='aac', g=gop).run(overwrite_output=True,
+                                                                                       quiet=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the wall-clock speedup of segment-parallel encoding')
+    parser.add_argument('--duration', type=int, default=120)
+    parser.add_argument('--size', default='1280x720')
+    parser.add_argument('--rate', type=int, default=30)
+    parser.add_argument('--gop', type=int, default=60)
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', type=int, default=1, help='ffmpeg threads per segment')
+    parser.add_argument('--operation', default=VideoProcessor.RESOLUTION,
+                        choices=[VideoProcessor.COMPRESS, VideoProcessor.RESOLUTION, VideoProcessor.ASPECT_RATIO])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    params = {
+        VideoProcessor.COMPRESS: dict(compressRate='0.5'),
+        VideoProcessor.RESOLUTION: dict(width=640, height=360),
+        VideoProcessor.ASPECT_RATIO: dict(aspectRatio='4:3'),
+    }
+    request = dict(operation=args.operation, params=params[args.operation])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'input.mp4')
+        output_path = os.path.join(tmp_dir, 'output.mp4')
+        generate_video(input_path, args.duration, args.size, args.rate, args.gop)
+        print(f'input: {args.duration}s {args.size} ({os.path.getsize(input_path) / 1024 ** 2:.1f} MB), '
+              f'{os.cpu_count()} cores')
+
+        # 分割しない1つのffmpegでの変換を基準にする
+        start = time.perf_counter()
+        VideoProcessor.build(request, input_path, output_path)[0].run(overwrite_output=True, quiet=True)
+        baseline = time.perf_counter() - start
+        print(f'{"segments":>10}{"time (s)":>12}{"speedup":>10}')
+        print(f'{"single":>10}{baseline:>12.2f}{1.0:>10.2f}')
+
+        for segments in args.segments:
+            start = time.perf_counter()
+            # 区間ごとにargs.threadsスレッドを使えるよう、ジョブ全体のスレッド数を渡す
+            SegmentEncoder.encode(request, input_path, output_path, args.threads * segments, segments)
+            elapsed = time.perf_counter() - start
+            print(f'{segments:>10}{elapsed:>12.2f}{baseline / elapsed:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
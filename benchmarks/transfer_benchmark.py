@@ -0,0 +1,93 @@
+import argparse
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from models.TCPConnection import TCPConnection
+
+
+class BenchmarkConnection(TCPConnection):
+    def run(self):
+        pass
+
+
+# 従来のBUFFER_SIZEずつsend/recvするループ
+def legacy_send(sock: socket.socket, file_path: str):
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(TCPConnection.BUFFER_SIZE)
+            if not data:
+                break
+            sock.sendall(data)
+
+
+def legacy_receive(sock: socket.socket, file_path: str, payload_size: int):
+    with open(file_path, 'wb') as f:
+        while payload_size > 0:
+            data = sock.recv(TCPConnection.BUFFER_SIZE)
+            if not data:
+                break
+            f.write(data)
+            payload_size -= len(data)
+
+
+def measure(send, receive, src_path: str, dst_path: str, payload_size: int) -> float:
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    receiver_error = []
+
+    def serve():
+        conn, _ = listener.accept()
+        try:
+            receive(conn, dst_path, payload_size)
+        except Exception as e:
+            receiver_error.append(e)
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    start = time.perf_counter()
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        send(sock, src_path)
+        thread.join()
+    elapsed = time.perf_counter() - start
+    listener.close()
+    if receiver_error:
+        raise receiver_error[0]
+    if os.path.getsize(dst_path) != payload_size:
+        raise RuntimeError('Received size does not match')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the legacy send/recv loop with the sendfile/recv_into path')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[64 * 1024, 256 * 1024, 1024 * 1024])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    payload_size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = os.path.join(tmp_dir, 'src.bin')
+        dst_path = os.path.join(tmp_dir, 'dst.bin')
+        with open(src_path, 'wb') as f:
+            f.write(os.urandom(payload_size))
+
+        cases = [('legacy', TCPConnection.BUFFER_SIZE, legacy_send, legacy_receive)]
+        for chunk_size in args.chunk_sizes:
+            connection = BenchmarkConnection('127.0.0.1', 0, logger, chunk_size)
+            connection.sock.close()
+            cases.append(('sendfile', chunk_size, connection.send_payload, connection.receive_payload))
+
+        print(f'{"mode":<10}{"chunk":>10}{"best (s)":>12}{"MB/s":>10}')
+        for name, chunk_size, send, receive in cases:
+            best = min(measure(send, receive, src_path, dst_path, payload_size) for _ in range(args.repeat))
+            print(f'{name:<10}{chunk_size:>10}{best:>12.3f}{args.size_mb / best:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
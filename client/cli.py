@@ -0,0 +1,132 @@
+from dotenv import load_dotenv
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from models.Client import Client, VALID_VIDEO_EXTENSIONS
+from models.ClientPool import ClientPool
+
+# 操作ごとのパラメータとコマンドライン引数の対応
+# compressはcompressRate、crf、targetSizeMBのどれか1つが必要で、サーバーが検証する
+OPERATIONS = {
+    'compress': [],
+    'resolutionChange': ['width', 'height'],
+    'aspectRatioChange': ['aspectRatio'],
+    'audioExtract': [],
+    'gifConvert': ['startSec', 'endSec'],
+}
+
+
+def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    server_ip = os.getenv('SERVER_IP')
+    server_port = os.getenv('SERVER_PORT')
+    chunk_size = int(os.getenv('CHUNK_SIZE', Client.CHUNK_SIZE))
+    connections = int(os.getenv('CLIENT_CONNECTIONS', ClientPool.SIZE))
+
+    parser = argparse.ArgumentParser(description='Convert every video under the given paths without the GUI. '
+                                                 'Results are written next to the inputs')
+    parser.add_argument('paths', nargs='+', help='video files or directories (searched recursively)')
+    parser.add_argument('--operation', required=True, choices=list(OPERATIONS))
+    parser.add_argument('--compress-rate', dest='compressRate')
+    parser.add_argument('--crf', help='compress with a constant quality (0-51) instead of compressRate')
+    parser.add_argument('--target-size-mb', dest='targetSizeMB', help='compress to this size with two-pass encoding')
+    parser.add_argument('--preset', help='encoder preset for re-encoded videos (server default if omitted)')
+    parser.add_argument('--width')
+    parser.add_argument('--height')
+    parser.add_argument('--aspect-ratio', dest='aspectRatio', help='W:H')
+    parser.add_argument('--start-sec', dest='startSec', help='required for gifConvert, optional for the others')
+    parser.add_argument('--end-sec', dest='endSec', help='required for gifConvert, optional for the others')
+    parser.add_argument('--connections', type=int, default=connections, help='concurrent connections')
+    parser.add_argument('--overwrite', action='store_true', help='convert even if the result already exists')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in OPERATIONS[args.operation]}
+    missing = [name for name, value in params.items() if value is None]
+    if missing:
+        parser.error(f'{args.operation} needs {", ".join(missing)}')
+    # 省略できるパラメータ。範囲は他の操作でも指定すれば切り出す
+    for name in ('startSec', 'endSec', 'preset') + (('compressRate', 'crf', 'targetSizeMB')
+                                                    if args.operation == 'compress' else ()):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+    jobs = []
+    for file_path in find_videos(args.paths):
+        output_base = f'{os.path.splitext(file_path)[0]}_{args.operation}'
+        # 既に変換結果がある入力は飛ばす
+        if not args.overwrite and any(os.path.exists(f'{output_base}.{media_type}')
+                                      for media_type in ('mp4', 'mp3', 'gif')):
+            continue
+        jobs.append(dict(file_name=file_path, media_type='mp4', output_base=output_base,
+                         request=dict(operation=args.operation, params=params)))
+    if not jobs:
+        print('Nothing to convert', file=sys.stderr)
+        return
+
+    progress = Progress(jobs)
+    ClientPool(server_ip, int(server_port), logger, chunk_size, args.connections).run(jobs, progress.update)
+    progress.finish()
+    if progress.failed:
+        sys.exit(1)
+
+
+def find_videos(paths: list[str]) -> list[str]:
+    file_paths = []
+    for path in paths:
+        if os.path.isfile(path):
+            file_paths.append(path)
+            continue
+        for directory, _, file_names in os.walk(path):
+            # 以前の変換結果（'<元の名前>_<operation>.mp4'）は入力にしない
+            file_paths.extend(os.path.join(directory, file_name) for file_name in sorted(file_names)
+                              if file_name.endswith(VALID_VIDEO_EXTENSIONS)
+                              and not os.path.splitext(file_name)[0].endswith(tuple(f'_{operation}'
+                                                                                    for operation in OPERATIONS)))
+    return file_paths
+
+
+# 全体の進捗を1行で表示する
+class Progress:
+    def __init__(self, jobs: list[dict]):
+        self.total = len(jobs)
+        self.total_bytes = sum(os.path.getsize(params['file_name']) for params in jobs)
+        self.done = 0
+        self.done_bytes = 0
+        self.failed = []
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.show()
+
+    def update(self, params: dict, response: dict):
+        with self.lock:
+            self.done += 1
+            self.done_bytes += os.path.getsize(params['file_name'])
+            if response is None or response['status'] != 200:
+                message = response['message'] if response else 'transfer failed'
+                self.failed.append((params['file_name'], message))
+            self.show()
+
+    def show(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done_bytes / elapsed if elapsed else 0
+        eta = (self.total_bytes - self.done_bytes) / rate if rate else 0
+        print(f'\r[{self.done}/{self.total}] {self.done_bytes / 1024 ** 2:.1f}/{self.total_bytes / 1024 ** 2:.1f} MB, '
+              f'{rate / 1024 ** 2:.1f} MB/s, {len(self.failed)} failed, ETA {eta:.0f}s', end='', file=sys.stderr)
+
+    def finish(self):
+        print(file=sys.stderr)
+        for file_name, message in self.failed:
+            print(f'Failed: {file_name}: {message}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,22 @@
 from dotenv import load_dotenv
 import logging
 import os.path
+import threading
 import tkinter as tk
 from tkinter import filedialog
 import tkinter.ttk as ttk
 from models.Client import Client
 from models.WidgetLogger import WidgetLogger
 
+PROGRESS_INTERVAL = 100
+
 
 def main():
     # 環境変数の読み込み
     load_dotenv()
     server_ip = os.getenv('SERVER_IP')
     server_port = os.getenv('SERVER_PORT')
+    chunk_size = int(os.getenv('CHUNK_SIZE', Client.CHUNK_SIZE))
 
     # ウィンドウの設定
     root = tk.Tk()
@@ -37,11 +41,28 @@ def main():
     }
     detail_option_entries = setup_options(setting_frame, options, option)
 
-    # ボタンを作成
+    # アップロードしながら変換結果を受け取るストリーミングモード
+    streaming = tk.BooleanVar()
+    tk.Checkbutton(setting_frame, text='Streaming', variable=streaming).pack(anchor='w', padx=20, pady=5)
+
+    # ボタンを作成。変換は別スレッドで行い、その間はProcessの代わりにCancelを押せるようにする
     button_frame = tk.Frame(root)
     button_frame.pack(fill='both', padx=30)
-    tk.Button(button_frame, text='Process',
-              command=lambda: process_video(get_file_path(), option, detail_option_entries, client)).pack(fill='both')
+    process_button = tk.Button(button_frame, text='Process',
+                               command=lambda: start_job(
+                                   client, create_request(get_file_path(), option, detail_option_entries, streaming)))
+    process_button.pack(side='left', expand=True, fill='both')
+    cancel_button = tk.Button(button_frame, text='Cancel', state='disabled', command=lambda: client.cancel())
+    cancel_button.pack(side='right', fill='both')
+
+    # 進捗バー
+    progress_frame = tk.Frame(root)
+    progress_frame.pack(fill='both', padx=30, pady=(10, 0))
+    progress_bar = ttk.Progressbar(progress_frame, mode='determinate')
+    progress_bar.pack(fill='x')
+    status_label = tk.Label(progress_frame, anchor='w')
+    status_label.pack(fill='x')
+    on_progress, start_job = create_job_runner(root, process_button, cancel_button, progress_bar, status_label)
 
     # ログ表示用のフレームを作成
     log_frame = tk.Frame(root)
@@ -51,7 +72,7 @@ def main():
     logger = setup_logging(log_text)
 
     # クライアントの起動
-    client = Client(server_ip, int(server_port), logger)
+    client = Client(server_ip, int(server_port), logger, chunk_size, progress=on_progress)
     client.run()
 
     root.mainloop()
@@ -59,7 +80,7 @@ def main():
 
 def setup_layout(root):
     root.title('Video Compressor')
-    root.geometry('600x500')
+    root.geometry('600x560')
 
 
 def setup_logging(text_widget):
@@ -122,7 +143,71 @@ def create_file_selector():
     return select_file, get_file_path
 
 
-def process_video(file_path: str, option: tk.StringVar, detail_options: dict, client: Client):
+# 変換を別のスレッドで実行する。進捗は送受信のスレッドが最新の値を置いておき、GUIのスレッドがPROGRESS_INTERVALごとに反映する
+def create_job_runner(root, process_button, cancel_button, progress_bar, status_label):
+    latest = None
+    result = None
+
+    def on_progress(phase, done, total):
+        nonlocal latest
+        latest = (phase, done, total)
+
+    def start_job(client, params):
+        nonlocal latest, result
+        if params is None:
+            return
+        latest = None
+        result = None
+        process_button.config(state='disabled')
+        cancel_button.config(state='normal')
+        status_label.config(text='Connecting...')
+        thread = threading.Thread(target=run_job, args=(client, params), name='transfer', daemon=True)
+        thread.start()
+        poll(client, thread)
+
+    def run_job(client, params):
+        nonlocal result
+        try:
+            result = client.process_video(params)
+        except Exception as e:
+            client.logger.error(e, exc_info=True)
+
+    def poll(client, thread):
+        if latest:
+            show_progress(*latest)
+        if thread.is_alive():
+            root.after(PROGRESS_INTERVAL, poll, client, thread)
+            return
+        progress_bar.stop()
+        process_button.config(state='normal')
+        cancel_button.config(state='disabled')
+        if client.cancelled.is_set():
+            status_label.config(text='Cancelled')
+        elif result is None:
+            status_label.config(text='Failed')
+        elif result['status'] != 200:
+            status_label.config(text=f'Failed: {result["status"]} {result.get("message", "")}')
+        else:
+            progress_bar.config(mode='determinate', maximum=1, value=1)
+            status_label.config(text='Done')
+
+    def show_progress(phase, done, total):
+        # 大きさが分からない場合は動き続けるバーにする
+        if total:
+            progress_bar.stop()
+            progress_bar.config(mode='determinate', maximum=total, value=min(done, total))
+            status_label.config(text=f'{phase}: {done / 1024 ** 2:.1f} / {total / 1024 ** 2:.1f} MB')
+        else:
+            if str(progress_bar['mode']) != 'indeterminate':
+                progress_bar.config(mode='indeterminate')
+                progress_bar.start()
+            status_label.config(text=f'{phase}: {done / 1024 ** 2:.1f} MB' if done else f'{phase}...')
+
+    return on_progress, start_job
+
+
+# 入力の誤りはログに出してNoneを返す
+def create_request(file_path: str, option: tk.StringVar, detail_options: dict, streaming: tk.BooleanVar) -> dict:
     _, file_extension = os.path.splitext(file_path)
     try:
         # optionとoperationの対応
@@ -131,12 +216,12 @@ def process_video(file_path: str, option: tk.StringVar, detail_options: dict, cl
             'Resize': 'resolutionChange',
             'Change Aspect Ratio': 'aspectRatioChange',
             'Extract Audio': 'audioExtract',
-            'Convert to GIF': 'logging'
+            'Convert to GIF': 'gifConvert'
         }
 
         params = {
             'file_name': file_path,
-            'media_type': file_extension,
+            'media_type': file_extension[1:],
             'request': {
                 'operation': operation[option.get()],
                 'params': {
@@ -146,12 +231,10 @@ def process_video(file_path: str, option: tk.StringVar, detail_options: dict, cl
 
         # 各オプションに対応するエントリーから値を取得し、それをリクエストの形式に合わせて辞書に格納
         if option.get() == 'Compress':
-            client.logger.info(detail_options['Compress'][0].get())
-            client.logger.info(type(detail_options['Compress'][0].get()))
             params['request']['params']['compressRate'] = detail_options['Compress'][0].get()
         elif option.get() == 'Resize':
-            params['request']['params']['resolution'] = detail_options['Resize'][0].get() + 'x' + detail_options['Resize'][
-                1].get()
+            params['request']['params']['width'] = detail_options['Resize'][0].get()
+            params['request']['params']['height'] = detail_options['Resize'][1].get()
         elif option.get() == 'Change Aspect Ratio':
             params['request']['params']['aspectRatio'] = detail_options['Change Aspect Ratio'][0].get() + ':' + \
                                                          detail_options['Change Aspect Ratio'][1].get()
@@ -160,9 +243,12 @@ def process_video(file_path: str, option: tk.StringVar, detail_options: dict, cl
         elif option.get() == 'Convert to GIF':
             params['request']['params']['startSec'] = detail_options['Convert to GIF'][0].get()
             params['request']['params']['endSec'] = detail_options['Convert to GIF'][1].get()
-        client.process_video(params)
+        if streaming.get():
+            params['request']['streaming'] = True
+        return params
     except Exception as e:
-        client.logger.error(e, exc_info=True)
+        logging.error(e, exc_info=True)
+        return None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,580 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import logging
+import os.path
+import socket
+import time
+import zlib
+from models.EncoderPreset import EncoderPreset
+from models.FFmpegProgress import FFmpegProgress
+from models.GifEncoder import GifEncoder
+from models.JobScheduler import AsyncJobScheduler, JobScheduler, QueueFullError
+from models.MediaProbe import MediaProbe
+from models.Metrics import JobRecord, Metrics
+from models.ResultBuffer import MemoryBudget, ResultBuffer
+from models.ResultCache import ResultCache
+from models.SegmentEncoder import SegmentEncoder
+from models.Spool import Spool, SpoolFullError
+from models.UploadSession import UploadSession
+from models.VideoProcessor import InvalidRequestError, VideoProcessor
+from models.WorkerPool import WorkerPool
+from models.TCPConnection import ChunkCompressor, TCPConnection
+
+
+# 1つのイベントループで全ての接続を扱うサーバー。プロトコルはServerと同じ
+class AsyncServer(TCPConnection):
+    LISTEN_NUM = socket.SOMAXCONN
+    # keepAliveの接続で次のリクエストを待つ秒数
+    KEEP_ALIVE_TIMEOUT = 30
+
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = TCPConnection.CHUNK_SIZE,
+                 cache: ResultCache = None, scheduler: AsyncJobScheduler = None, metrics: Metrics = None,
+                 budget: MemoryBudget = None, spool: Spool = None, pool: WorkerPool = None):
+        super().__init__(host, port, logger, chunk_size)
+        self.cache = cache if cache else ResultCache(logger)
+        self.scheduler = scheduler if scheduler else AsyncJobScheduler(logger)
+        self.metrics = metrics if metrics else Metrics()
+        self.budget = budget if budget else MemoryBudget()
+        self.spool = spool if spool else Spool(logger)
+        # 指定された場合、変換はworkerノードで行う
+        self.pool = pool
+        self.metrics.add_collector(Metrics.stats_collector('scheduler', self.scheduler.stats))
+        self.metrics.add_collector(Metrics.stats_collector('cache', self.cache.stats))
+        self.metrics.add_collector(Metrics.stats_collector('probe', MediaProbe.stats))
+        self.metrics.add_collector(Metrics.stats_collector('palette', GifEncoder.stats))
+        self.metrics.add_collector(EncoderPreset.collect)
+        self.metrics.add_collector(Metrics.stats_collector('memory', self.budget.stats))
+        self.metrics.add_collector(Metrics.stats_collector('spool', self.spool.stats))
+        if self.pool:
+            self.metrics.add_collector(self.pool.collect)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        # Serverと同じく生成した時点で接続を受け付け、イベントループが動き出す前の接続も拒否しない
+        self.sock.listen(AsyncServer.LISTEN_NUM)
+
+    def run(self):
+        self.spool.start()
+        if self.pool:
+            self.pool.start()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt as e:
+            self.logger.error(e, exc_info=True)
+            self.sock.close()
+        finally:
+            self.spool.stop()
+            if self.pool:
+                self.pool.stop()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.listen_to_client, sock=self.sock, backlog=AsyncServer.LISTEN_NUM,
+                                            limit=self.chunk_size)
+        async with server:
+            await server.serve_forever()
+
+    # クライアントからのメッセージを待ち受ける
+    # keepAliveのリクエストが成功した場合は接続を切らずに、同じ接続で次のリクエストを待つ
+    async def listen_to_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.logger.info(f'Connection from {writer.get_extra_info("peername")} has been established!')
+        peer = ':'.join(map(str, writer.get_extra_info('peername')[:2]))
+        try:
+            header = None
+            while await self.handle_request(reader, writer, peer, header):
+                header = await self.wait_next_request(reader)
+                if header is None:
+                    break
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+            self.logger.info('Connection has been closed!')
+
+    # 次のリクエストのヘッダーを待つ。KEEP_ALIVE_TIMEOUT秒以内に届かないか、切断された場合はNone
+    @staticmethod
+    async def wait_next_request(reader: asyncio.StreamReader):
+        try:
+            return await asyncio.wait_for(reader.readexactly(AsyncServer.HEADER_SIZE), AsyncServer.KEEP_ALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    # 1つのリクエストを処理し、同じ接続で次のリクエストを受け付けるかを返す
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, peer: str,
+                             header: bytes = None) -> bool:
+        record = JobRecord(self.metrics, self.logger, peer).start()
+        try:
+            request, media_type, payload_size = await self.receive_request(reader, header)
+            # ハッシュだけが送られてきた場合、キャッシュにあればアップロードを省略する
+            # offsetがあれば、途中まで受信済みの変換結果の続きから送る
+            if AsyncServer.INPUT_HASH in request and payload_size == 0:
+                if request['operation'] == VideoProcessor.BATCH:
+                    sent = await self.send_cached_batch_response(writer, VideoProcessor.batch_requests(request),
+                                                                 request[AsyncServer.INPUT_HASH])
+                else:
+                    sent = await self.send_cached_response(
+                        writer, ResultCache.make_key(request[AsyncServer.INPUT_HASH], request),
+                        int(request.get('offset', 0)))
+                if sent:
+                    return request.get(AsyncServer.KEEP_ALIVE, False)
+                # 変換待ちが詰まっている場合はアップロードさせずに断る
+                if self.scheduler.is_full():
+                    raise QueueFullError('Encode queue is full')
+                # ディスクに入りきらない場合もアップロードさせずに断る
+                self.spool.check(int(request.get(AsyncServer.UPLOAD_SIZE, 0)))
+                response = UploadSession.not_found_response(request, self.spool.session_dir)
+                await self.send_response(writer, '', response, '')
+                request, media_type, payload_size = await self.receive_request(reader)
+            # streamingは失敗すると送受信の途中で切れるため、接続を使い回さない
+            # 標準入力から変換できるのはmoovが先頭にある入力だけで、それ以外は通常どおりファイルに受信してから変換する
+            loop = asyncio.get_running_loop()
+            head = b''
+            if request.get('streaming'):
+                head, streamable = await self.receive_stream_head(reader, payload_size)
+                if streamable:
+                    job_dir = await loop.run_in_executor(None, self.spool.reserve, len(head))
+                    try:
+                        with record.phase('probe'):
+                            plan = await loop.run_in_executor(None, VideoProcessor.plan_stream, request, head,
+                                                              job_dir)
+                        await self.process_streaming_request(reader, writer, request, payload_size, head, plan)
+                    finally:
+                        await loop.run_in_executor(None, self.spool.release, job_dir)
+                    return False
+                self.logger.info('The input has no moov at the beginning, receiving it before processing')
+            # 入力と変換途中のファイルはジョブ専用のディレクトリに置き、終わったらディレクトリごと削除する
+            upload_size = payload_size
+            if AsyncServer.SESSION_ID in request:
+                upload_size += int(request.get('offset', 0))
+            job_dir = await loop.run_in_executor(None, self.spool.reserve, upload_size)
+            try:
+                with record.phase('receive'):
+                    if AsyncServer.SESSION_ID in request:
+                        input_file_path, input_hash = await self.receive_session_upload(reader, request, media_type,
+                                                                                        payload_size, job_dir, head)
+                    else:
+                        hasher = hashlib.sha256()
+                        input_file_path = await self.receive_upload(reader, media_type, payload_size, hasher,
+                                                                    job_dir, head)
+                        input_hash = hasher.hexdigest()
+                record.received(payload_size)
+                # GIFのパレットのキャッシュは入力のハッシュで引く
+                request[AsyncServer.INPUT_HASH] = input_hash
+                if request['operation'] == VideoProcessor.BATCH:
+                    await self.process_batch_request(writer, request, input_file_path, input_hash)
+                else:
+                    await self.process_request(writer, request, input_file_path,
+                                               ResultCache.make_key(input_hash, request))
+            finally:
+                await loop.run_in_executor(None, self.spool.release, job_dir)
+            return request.get(AsyncServer.KEEP_ALIVE, False)
+        except QueueFullError as e:
+            self.logger.error(f'{e}: {self.scheduler.stats()}')
+            await self.send_error(writer, dict(status=503, message=str(e)))
+        except SpoolFullError as e:
+            self.logger.error(f'{e}: {self.spool.stats()}')
+            await self.send_error(writer, dict(status=507, message=str(e)))
+        except InvalidRequestError as e:
+            self.logger.error(f'Invalid request: {e}')
+            await self.send_error(writer, dict(status=400, message=str(e)))
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            await self.send_error(writer, dict(status=500, message=str(e)))
+        finally:
+            record.finish()
+        return False
+
+    async def process_request(self, writer: asyncio.StreamWriter, request: dict, input_file_path: str,
+                              cache_key: str):
+        # 変換結果は入力と同じジョブのディレクトリに書き出す
+        output_file_path = os.path.join(os.path.dirname(input_file_path),
+                                        f'processed_{os.path.basename(input_file_path)}')
+        buffer = None
+
+        try:
+            if await self.send_cached_response(writer, cache_key):
+                return
+
+            # 変換できないパラメータは変換待ちに並ぶ前に断る。probeは短時間で終わるのでスレッドで実行する
+            record = JobRecord.current.get()
+            loop = asyncio.get_running_loop()
+            with record.phase('probe'):
+                await loop.run_in_executor(None, VideoProcessor.plan, request, input_file_path)
+
+            # ファイルを処理する。変換は子プロセスを待つ
+            queued_at = time.monotonic()
+            async with self.scheduler.slot(self.priority(request)) as threads:
+                record.add('queue', time.monotonic() - queued_at)
+                self.logger.info('Processing...')
+                with record.phase('encode'):
+                    # workerノードで変換する。送受信はブロックするためスレッドで実行する
+                    if self.pool:
+                        media_type, output_file_path = await loop.run_in_executor(
+                            None, self.pool.process, request, input_file_path, output_file_path, threads)
+                    elif request['operation'] in VideoProcessor.PIPE_OPERATIONS:
+                        # mp3とGIFはファイルに書き出さずにメモリに受け取る。大きすぎる場合だけファイルに書き出す
+                        media_type = VideoProcessor.MEDIA_TYPES[request['operation']]
+                        output_file_path = f'{os.path.splitext(output_file_path)[0]}.{media_type}'
+                        buffer = ResultBuffer(self.budget, output_file_path)
+                        try:
+                            with VideoProcessor.palette(request) as palette:
+                                output = await loop.run_in_executor(
+                                    None, functools.partial(VideoProcessor.output, request, input_file_path,
+                                                            VideoProcessor.STREAM_OUTPUT, threads, palette=palette))
+                                await FFmpegProgress(record.update_progress).run_async(output, buffer)
+                        finally:
+                            buffer.close()
+                    # 大きな入力は区間ごとに並列でエンコードする。複数のffmpegを管理するためスレッドで実行する
+                    elif SegmentEncoder.eligible(request, input_file_path):
+                        media_type, output_file_path = await loop.run_in_executor(
+                            None, functools.partial(SegmentEncoder.encode, request, input_file_path,
+                                                    output_file_path, threads, progress=record.update_progress))
+                    # 2パスエンコードは2つのffmpegを順に実行するためスレッドで実行する
+                    elif VideoProcessor.two_pass(request):
+                        media_type, output_file_path = await loop.run_in_executor(
+                            None, VideoProcessor.process, request, input_file_path, output_file_path, threads,
+                            record.update_progress)
+                    else:
+                        started = time.monotonic()
+                        output, media_type, output_file_path = await loop.run_in_executor(
+                            None, VideoProcessor.build, request, input_file_path, output_file_path, threads)
+                        await FFmpegProgress(record.update_progress).run_async(output)
+                        await loop.run_in_executor(None, VideoProcessor.record, request, input_file_path,
+                                                   output_file_path, threads, time.monotonic() - started)
+
+            if buffer is not None and buffer.in_memory:
+                await self.send_memory_response(writer, cache_key, media_type, buffer.data)
+                return
+
+            # 変換結果をキャッシュに移して送信する。途中で切れても続きから受け取り直せる
+            # CRC32の計算と、別のファイルシステムへの移動はコピーになるため、スレッドで実行する
+            if not await loop.run_in_executor(None, self.cache.put, cache_key, output_file_path, media_type):
+                await self.send_response(writer, media_type, dict(status=200, message='OK'), output_file_path)
+            elif not await self.send_cached_response(writer, cache_key, count=False):
+                raise RuntimeError('The result was evicted before it was sent')
+        finally:
+            if buffer is not None:
+                buffer.release()
+
+    # メモリにある変換結果をヘッダーからpayloadまでまとめて書き込み、送った後にキャッシュに書き込む
+    async def send_memory_response(self, writer: asyncio.StreamWriter, cache_key: str, media_type: str,
+                                   data: bytearray):
+        checksum = zlib.crc32(data)
+        response = dict(status=200, message='OK', offset=0, size=len(data), checksum=checksum)
+        loop = asyncio.get_running_loop()
+        # 圧縮する場合があるため、バッファはスレッドで作る。ネゴシエーションの結果を見るためコンテキストを引き継ぐ
+        buffers = await loop.run_in_executor(None, contextvars.copy_context().run, self.memory_response, media_type,
+                                             response, data)
+        record = JobRecord.current.get()
+        with record.phase('send'):
+            writer.writelines(buffers)
+            await writer.drain()
+        record.sent(response, sum(len(buffer) for buffer in buffers[3:]))
+        self.logger.info(f'Result has been sent from memory! ({len(data)} bytes)')
+        try:
+            await loop.run_in_executor(None, self.cache.put_data, cache_key, data, media_type, checksum)
+        except OSError as e:
+            self.logger.error(f'Failed to cache the result: {e}')
+
+    # 複数の操作を1回のデコードでまとめて変換し、変換結果を1つのレスポンスで続けて返す
+    async def process_batch_request(self, writer: asyncio.StreamWriter, request: dict, input_file_path: str,
+                                    input_hash: str):
+        output_file_path = os.path.join(os.path.dirname(input_file_path),
+                                        f'processed_{os.path.basename(input_file_path)}')
+        # 今回変換した結果。key -> (パス, 拡張子)
+        outputs = {}
+
+        requests = VideoProcessor.batch_requests(request)
+        keys = [ResultCache.make_key(input_hash, sub_request) for sub_request in requests]
+        with contextlib.ExitStack() as stack:
+            # キャッシュにある変換結果は送信が終わるまで削除されないようにする
+            results = {}
+            for key in dict.fromkeys(keys):
+                cached = stack.enter_context(self.cache.lookup(key))
+                if cached is not None:
+                    results[key] = cached
+            missing = {key: sub_request for key, sub_request in zip(keys, requests) if key not in results}
+            if missing:
+                # 変換できないパラメータは変換待ちに並ぶ前に断る
+                record = JobRecord.current.get()
+                loop = asyncio.get_running_loop()
+                with record.phase('probe'):
+                    for sub_request in missing.values():
+                        await loop.run_in_executor(None, VideoProcessor.plan, sub_request, input_file_path)
+                queued_at = time.monotonic()
+                async with self.scheduler.slot(self.priority(request)) as threads:
+                    record.add('queue', time.monotonic() - queued_at)
+                    self.logger.info(f'Processing {len(missing)} of {len(requests)} operations...')
+                    with record.phase('encode'):
+                        if self.pool:
+                            processed = await loop.run_in_executor(
+                                None, self.pool.process_batch, list(missing.values()), input_file_path,
+                                output_file_path, threads)
+                        else:
+                            output, processed = await loop.run_in_executor(
+                                None, VideoProcessor.build_batch, list(missing.values()), input_file_path,
+                                output_file_path, threads)
+                            await FFmpegProgress(record.update_progress).run_async(output)
+                outputs = {key: (file_path, media_type)
+                           for key, (media_type, file_path) in zip(missing, processed)}
+                results.update(outputs)
+            await self.send_batch_response(writer, requests, keys, results)
+
+        # 送信した変換結果をキャッシュに移す
+        loop = asyncio.get_running_loop()
+        for key, (file_path, media_type) in outputs.items():
+            await loop.run_in_executor(None, self.cache.put, key, file_path, media_type)
+
+    # streamingの入力の先頭を、moovを読み終わるか、moovが先頭にないと分かるまで受信する
+    # 受信した先頭と、標準入力から変換できるかを返す
+    async def receive_stream_head(self, reader: asyncio.StreamReader, payload_size: int) -> tuple[bytes, bool]:
+        head = b''
+        while True:
+            streamable, size = MediaProbe.stream_head(head)
+            if streamable is not None:
+                return head, streamable
+            if size > min(payload_size, MediaProbe.MAX_STREAM_HEAD):
+                return head, False
+            head += await reader.readexactly(size - len(head))
+
+    # ファイルを保存せず、受信したデータをffmpegに流し込みながら変換結果を順次返す。headはpayloadのうち既に受信した先頭
+    async def process_streaming_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                        request: dict, payload_size: int, head: bytes, plan: dict):
+        record = JobRecord.current.get()
+        record.received(payload_size)
+        queued_at = time.monotonic()
+        async with self.scheduler.slot(self.priority(request)) as threads:
+            record.add('queue', time.monotonic() - queued_at)
+            with record.phase('encode'):
+                self.logger.info('Processing (streaming)...')
+                output, media_type = VideoProcessor.build_stream(request, plan, threads)
+                process = await asyncio.create_subprocess_exec(*output.compile(), stdin=asyncio.subprocess.PIPE,
+                                                               stdout=asyncio.subprocess.PIPE)
+                feeder = asyncio.create_task(self.feed_process(reader, process, head, payload_size))
+                try:
+                    # 最初の出力を待ち、何も出力せずに失敗した場合は通常のエラーレスポンスを返す
+                    chunk_size = self.negotiated_chunk_size()
+                    data = await process.stdout.read(chunk_size)
+                    if not data:
+                        await feeder
+                        raise RuntimeError(f'ffmpeg exited with code {await process.wait()}')
+                    response = dict(status=200, message='OK', transfer=AsyncServer.CHUNKED)
+                    self.write_metadata(writer, media_type, response, 0)
+                    compressor = ChunkCompressor(self.compresses(media_type))
+                    while data:
+                        buffers = await self.encode_chunk(compressor, data)
+                        writer.writelines(buffers)
+                        await writer.drain()
+                        record.sent(response, len(buffers[1]))
+                        data = await process.stdout.read(chunk_size)
+                    await feeder
+                    # 途中で失敗した場合は終端チャンクを送らずに接続を切り、クライアントに不完全なことを伝える
+                    if await process.wait() != 0:
+                        self.logger.error(f'ffmpeg exited with code {process.returncode} while streaming')
+                        return
+                    writer.write(int.to_bytes(0, AsyncServer.CHUNK_LENGTH_SIZE, 'big'))
+                    await writer.drain()
+                    self.logger.info('Streaming has been completed!')
+                finally:
+                    if process.returncode is None:
+                        process.kill()
+                    await process.wait()
+                    feeder.cancel()
+
+    async def feed_process(self, reader: asyncio.StreamReader, process: asyncio.subprocess.Process, head: bytes,
+                           payload_size: int):
+        try:
+            process.stdin.write(head)
+            payload_size -= len(head)
+            while payload_size > 0:
+                data = await reader.read(min(payload_size, self.chunk_size))
+                if not data:
+                    raise ConnectionError(f'Connection closed with {payload_size} bytes remaining')
+                process.stdin.write(data)
+                await process.stdin.drain()
+                payload_size -= len(data)
+        except (BrokenPipeError, ConnectionError) as e:
+            self.logger.error(f'Failed to feed ffmpeg: {e}')
+        finally:
+            process.stdin.close()
+
+    @staticmethod
+    def priority(request: dict) -> int:
+        return int(request.get('priority', JobScheduler.DEFAULT_PRIORITY))
+
+    async def send_cached_response(self, writer: asyncio.StreamWriter, cache_key: str, offset: int = 0,
+                                   count: bool = True) -> bool:
+        with self.cache.lookup(cache_key, count) as cached:
+            if cached is None:
+                return False
+            file_path, media_type = cached
+            self.logger.info(f'Sending cached result from {offset}: {cache_key} {self.cache.stats()}')
+            size = os.path.getsize(file_path)
+            if offset > size:
+                offset = 0
+            checksum = await asyncio.get_running_loop().run_in_executor(None, self.cache.checksum, cache_key,
+                                                                        file_path)
+            response = dict(status=200, message='OK', offset=offset, size=size, checksum=checksum)
+            await self.send_response(writer, media_type, response, file_path, offset)
+            return True
+
+    # 全ての操作の変換結果がキャッシュにある場合だけ返す
+    async def send_cached_batch_response(self, writer: asyncio.StreamWriter, requests: list[dict],
+                                         input_hash: str) -> bool:
+        keys = [ResultCache.make_key(input_hash, sub_request) for sub_request in requests]
+        with contextlib.ExitStack() as stack:
+            results = {key: stack.enter_context(self.cache.lookup(key)) for key in dict.fromkeys(keys)}
+            if None in results.values():
+                return False
+            self.logger.info(f'Sending {len(requests)} cached results: {self.cache.stats()}')
+            await self.send_batch_response(writer, requests, keys, results)
+            return True
+
+    # resultsに各変換結果の拡張子と大きさを並べ、payloadにはその順に続けて送る
+    async def send_batch_response(self, writer: asyncio.StreamWriter, requests: list[dict], keys: list[str],
+                                  results: dict):
+        file_paths = [results[key][0] for key in keys]
+        sizes = [os.path.getsize(file_path) for file_path in file_paths]
+        response = dict(status=200, message='OK', results=[
+            dict(operation=sub_request['operation'], mediaType=results[key][1], size=size)
+            for sub_request, key, size in zip(requests, keys, sizes)])
+        record = JobRecord.current.get()
+        with record.phase('send'):
+            self.write_metadata(writer, '', response, sum(sizes))
+            for file_path in file_paths:
+                with open(file_path, 'rb') as f:
+                    await asyncio.get_running_loop().sendfile(writer.transport, f)
+            self.logger.info(f'Files have been sent! ({sum(sizes)} bytes)')
+            await writer.drain()
+        record.sent(response, sum(sizes))
+
+    async def receive_request(self, reader: asyncio.StreamReader, header: bytes = None) -> tuple[dict, str, int]:
+        self.logger.info('Waiting for header...')
+        # リクエストを読めるまではv1として応答する
+        AsyncServer.negotiated.set(None)
+        request_size, media_type_size, payload_size = self.unpack_header(
+            header or await reader.readexactly(AsyncServer.HEADER_SIZE))
+        self.logger.info(
+            f'request_size: {request_size}, media_type_size: {media_type_size}, payload_size: {payload_size}')
+        request = self.decode_metadata(await reader.readexactly(request_size))
+        media_type = (await reader.readexactly(media_type_size)).decode('utf-8')
+        self.logger.info(f'Request: {request}, media_type: {media_type}')
+        self.negotiate(request)
+        JobRecord.current.get().operation = request.get('operation')
+        return request, media_type, payload_size
+
+    # ジョブのディレクトリに入力を受信し、保存したパスを返す
+    # headはpayloadのうち既に受信した先頭
+    async def receive_upload(self, reader: asyncio.StreamReader, media_type: str, payload_size: int, hasher,
+                             job_dir: str, head: bytes = b'') -> str:
+        file_path = os.path.join(job_dir, f'input.{media_type}')
+        self.logger.info(f'Saving file to {file_path}')
+        loop = asyncio.get_running_loop()
+        with open(file_path, 'wb') as f:
+            # 領域の確保とファイルへの書き込みはイベントループを止めないようスレッドで行う
+            await loop.run_in_executor(None, Spool.allocate, f, payload_size)
+            with Spool.truncated(f):
+                await loop.run_in_executor(None, f.write, head)
+                hasher.update(head)
+                await self.copy_to_file(reader, f, payload_size - len(head), hasher)
+        self.logger.info('File has been received!')
+        return file_path
+
+    # 続きから受信し、受信済みの部分と合わせて入力のハッシュを確かめる
+    # ジョブのディレクトリに移した入力のパスと入力のハッシュを返す
+    async def receive_session_upload(self, reader: asyncio.StreamReader, request: dict, media_type: str,
+                                     payload_size: int, job_dir: str, head: bytes = b'') -> tuple[str, str]:
+        session = UploadSession(request[AsyncServer.SESSION_ID], self.spool.session_dir)
+        offset = int(request.get('offset', 0))
+        self.logger.info(f'Receiving session {session.session_id} from {offset}')
+        loop = asyncio.get_running_loop()
+        f, hasher = await loop.run_in_executor(None, session.open, offset)
+        with f:
+            await loop.run_in_executor(None, Spool.allocate, f, offset + payload_size)
+            with Spool.truncated(f):
+                await loop.run_in_executor(None, f.write, head)
+                hasher.update(head)
+                await self.copy_to_file(reader, f, payload_size - len(head), hasher)
+        file_path = os.path.join(job_dir, f'input.{media_type}')
+        session.complete(hasher, request.get(AsyncServer.INPUT_HASH), file_path)
+        self.logger.info('File has been received!')
+        return file_path, hasher.hexdigest()
+
+    async def copy_to_file(self, reader: asyncio.StreamReader, f, size: int, hasher=None):
+        loop = asyncio.get_running_loop()
+        while size > 0:
+            data = await reader.read(min(size, self.chunk_size))
+            if not data:
+                raise ConnectionError(f'Connection closed with {size} bytes remaining')
+            await loop.run_in_executor(None, f.write, data)
+            if hasher:
+                hasher.update(data)
+            size -= len(data)
+
+    def write_metadata(self, writer: asyncio.StreamWriter, media_type: str, response: dict, payload_size: int):
+        response_bytes = self.encode_metadata(response)
+        media_type_bytes = bytes(media_type, 'utf-8')
+        writer.write(self.pack_header(len(response_bytes), len(media_type_bytes), payload_size))
+        writer.write(response_bytes)
+        writer.write(media_type_bytes)
+
+    async def send_response(self, writer: asyncio.StreamWriter, media_type: str, response: dict, file_path: str,
+                            offset: int = 0):
+        payload_size = os.path.getsize(file_path) - offset if file_path else 0
+        record = JobRecord.current.get()
+        if file_path and self.compresses(media_type):
+            # 圧縮後の大きさは送るまでわからないため、チャンク形式で送る
+            response = dict(response, transfer=AsyncServer.CHUNKED)
+            with record.phase('send'):
+                self.write_metadata(writer, media_type, response, 0)
+                sent = await self.send_compressed_file(writer, file_path, offset)
+            record.sent(response, sent)
+            return
+        with record.phase('send'):
+            self.write_metadata(writer, media_type, response, payload_size)
+            if file_path:
+                # sendfileでカーネル内でファイルをコピーして送信する
+                with open(file_path, 'rb') as f:
+                    await asyncio.get_running_loop().sendfile(writer.transport, f, offset)
+                self.logger.info(f'File has been sent! ({payload_size} bytes)')
+            await writer.drain()
+        record.sent(response, payload_size)
+
+    # 圧縮はmmapしたファイルを直接読み、圧縮が効かなくなった後はsendfileで送る
+    async def send_compressed_file(self, writer: asyncio.StreamWriter, file_path: str, offset: int = 0) -> int:
+        compressor = ChunkCompressor(True)
+        chunk_size = self.negotiated_chunk_size()
+        size = os.path.getsize(file_path)
+        sent = 0
+        loop = asyncio.get_running_loop()
+        with open(file_path, 'rb') as f, AsyncServer.map_file(f, size) as mapped:
+            for start in range(offset, size, chunk_size):
+                count = min(chunk_size, size - start)
+                if compressor.enabled:
+                    with memoryview(mapped)[start:start + count] as view:
+                        buffers = await self.encode_chunk(compressor, view)
+                        writer.writelines(buffers)
+                        await writer.drain()
+                        sent += len(buffers[1])
+                else:
+                    writer.write(int.to_bytes(count, AsyncServer.CHUNK_LENGTH_SIZE, 'big'))
+                    await loop.sendfile(writer.transport, f, start, count)
+                    sent += count
+        writer.write(int.to_bytes(0, AsyncServer.CHUNK_LENGTH_SIZE, 'big'))
+        await writer.drain()
+        self.logger.info(f'File has been sent! ({sent} bytes for {size - offset} bytes)')
+        return sent
+
+    # 圧縮はイベントループを止めないよう別スレッドで行う
+    @staticmethod
+    async def encode_chunk(compressor: ChunkCompressor, data: bytes) -> list[bytes]:
+        if not compressor.enabled:
+            return compressor.encode(data)
+        return await asyncio.get_running_loop().run_in_executor(None, compressor.encode, data)
+
+    async def send_error(self, writer: asyncio.StreamWriter, response: dict):
+        try:
+            await self.send_response(writer, '', response, '')
+        except ConnectionError as e:
+            self.logger.error(f'Failed to send error response: {e}')
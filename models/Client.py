@@ -1,4 +1,10 @@
 import logging
+import os
+import shutil
+import socket
+import threading
+import uuid
+from models.ResultCache import ResultCache
 from models.TCPConnection import TCPConnection
 
 VALID_VIDEO_EXTENSIONS = ('.mp4',)
@@ -7,25 +13,209 @@ VALID_VIDEO_EXTENSIONS = ('.mp4',)
 class Client(TCPConnection):
     MAX_FILE_SIZE = 2 ** 47
     OUTPUT_FILE_NAME = 'output'
+    MAX_RETRIES = 3
 
-    def __init__(self, host: str, port: int, logger: logging.Logger):
-        super().__init__(host, port, logger)
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = TCPConnection.CHUNK_SIZE,
+                 precheck: bool = True, keep_alive: bool = False, progress=None):
+        super().__init__(host, port, logger, chunk_size)
         self.logger = logger
+        self.precheck = precheck
+        self.keep_alive = keep_alive
+        # progress(phase, done, total)を送受信したバイト数とともに呼ぶ。totalが分からない場合は0
+        # phaseは'upload'、'processing'（サーバーの変換待ち）、'download'のいずれか。送受信を行うスレッドから呼ばれる
+        self.progress = progress
+        self.cancelled = threading.Event()
+        self.downloaded = 0
+        self.download_size = 0
+        # 今の接続で次のリクエストを送れるか。サーバーは1つのリクエストを処理すると、keepAliveでなければ接続を切る
+        self.reusable = False
         self.sock.settimeout(Client.TIMEOUT)
 
     def run(self):
         self.sock.connect((self.host, self.port))
+        self.reusable = True
 
-    def process_video(self, params: dict):
+    # 接続し直す。送受信の途中で切れた場合に使う
+    def reconnect(self):
+        self.sock.close()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(Client.TIMEOUT)
+        self.run()
+
+    # 別のスレッドから呼ぶ。送受信の途中でも接続を切り、実行中のprocess_videoはNoneを返す
+    def cancel(self):
+        self.cancelled.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def report(self, phase: str, done: int, total: int):
+        if self.progress:
+            self.progress(phase, done, total)
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise ConnectionAbortedError('Transfer has been cancelled')
+
+    # 最後のレスポンスを返す。送受信に失敗した場合はNone
+    # params['output_base']があれば、変換結果を'<output_base>.<拡張子>'に保存する
+    def process_video(self, params: dict) -> dict:
         file_name = params['file_name']
         if not file_name.endswith(VALID_VIDEO_EXTENSIONS):
             self.logger.error(f'Invalid file extension: {file_name}')
             self.sock.close()
-            return
-        self.send_header(self.sock, params['media_type'], params['request'], file_name)
-        self.send_body(self.sock, params['media_type'], params['request'], file_name)
+            self.reusable = False
+            return None
+        self.cancelled.clear()
+        if not self.reusable:
+            self.reconnect()
+        self.reusable = False
+        # v2を希望する。v1のサーバーは知らないキーを無視する
+        request = dict(params['request'], **self.offer())
+        if self.keep_alive:
+            request[Client.KEEP_ALIVE] = True
+        params = dict(params, request=request)
+        if not self.precheck:
+            try:
+                response = self.upload(params, params['request'])
+            except socket.error:
+                if not self.cancelled.is_set():
+                    raise
+                response = None
+            if self.cancelled.is_set():
+                self.logger.info(f'Cancelled {file_name}')
+                return None
+            self.reuse(params, response)
+            return response
+        # 同じセッションIDで接続し直すと、サーバーは受信済みの位置から続きを受け付ける
+        session = dict(sessionId=uuid.uuid4().hex, inputHash=ResultCache.hash_file(file_name))
+        for attempt in range(Client.MAX_RETRIES + 1):
+            try:
+                if attempt:
+                    self.reconnect()
+                self.check_cancelled()
+                response = self.resume(params, session)
+                if response['status'] == 200 and params.get('output_base') and 'download_path' in session:
+                    media_type = os.path.splitext(session['download_path'])[1]
+                    shutil.move(session['download_path'], params['output_base'] + media_type)
+                self.reuse(params, response)
+                return response
+            except socket.error as e:
+                if self.cancelled.is_set():
+                    self.logger.info(f'Cancelled {file_name}')
+                    return None
+                self.logger.warning(f'Transfer has been interrupted ({attempt + 1}/{Client.MAX_RETRIES + 1}): {e}')
+        self.logger.error(f'Failed to process {file_name}')
+        return None
+
+    # keepAliveで成功した場合だけ、次のリクエストに今の接続を使う
+    def reuse(self, params: dict, response: dict):
+        self.reusable = (self.keep_alive and response is not None and response['status'] == 200
+                         and not params['request'].get('streaming'))
+
+    # アップロードの前に入力のハッシュを送り、サーバーに変換結果があればそれを受け取る
+    # キャッシュにあった場合やサーバーが混雑している場合はアップロードしない
+    def resume(self, params: dict, session: dict):
+        download_path = session.get('download_path')
+        downloaded = os.path.getsize(download_path) if download_path and os.path.exists(download_path) else 0
+        request = dict(params['request'], inputHash=session['inputHash'], sessionId=session['sessionId'],
+                       offset=downloaded, uploadSize=os.path.getsize(params['file_name']))
+        self.send_header(self.sock, params['media_type'], request, '')
+        self.send_metadata(self.sock, params['media_type'], request)
+        response = self.receive_response(session)
+        if response['status'] != 404:
+            return response
+
+        # サーバーが受信済みの部分が手元のファイルと一致する場合だけ続きから送る
+        offset = response.get('offset', 0)
+        if offset and self.checksum(params['file_name'], offset) != response.get('checksum'):
+            self.logger.warning('Uploaded data does not match the local file, restarting from the beginning')
+            offset = 0
+        self.logger.info(f'Uploading from {offset}')
+        return self.upload(params, dict(request, offset=offset), offset, session)
+
+    def upload(self, params: dict, request: dict, offset: int = 0, session: dict = None) -> dict:
+        file_name = params['file_name']
+        if request.get('streaming'):
+            # サーバーはアップロード中から結果を返し始めるため、送信と並行して受信する
+            # 受信スレッドの例外は呼び出し元に伝え、途中で切れた場合はやり直させる
+            responses = []
+            errors = []
+
+            def receive():
+                try:
+                    responses.append(self.receive_response(session))
+                except Exception as e:
+                    errors.append(e)
+
+            receiver = threading.Thread(target=receive)
+            receiver.start()
+            self.send_header(self.sock, params['media_type'], request, file_name, offset)
+            self.send_body(self.sock, params['media_type'], request, file_name, offset)
+            receiver.join()
+            if errors:
+                raise errors[0]
+            if not responses:
+                raise ConnectionError('Connection closed before the response was received')
+            return responses[0]
+        self.send_header(self.sock, params['media_type'], request, file_name, offset)
+        self.send_body(self.sock, params['media_type'], request, file_name, offset)
+        # send_bodyは送信の失敗を握りつぶすため、キャンセルで切った場合はここで止める
+        self.check_cancelled()
+        self.report('processing', 0, 0)
+        return self.receive_response(session)
+
+    # キャンセルを確かめて進捗を通知できるよう、chunk_sizeずつsendfileで送る
+    def send_payload(self, sock: socket.socket, file_path: str, offset: int = 0):
+        size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            for start in range(offset, size, self.chunk_size):
+                self.check_cancelled()
+                count = min(self.chunk_size, size - start)
+                sock.sendfile(f, start, count)
+                self.report('upload', start + count - offset, size - offset)
+        self.logger.info(f'File has been sent! ({size - offset} bytes)')
+
+    # 受信はすべてここを通る。圧縮されたチャンクは数えないため、圧縮された変換結果では進捗が途中で止まる
+    def copy_to_writer(self, sock: socket.socket, writer, size: int, hasher=None):
+        while size > 0:
+            self.check_cancelled()
+            count = min(size, self.chunk_size)
+            super().copy_to_writer(sock, writer, count, hasher)
+            size -= count
+            self.downloaded += count
+            self.report('download', self.downloaded, self.download_size)
+
+    def receive_response(self, session: dict = None) -> dict:
         self.logger.info('Waiting for response...')
         request_size, media_type_size, payload_size = self.receive_header(self.sock)
         self.logger.info(
             f'request_size: {request_size}, media_type_size: {media_type_size}, payload_size: {payload_size}')
-        self.receive_body(self.sock, request_size, media_type_size, payload_size)
+        response, media_type = self.receive_metadata(self.sock, request_size, media_type_size)
+        self.logger.info(f'Response: {response}')
+        if response['status'] != 200:
+            return response
+        self.downloaded = 0
+        self.download_size = payload_size
+        if response.get('transfer') == Client.CHUNKED:
+            self.download_size = max(0, response.get('size', 0) - response.get('offset', 0))
+        self.report('download', 0, self.download_size)
+        if Client.RESULTS in response:
+            address, port = self.sock.getsockname()
+            name = session['sessionId'] if session else f'{address}_{port}'
+            self.receive_results(self.sock, response, f'{Client.OUTPUT_FILE_NAME}_{name}')
+            return response
+        if session is None:
+            self.receive_file(self.sock, response, media_type, payload_size)
+            return response
+
+        # セッションごとに決まった名前で保存し、途中で切れても続きから受け取る
+        file_name = f'{Client.OUTPUT_FILE_NAME}_{session["sessionId"]}.{media_type}'
+        session['download_path'] = os.path.join(Client.DEST_DIR, file_name)
+        self.receive_file(self.sock, response, media_type, payload_size, file_name=file_name,
+                          offset=response.get('offset', 0))
+        if 'checksum' in response and self.checksum(session['download_path']) != response['checksum']:
+            os.remove(session['download_path'])
+            raise ConnectionError('Checksum mismatch: the downloaded file is corrupted')
+        return response
@@ -0,0 +1,51 @@
+import logging
+import queue
+import threading
+from models.Client import Client
+from models.TCPConnection import TCPConnection
+
+
+# size本までの接続で複数のファイルを並行して変換する。各接続はkeepAliveで次のファイルにも使い回す
+class ClientPool:
+    SIZE = 4
+
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = TCPConnection.CHUNK_SIZE,
+                 size: int = SIZE):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self.size = size
+
+    # jobsはClient.process_videoに渡すparamsのリスト。1つ終わるたびにcallback(params, response)を呼ぶ
+    # responseは最後のレスポンスで、送受信に失敗した場合はNone
+    def run(self, jobs: list[dict], callback=None):
+        pending = queue.Queue()
+        for params in jobs:
+            pending.put(params)
+        workers = [threading.Thread(target=self.work, args=(pending, callback), name=f'client-{i}')
+                   for i in range(min(self.size, len(jobs)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, pending: queue.Queue, callback):
+        client = Client(self.host, self.port, self.logger, self.chunk_size, keep_alive=True)
+        try:
+            while True:
+                try:
+                    params = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    response = client.process_video(params)
+                except Exception as e:
+                    # 接続できない場合なども次のファイルに進む。次のファイルでは接続し直す
+                    self.logger.error(f'Failed to process {params["file_name"]}: {e}')
+                    client.reusable = False
+                    response = None
+                if callback:
+                    callback(params, response)
+        finally:
+            client.sock.close()
@@ -0,0 +1,65 @@
+import json
+import logging
+import threading
+
+
+# 名前付きのエンコード設定。リクエストのpresetで速度と大きさのトレードオフを選ぶ
+# プリセットとスレッド数ごとにエンコード時間と出力サイズを集計し、どの設定が効率がよいかを比べられるようにする
+class EncoderPreset:
+    PRESETS = {
+        'fastest': dict(vcodec='libx264', preset='ultrafast'),
+        'fast': dict(vcodec='libx264', preset='veryfast'),
+        # ffmpegのデフォルトと同じ
+        'balanced': dict(vcodec='libx264', preset='medium'),
+        'small': dict(vcodec='libx264', preset='slow'),
+        # hvc1のタグを付けないとQuickTimeなどで再生できない
+        'hevc': dict(vcodec='libx265', preset='fast', **{'tag:v': 'hvc1'}),
+        'hevc-small': dict(vcodec='libx265', preset='slow', **{'tag:v': 'hvc1'}),
+    }
+    DEFAULT = 'balanced'
+    # 同じ画質になるCRFの目安はコーデックごとに違う
+    DEFAULT_CRF = {'libx264': 23, 'libx265': 28}
+    # x265は進捗以外のログを大量に出すため、エラーだけにする
+    X265_PARAMS = 'log-level=error'
+
+    lock = threading.Lock()
+    # (プリセット, スレッド数) -> 集計
+    totals = {}
+
+    @staticmethod
+    # ffmpegの出力に渡すオプション。numberを渡すと2パスエンコードのnumber回目にする
+    def options(name: str, number: int = 0, passlog: str = None) -> dict:
+        options = dict(EncoderPreset.PRESETS[name])
+        if options['vcodec'] == 'libx265':
+            x265_params = EncoderPreset.X265_PARAMS
+            if number:
+                x265_params += f':pass={number}:stats={passlog}'
+            options['x265-params'] = x265_params
+        elif number:
+            options.update({'pass': number, 'passlogfile': passlog})
+        return options
+
+    @staticmethod
+    def codec(name: str) -> str:
+        return EncoderPreset.PRESETS[name]['vcodec']
+
+    @staticmethod
+    # 1回のエンコードの結果を集計に加える。media_secondsはエンコードした動画の長さ
+    def record(name: str, threads: int, seconds: float, output_bytes: int, media_seconds: float):
+        with EncoderPreset.lock:
+            totals = EncoderPreset.totals.setdefault((name, threads), dict(jobs=0, encode_seconds=0.0,
+                                                                           output_bytes=0, media_seconds=0.0))
+            totals['jobs'] += 1
+            totals['encode_seconds'] += seconds
+            totals['output_bytes'] += output_bytes
+            totals['media_seconds'] += media_seconds
+        logging.info(json.dumps(dict(event='encode', preset=name, threads=threads, seconds=round(seconds, 3),
+                                     output_bytes=output_bytes, media_seconds=round(media_seconds, 3))))
+
+    @staticmethod
+    # Metricsのcollector。プリセットとスレッド数をラベルにする
+    def collect() -> list:
+        with EncoderPreset.lock:
+            totals = [(name, threads, dict(values)) for (name, threads), values in EncoderPreset.totals.items()]
+        return [(f'preset_{key}', dict(preset=name, threads=threads), value)
+                for name, threads, values in totals for key, value in values.items()]
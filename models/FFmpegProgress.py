@@ -0,0 +1,97 @@
+import asyncio
+import collections
+import ffmpeg
+import logging
+import re
+import subprocess
+import threading
+
+
+# ffmpegに-progressで進捗をstderrへ書き出させ、1回分の進捗がそろうたびにcallbackに渡す
+class FFmpegProgress:
+    ARGS = ['-progress', 'pipe:2', '-nostats']
+    PATTERN = re.compile(r'^(\w+)=\s*(\S*)$')
+    # 失敗したときに例外に含めるログの行数
+    LOG_LINES = 20
+    # 標準出力から1度に読み込むバイト数
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.values = {}
+        self.log = collections.deque(maxlen=FFmpegProgress.LOG_LINES)
+
+    @staticmethod
+    def command(output: ffmpeg.nodes.OutputStream) -> list[str]:
+        args = output.compile(overwrite_output=True)
+        return args[:1] + FFmpegProgress.ARGS + args[1:]
+
+    # 進捗はkey=valueの行が続き、progress=continue|endで1回分が終わる。それ以外の行はffmpegのログ
+    def feed(self, line: str):
+        line = line.rstrip()
+        match = FFmpegProgress.PATTERN.match(line)
+        if match is None:
+            if line:
+                self.log.append(line)
+                logging.debug(line)
+            return
+        key, value = match.groups()
+        self.values[key] = value
+        if key == 'progress':
+            if self.callback:
+                self.callback(self.values)
+            self.values = {}
+
+    def error(self, returncode: int) -> RuntimeError:
+        return RuntimeError(f'ffmpeg exited with code {returncode}: ' + ' / '.join(self.log))
+
+    # sinkを渡すと、標準出力に書き出された変換結果をsink.writeに渡す
+    def run(self, output: ffmpeg.nodes.OutputStream, sink=None):
+        process = subprocess.Popen(self.command(output), stdout=subprocess.PIPE if sink else None,
+                                   stderr=subprocess.PIPE)
+        if sink is None:
+            self.read_log(process.stderr)
+        else:
+            # 標準出力と標準エラー出力のどちらかが詰まらないよう、ログは別スレッドで読む
+            reader = threading.Thread(target=self.read_log, args=(process.stderr,))
+            reader.start()
+            try:
+                while data := process.stdout.read1(FFmpegProgress.READ_SIZE):
+                    sink.write(data)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                reader.join()
+        if process.wait() != 0:
+            raise self.error(process.returncode)
+
+    def read_log(self, stderr):
+        for line in stderr:
+            self.feed(line.decode('utf-8', errors='replace'))
+
+    async def run_async(self, output: ffmpeg.nodes.OutputStream, sink=None):
+        process = await asyncio.create_subprocess_exec(*self.command(output),
+                                                       stdout=asyncio.subprocess.PIPE if sink else None,
+                                                       stderr=asyncio.subprocess.PIPE)
+        try:
+            if sink is None:
+                await self.read_log_async(process.stderr)
+            else:
+                await asyncio.gather(self.read_log_async(process.stderr), self.read_output_async(process.stdout, sink))
+        except BaseException:
+            # キャンセルされた場合もffmpegを残さない
+            process.kill()
+            await process.wait()
+            raise
+        if await process.wait() != 0:
+            raise self.error(process.returncode)
+
+    async def read_log_async(self, stderr: asyncio.StreamReader):
+        while line := await stderr.readline():
+            self.feed(line.decode('utf-8', errors='replace'))
+
+    @staticmethod
+    async def read_output_async(stdout: asyncio.StreamReader, sink):
+        while data := await stdout.read(FFmpegProgress.READ_SIZE):
+            sink.write(data)
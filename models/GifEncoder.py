@@ -0,0 +1,154 @@
+import contextlib
+import ffmpeg
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+# GIFはfpsと幅を上限に収め、palettegenとpaletteuseを1つのフィルターグラフで行う
+# 生成したパレットは(入力のハッシュ, 範囲)ごとに保存し、同じ区間を変換し直すときはpalettegenを省く
+class GifEncoder:
+    MAX_FPS = 15
+    MAX_WIDTH = 480
+    PALETTE_DIR = './palettes'
+    MAX_PALETTES = 1024
+    # bayerは誤差拡散よりフレーム間のちらつきが少なく、変化した矩形だけを書き直すdiff_modeと合わせて小さくなる
+    DITHER = dict(dither='bayer', bayer_scale=3, diff_mode='rectangle')
+
+    lock = threading.Lock()
+    # key -> パスのLRU。先頭ほど長く使われていない
+    palettes = OrderedDict()
+    # 書き出し中のパレット。同じパレットを同時に書き出さない
+    pending = set()
+    loaded = False
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    # 出力するfpsと幅の上限。指定がなければ元の動画に合わせ、どちらもMAX_FPSとMAX_WIDTHを超えない
+    def limits(params: dict, video: dict = None) -> tuple[float, int]:
+        fps = min(float(params.get('fps') or GifEncoder.MAX_FPS), GifEncoder.MAX_FPS)
+        if video and video.get('frame_rate'):
+            fps = min(fps, video['frame_rate'])
+        width = min(int(params.get('width') or GifEncoder.MAX_WIDTH), GifEncoder.MAX_WIDTH)
+        return fps, width
+
+    @staticmethod
+    # 元の幅がwidthより小さい場合は拡大しない
+    def scale(video, fps: float, width: int):
+        return video.filter('fps', round(fps, 3)).filter('scale', f'min(iw,{width})', -1, flags='lanczos')
+
+    @staticmethod
+    # 縮小した映像からパレットを作ってGIFにする。save=Trueの場合はパレットのストリームも返す
+    def filter(video, fps: float, width: int, save: bool = False) -> tuple:
+        video = GifEncoder.scale(video, fps, width).split()
+        palette = video[1].filter('palettegen')
+        if not save:
+            return ffmpeg.filter([video[0], palette], 'paletteuse', **GifEncoder.DITHER), None
+        palettes = palette.split()
+        return ffmpeg.filter([video[0], palettes[0]], 'paletteuse', **GifEncoder.DITHER), palettes[1]
+
+    @staticmethod
+    # 入力ファイルの[startSec, endSec)をGIFにするffmpegの出力を作る
+    # paletteはGifEncoder.paletteが返す(キャッシュにあるパレット, パレットの保存先)
+    def output(input_file: str, output_file: str, params: dict, video: dict = None, threads: int = 0,
+               palette: tuple = (None, None)) -> ffmpeg.nodes.OutputStream:
+        start, end = float(params['startSec']), float(params['endSec'])
+        # 入力側でシークし、startSecより前はデコードしない
+        stream = ffmpeg.input(input_file, ss=start, t=end - start)
+        fps, width = GifEncoder.limits(params, video)
+        cached, save_path = palette
+        if cached is not None:
+            gif = ffmpeg.filter([GifEncoder.scale(stream.video, fps, width), ffmpeg.input(cached).video],
+                                'paletteuse', **GifEncoder.DITHER)
+            return ffmpeg.output(gif, output_file, format='gif', threads=threads)
+        gif, palette_stream = GifEncoder.filter(stream.video, fps, width, save=save_path is not None)
+        output = ffmpeg.output(gif, output_file, format='gif', threads=threads)
+        if palette_stream is None:
+            return output
+        # 書き終わってからリネームされるので、途中で失敗しても壊れたパレットは残らない
+        return ffmpeg.merge_outputs(output, ffmpeg.output(palette_stream, save_path, format='image2', vframes=1,
+                                                          atomic_writing=1))
+
+    @staticmethod
+    def key(input_hash: str, start, end) -> str:
+        return hashlib.sha256(f'{input_hash}:{float(start)}:{float(end)}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def path(key: str) -> str:
+        return os.path.join(GifEncoder.PALETTE_DIR, f'{key}.png')
+
+    @staticmethod
+    @contextlib.contextmanager
+    # キャッシュにあるパレットを探し、(キャッシュにあるパレット, パレットの保存先)を返す
+    # 保存先を返した場合は、変換が成功した後にパレットをキャッシュに加える
+    def palette(input_hash: str, start, end):
+        if input_hash is None:
+            yield None, None
+            return
+        key = GifEncoder.key(input_hash, start, end)
+        with GifEncoder.lock:
+            GifEncoder.load()
+            if key in GifEncoder.palettes:
+                GifEncoder.palettes.move_to_end(key)
+                GifEncoder.hits += 1
+                cached = True
+            else:
+                GifEncoder.misses += 1
+                cached = False
+                # 他のジョブが書き出している場合はこのジョブでは保存しない
+                reserved = key not in GifEncoder.pending
+                GifEncoder.pending.add(key)
+        if cached:
+            yield GifEncoder.path(key), None
+            return
+        if not reserved:
+            yield None, None
+            return
+
+        try:
+            yield None, GifEncoder.path(key)
+            if os.path.exists(GifEncoder.path(key)):
+                with GifEncoder.lock:
+                    GifEncoder.palettes[key] = GifEncoder.path(key)
+                    GifEncoder.evict()
+                logging.info(f'Saved the palette for {input_hash} {start} - {end}')
+        finally:
+            with GifEncoder.lock:
+                GifEncoder.pending.discard(key)
+
+    @staticmethod
+    # 初回に保存済みのパレットを更新日時の古い順に読み込む。lockを取って呼ぶ
+    def load():
+        if GifEncoder.loaded:
+            return
+        GifEncoder.loaded = True
+        os.makedirs(GifEncoder.PALETTE_DIR, exist_ok=True)
+        files = []
+        for file_name in os.listdir(GifEncoder.PALETTE_DIR):
+            file_path = os.path.join(GifEncoder.PALETTE_DIR, file_name)
+            # 書き込み途中で止まった一時ファイル（'<key>.png.tmp'）は削除する
+            if file_name.endswith('.tmp'):
+                os.remove(file_path)
+                continue
+            if not file_name.endswith('.png'):
+                continue
+            files.append((os.stat(file_path).st_mtime, file_name[:-len('.png')], file_path))
+        for _, key, file_path in sorted(files):
+            GifEncoder.palettes[key] = file_path
+        GifEncoder.evict()
+
+    @staticmethod
+    # lockを取って呼ぶ
+    def evict():
+        while len(GifEncoder.palettes) > GifEncoder.MAX_PALETTES:
+            _, file_path = GifEncoder.palettes.popitem(last=False)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    @staticmethod
+    def stats() -> dict:
+        with GifEncoder.lock:
+            return dict(palettes=len(GifEncoder.palettes), hits=GifEncoder.hits, misses=GifEncoder.misses)
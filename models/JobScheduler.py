@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    pass
+
+
+# 変換処理だけを受け持つスケジューラー。ffmpegは子プロセスで動くため、ワーカースレッドは起動と待機だけを行う
+class JobScheduler:
+    THREADS_PER_JOB = 2
+    MAX_QUEUE = 32
+    DEFAULT_PRIORITY = 0
+
+    def __init__(self, logger: logging.Logger, workers: int = 0, threads_per_job: int = THREADS_PER_JOB,
+                 max_queue: int = MAX_QUEUE):
+        self.logger = logger
+        self.workers, self.threads_per_job = JobScheduler.capacity(workers, threads_per_job)
+        self.queue = queue.PriorityQueue(maxsize=max_queue)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        for i in range(self.workers):
+            threading.Thread(target=self.work, name=f'encoder-{i}', daemon=True).start()
+        self.logger.info(f'JobScheduler: {self.workers} workers x {self.threads_per_job} threads')
+
+    # ffmpegのスレッド数の合計がコア数を超えないように(ワーカー数, ジョブあたりのスレッド数)を決める
+    @staticmethod
+    def capacity(workers: int = 0, threads_per_job: int = THREADS_PER_JOB) -> tuple[int, int]:
+        cpu_count = os.cpu_count() or 1
+        threads_per_job = max(1, min(threads_per_job, cpu_count))
+        return (workers if workers else max(1, cpu_count // threads_per_job)), threads_per_job
+
+    def is_full(self) -> bool:
+        return self.queue.full()
+
+    # 優先度の小さいものから実行する。同じ優先度なら投入順
+    def submit(self, fn, *args, priority: int = DEFAULT_PRIORITY, timeout: float = None) -> Future:
+        future = Future()
+        try:
+            self.queue.put((priority, next(self.counter), time.monotonic(), fn, args, future), timeout=timeout)
+        except queue.Full:
+            raise QueueFullError(f'Encode queue is full ({self.queue.maxsize} jobs)')
+        return future
+
+    # 投入して結果を待つ。fnにはキーワード引数threadsでジョブあたりのスレッド数が渡される
+    def run(self, fn, *args, priority: int = DEFAULT_PRIORITY, timeout: float = None):
+        return self.submit(fn, *args, priority=priority, timeout=timeout).result()
+
+    def work(self):
+        while True:
+            _, _, queued_at, fn, args, future = self.queue.get()
+            wait = time.monotonic() - queued_at
+            with self.lock:
+                self.running += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            if not future.set_running_or_notify_cancel():
+                self.finish(False)
+                continue
+            try:
+                future.set_result(fn(*args, threads=self.threads_per_job))
+                self.finish(True)
+            except BaseException as e:
+                future.set_exception(e)
+                self.finish(False)
+            self.logger.info(f'Job finished after waiting {wait:.2f}s: {self.stats()}')
+
+    def finish(self, succeeded: bool):
+        with self.lock:
+            self.running -= 1
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            started = self.completed + self.failed + self.running
+            return dict(queue_depth=self.queue.qsize(), running=self.running, workers=self.workers,
+                        threads_per_job=self.threads_per_job, completed=self.completed, failed=self.failed,
+                        avg_wait=self.total_wait / started if started else 0.0, max_wait=self.max_wait)
+
+
+# AsyncServer用のスケジューラー。イベントループ上で実行枠を優先度順に割り当てる
+class AsyncJobScheduler:
+    def __init__(self, logger: logging.Logger, workers: int = 0, threads_per_job: int = JobScheduler.THREADS_PER_JOB,
+                 max_queue: int = JobScheduler.MAX_QUEUE):
+        self.logger = logger
+        self.workers, self.threads_per_job = JobScheduler.capacity(workers, threads_per_job)
+        self.max_queue = max_queue
+        # (priority, 到着順, 実行枠が渡されると完了するfuture)のヒープ
+        self.waiting = []
+        self.counter = itertools.count()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.logger.info(f'AsyncJobScheduler: {self.workers} workers x {self.threads_per_job} threads')
+
+    def is_full(self) -> bool:
+        return len(self.waiting) >= self.max_queue
+
+    # 実行枠を確保し、ジョブあたりのスレッド数を返す
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = JobScheduler.DEFAULT_PRIORITY):
+        queued_at = time.monotonic()
+        if self.running < self.workers and not self.waiting:
+            self.running += 1
+        else:
+            if self.is_full():
+                raise QueueFullError(f'Encode queue is full ({self.max_queue} jobs)')
+            future = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self.counter), future)
+            heapq.heappush(self.waiting, entry)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if entry in self.waiting:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                # 実行枠を渡された直後にキャンセルされた場合は次のジョブに回す
+                elif future.done() and not future.cancelled():
+                    self.release()
+                raise
+        wait = time.monotonic() - queued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            yield self.threads_per_job
+            self.completed += 1
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.release()
+            self.logger.info(f'Job finished after waiting {wait:.2f}s: {self.stats()}')
+
+    # 待っているジョブがあれば実行枠をそのまま渡す
+    # 切断などでキャンセルされたfutureはヒープから取り除かれる前に残っていることがあるため、飛ばして次に渡す
+    def release(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed + self.running
+        return dict(queue_depth=len(self.waiting), running=self.running, workers=self.workers,
+                    threads_per_job=self.threads_per_job, completed=self.completed, failed=self.failed,
+                    avg_wait=self.total_wait / started if started else 0.0, max_wait=self.max_wait)
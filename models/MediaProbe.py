@@ -0,0 +1,106 @@
+import ffmpeg
+import logging
+import os
+import threading
+from collections import OrderedDict
+from fractions import Fraction
+
+
+# ffprobeの結果を入力ごとに1度だけ取得して使い回す。キーはinode、サイズ、更新日時なので、書き換えられた入力は取り直す
+class MediaProbe:
+    MAX_ENTRIES = 1024
+    # streamingで先頭のmoovを読むために受信する上限。超える場合はファイルに受信してから変換する
+    MAX_STREAM_HEAD = 16 * 1024 ** 2
+
+    lock = threading.Lock()
+    # key -> 整形したprobeの結果。先頭ほど長く使われていない
+    entries = OrderedDict()
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def key(file_path: str) -> tuple:
+        stat = os.stat(file_path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    # 動画と音声の最初のストリームの情報を返す。ストリームがない場合はNone
+    def probe(file_path: str) -> dict:
+        key = MediaProbe.key(file_path)
+        with MediaProbe.lock:
+            info = MediaProbe.entries.get(key)
+            if info is not None:
+                MediaProbe.entries.move_to_end(key)
+                MediaProbe.hits += 1
+                return info
+            MediaProbe.misses += 1
+
+        info = MediaProbe.parse(ffmpeg.probe(file_path, cmd="ffprobe"))
+        logging.info(f'Probed {file_path}: {info}')
+        with MediaProbe.lock:
+            MediaProbe.entries[key] = info
+            while len(MediaProbe.entries) > MediaProbe.MAX_ENTRIES:
+                MediaProbe.entries.popitem(last=False)
+        return info
+
+    @staticmethod
+    def parse(probe: dict) -> dict:
+        video = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+        audio = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), None)
+        info = dict(duration=MediaProbe.number(probe['format'].get('duration'), float),
+                    bit_rate=MediaProbe.number(probe['format'].get('bit_rate')), video=None, audio=None)
+        if video:
+            info['video'] = dict(codec=video['codec_name'], width=video['width'], height=video['height'],
+                                 bit_rate=MediaProbe.number(video.get('bit_rate')), pix_fmt=video.get('pix_fmt'),
+                                 display_aspect_ratio=video.get('display_aspect_ratio'),
+                                 frame_rate=MediaProbe.frame_rate(video.get('avg_frame_rate')))
+        if audio:
+            info['audio'] = dict(codec=audio['codec_name'], bit_rate=MediaProbe.number(audio.get('bit_rate')))
+        return info
+
+    @staticmethod
+    # ffprobeは値がない場合に'N/A'を返すことがある
+    def number(value, cast=int):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    # 'num/den'を秒あたりのフレーム数にする。'0/0'など分からない場合はNone
+    def frame_rate(value: str):
+        try:
+            rate = float(Fraction(value))
+        except (TypeError, ValueError, ZeroDivisionError):
+            return None
+        return rate if rate > 0 else None
+
+    @staticmethod
+    # MP4の先頭からボックスを順に見て、標準入力から変換できる（moovがmdatより前にある）かを調べる
+    # 変換できる場合は(True, moovの終わりの位置)、できない場合は(False, 0)、判断するのにdataが足りない場合は(None, 必要なバイト数)
+    def stream_head(data: bytes) -> tuple:
+        position = 0
+        while True:
+            if len(data) < position + 8:
+                return None, position + 8
+            size = int.from_bytes(data[position:position + 4], 'big')
+            box_type = bytes(data[position + 4:position + 8])
+            header_size = 8
+            if size == 1:
+                if len(data) < position + 16:
+                    return None, position + 16
+                size = int.from_bytes(data[position + 8:position + 16], 'big')
+                header_size = 16
+            # mdatやmoofが先にある場合は、moovを読むのに入力の最後まで待つ必要がある
+            if box_type in (b'mdat', b'moof') or size < header_size:
+                return False, 0
+            if len(data) < position + size:
+                return None, position + size
+            if box_type == b'moov':
+                return True, position + size
+            position += size
+
+    @staticmethod
+    def stats() -> dict:
+        with MediaProbe.lock:
+            return dict(entries=len(MediaProbe.entries), hits=MediaProbe.hits, misses=MediaProbe.misses)
@@ -0,0 +1,227 @@
+import bisect
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# カウンターとヒストグラムを集計し、Prometheusのテキスト形式で返す
+class Metrics:
+    PREFIX = 'video_'
+    DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    SIZE_BUCKETS = (2 ** 10, 2 ** 16, 2 ** 20, 2 ** 24, 2 ** 26, 2 ** 28, 2 ** 30, 2 ** 32)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> 値
+        self.counters = {}
+        # (name, labels) -> [buckets, バケットごとの件数, 合計, 件数]
+        self.histograms = {}
+        # 描画のたびに呼ばれ、(name, labels, value)のリストを返す。キューの長さやキャッシュの状態に使う
+        self.collectors = []
+        # 実行中のジョブ。id -> JobRecord
+        self.active = {}
+
+    @staticmethod
+    def labels(**labels) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, Metrics.labels(**labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = DURATION_BUCKETS, **labels):
+        key = (name, Metrics.labels(**labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram[1][index] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    # stats()の数値の項目をそのままゲージにするcollector
+    @staticmethod
+    def stats_collector(prefix: str, stats):
+        return lambda: [(f'{prefix}_{name}', {}, value) for name, value in stats().items()
+                        if isinstance(value, (int, float))]
+
+    # 実行中のジョブごとのffmpegの進捗
+    def collect_active(self) -> list:
+        with self.lock:
+            records = list(self.active.values())
+        samples = [('active_jobs', {}, len(records))]
+        for record in records:
+            labels = dict(job=record.id, operation=record.operation)
+            for name in ('fps', 'frame', 'speed'):
+                if name in record.progress:
+                    samples.append((f'job_{name}', labels, record.progress[name]))
+        return samples
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        for name, group in itertools.groupby(counters, key=lambda item: item[0][0]):
+            lines.append(f'# TYPE {Metrics.PREFIX}{name} counter')
+            lines.extend(f'{Metrics.PREFIX}{name}{Metrics.format_labels(labels)} {value}'
+                         for (_, labels), value in group)
+        for name, group in itertools.groupby(histograms, key=lambda item: item[0][0]):
+            lines.append(f'# TYPE {Metrics.PREFIX}{name} histogram')
+            for (_, labels), (buckets, counts, total, count) in group:
+                cumulative = 0
+                for bucket, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{Metrics.PREFIX}{name}_bucket{Metrics.format_labels(labels + (("le", bucket),))} '
+                                 f'{cumulative}')
+                lines.append(f'{Metrics.PREFIX}{name}_bucket{Metrics.format_labels(labels + (("le", "+Inf"),))} '
+                             f'{count}')
+                lines.append(f'{Metrics.PREFIX}{name}_sum{Metrics.format_labels(labels)} {total}')
+                lines.append(f'{Metrics.PREFIX}{name}_count{Metrics.format_labels(labels)} {count}')
+        samples = self.collect_active()
+        for collector in self.collectors:
+            samples.extend(collector())
+        for name, group in itertools.groupby(sorted(samples, key=lambda sample: sample[0]), key=lambda s: s[0]):
+            lines.append(f'# TYPE {Metrics.PREFIX}{name} gauge')
+            lines.extend(f'{Metrics.PREFIX}{name}{Metrics.format_labels(Metrics.labels(**labels))} {value}'
+                         for _, labels, value in group)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+    # 別スレッドでHTTPサーバーを起動し、GET /metricsに応答する
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+# 1つの接続で行った処理の記録。フェーズごとの時間と送受信したバイト数を集計し、終了時に1行のJSONでログに出す
+class JobRecord:
+    # フェーズはreceive、queue、probe、encode、send
+    ids = itertools.count(1)
+    # 処理中の接続の記録。スレッドやasyncioのタスクごとに別々に持つ
+    current = contextvars.ContextVar('job_record', default=None)
+
+    def __init__(self, metrics: Metrics, logger: logging.Logger, peer: str = ''):
+        self.metrics = metrics
+        self.logger = logger
+        self.id = next(JobRecord.ids)
+        self.peer = peer
+        self.operation = None
+        self.status = None
+        self.phases = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.progress = {}
+        self.started = time.monotonic()
+        self.token = None
+
+    # 接続の処理を始める前に呼び、この接続の記録をJobRecord.currentから参照できるようにする
+    def start(self):
+        self.token = JobRecord.current.set(self)
+        with self.metrics.lock:
+            self.metrics.active[self.id] = self
+        return self
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    # スケジューラーに渡すジョブを包み、実行が始まるまでをqueue、実行中をencodeとして記録する
+    # ワーカースレッドでも呼び出し元のcontextvars（JobRecord.currentなど）を参照できるようにする
+    def job(self, fn, **kwargs):
+        queued_at = time.monotonic()
+        context = contextvars.copy_context()
+
+        def run(*args, threads: int = 0):
+            self.add('queue', time.monotonic() - queued_at)
+            with self.phase('encode'):
+                return context.run(fn, *args, threads=threads, **kwargs)
+
+        return run
+
+    def received(self, size: int):
+        self.bytes_in += size
+
+    def sent(self, response: dict, size: int):
+        self.status = response.get('status')
+        self.bytes_out += size
+
+    # FFmpegProgressのcallback
+    def update_progress(self, values: dict):
+        progress = {}
+        for name, cast in (('fps', float), ('frame', int), ('speed', lambda value: float(value.rstrip('x')))):
+            try:
+                progress[name] = cast(values[name])
+            except (KeyError, ValueError):
+                pass
+        self.progress = progress
+
+    def finish(self):
+        JobRecord.current.reset(self.token)
+        with self.metrics.lock:
+            del self.metrics.active[self.id]
+        elapsed = time.monotonic() - self.started
+        operation = self.operation or 'unknown'
+        status = self.status or 'none'
+        self.metrics.inc('jobs_total', operation=operation, status=status)
+        self.metrics.inc('bytes_received_total', self.bytes_in)
+        self.metrics.inc('bytes_sent_total', self.bytes_out)
+        self.metrics.observe('request_seconds', elapsed, operation=operation)
+        for name, seconds in self.phases.items():
+            self.metrics.observe('phase_seconds', seconds, phase=name)
+        if self.bytes_in:
+            self.metrics.observe('payload_bytes', self.bytes_in, Metrics.SIZE_BUCKETS, direction='in')
+        if self.bytes_out:
+            self.metrics.observe('payload_bytes', self.bytes_out, Metrics.SIZE_BUCKETS, direction='out')
+
+        record = dict(event='job', id=self.id, peer=self.peer, operation=self.operation, status=self.status,
+                      seconds=round(elapsed, 3), bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                      phases={name: round(seconds, 3) for name, seconds in self.phases.items()})
+        # 受信と送信の速度（バイト/秒）
+        for name, size in (('receive', self.bytes_in), ('send', self.bytes_out)):
+            if size and self.phases.get(name):
+                record[f'{name}_bytes_per_sec'] = round(size / self.phases[name])
+        if self.progress:
+            record['progress'] = self.progress
+        self.logger.info(json.dumps(record))
@@ -0,0 +1,86 @@
+import threading
+
+
+# 変換中と送信待ちの変換結果がメモリに持つバイト数の合計を制限する
+class MemoryBudget:
+    LIMIT = 256 * 1024 ** 2
+    # この大きさまでの変換結果はメモリに持ち、ファイルに書き出さない
+    MAX_RESULT = 8 * 1024 ** 2
+
+    def __init__(self, limit: int = LIMIT, max_result: int = MAX_RESULT):
+        self.limit = limit
+        self.max_result = max_result
+        self.lock = threading.Lock()
+        self.held = 0
+        self.peak = 0
+        self.in_memory = 0
+        self.spilled = 0
+
+    def try_acquire(self, size: int) -> bool:
+        with self.lock:
+            if self.held + size > self.limit:
+                return False
+            self.held += size
+            self.peak = max(self.peak, self.held)
+            return True
+
+    def release(self, size: int):
+        with self.lock:
+            self.held -= size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(limit=self.limit, held=self.held, peak=self.peak, in_memory=self.in_memory,
+                        spilled=self.spilled)
+
+
+# ffmpegがパイプに書き出す変換結果を受け取る。max_resultと予算の範囲ではメモリに持ち、超えたらspill_pathに書き出す
+class ResultBuffer:
+    def __init__(self, budget: MemoryBudget, spill_path: str):
+        self.budget = budget
+        self.spill_path = spill_path
+        self.data = bytearray()
+        self.file = None
+        # 予算から確保しているバイト数
+        self.held = 0
+
+    @property
+    def in_memory(self) -> bool:
+        return self.file is None
+
+    def write(self, data: bytes):
+        if self.file is None:
+            # 解放した後（タイムアウトした場合など）に届いた出力は捨てる
+            if self.data is None:
+                return
+            if (len(self.data) + len(data) <= self.budget.max_result
+                    and self.budget.try_acquire(len(data))):
+                self.data += data
+                self.held += len(data)
+                return
+            self.spill()
+        self.file.write(data)
+
+    # 受け取った分をファイルに書き出し、以降はファイルに書き込む
+    def spill(self):
+        self.file = open(self.spill_path, 'wb')
+        self.file.write(self.data)
+        self.data = bytearray()
+        self.budget.release(self.held)
+        self.held = 0
+        with self.budget.lock:
+            self.budget.spilled += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        else:
+            with self.budget.lock:
+                self.budget.in_memory += 1
+
+    # 送信が終わったか失敗した後に呼び、メモリに持っていた分を予算に返す
+    def release(self):
+        self.budget.release(self.held)
+        self.held = 0
+        if self.file is None:
+            self.data = None
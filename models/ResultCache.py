@@ -0,0 +1,161 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from models.TCPConnection import TCPConnection
+from models.VideoProcessor import VideoProcessor
+
+
+class ResultCache:
+    CACHE_DIR = './cache'
+    MAX_BYTES = 10 * 1024 ** 3
+    # put_dataが書き込み途中に使う一時ファイルの名前
+    TEMP_PREFIX = '.'
+    TEMP_SUFFIX = '.tmp'
+
+    def __init__(self, logger: logging.Logger, cache_dir: str = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (media_type, size)。先頭ほど長く使われていない
+        self.entries = OrderedDict()
+        # 送信中のエントリは削除しない
+        self.pinned = {}
+        # key -> 変換結果のCRC32。再開したダウンロードの検証に使う
+        self.checksums = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    # 入力のハッシュと、サーバーの設定を反映して正規化したリクエスト（VideoProcessor.settings）からキーを作る
+    @staticmethod
+    def make_key(input_hash: str, request: dict) -> str:
+        canonical = json.dumps(VideoProcessor.settings(request), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(f'{input_hash}:{canonical}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while data := f.read(chunk_size):
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    # 起動時に既存のキャッシュファイルを更新日時の古い順に読み込む
+    def load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for file_name in os.listdir(self.cache_dir):
+            # 書き込み途中の一時ファイルは読み込まない。前回の実行で残ったものは削除する
+            if file_name.startswith(ResultCache.TEMP_PREFIX):
+                if file_name.endswith(ResultCache.TEMP_SUFFIX):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+                continue
+            key, _, media_type = file_name.partition('.')
+            stat = os.stat(os.path.join(self.cache_dir, file_name))
+            files.append((stat.st_mtime, key, media_type, stat.st_size))
+        for _, key, media_type, size in sorted(files):
+            self.entries[key] = (media_type, size)
+            self.total_bytes += size
+        self.evict()
+        self.logger.info(f'Loaded {len(self.entries)} cached results ({self.total_bytes} bytes)')
+
+    def path(self, key: str, media_type: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.{media_type}')
+
+    # ヒットした場合は(パス, 拡張子)を返し、使い終わるまで削除されないようにする
+    @contextlib.contextmanager
+    def lookup(self, key: str, count: bool = True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if count and entry is None:
+                self.misses += 1
+            elif count:
+                self.hits += 1
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.pinned[key] = self.pinned.get(key, 0) + 1
+        if entry is None:
+            yield None
+            return
+        media_type, _ = entry
+        file_path = self.path(key, media_type)
+        try:
+            os.utime(file_path)
+            yield file_path, media_type
+        finally:
+            with self.lock:
+                self.pinned[key] -= 1
+                if self.pinned[key] == 0:
+                    del self.pinned[key]
+                self.evict()
+
+    # 変換結果をキャッシュに移動する。予算より大きい場合は移動せずにFalseを返す
+    def put(self, key: str, file_path: str, media_type: str) -> bool:
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return False
+        checksum = TCPConnection.checksum(file_path)
+        shutil.move(file_path, self.path(key, media_type))
+        self.add(key, media_type, size, checksum)
+        return True
+
+    # メモリにある変換結果をキャッシュに書き込む。書き込み途中のファイルは見えないよう、一時ファイルから移す
+    def put_data(self, key: str, data, media_type: str, checksum: int) -> bool:
+        if len(data) > self.max_bytes:
+            return False
+        f = tempfile.NamedTemporaryFile(dir=self.cache_dir, prefix=ResultCache.TEMP_PREFIX,
+                                        suffix=ResultCache.TEMP_SUFFIX, delete=False)
+        try:
+            with f:
+                f.write(data)
+            os.replace(f.name, self.path(key, media_type))
+        except BaseException:
+            os.remove(f.name)
+            raise
+        self.add(key, media_type, len(data), checksum)
+        return True
+
+    def add(self, key: str, media_type: str, size: int, checksum: int):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key][1]
+            self.entries[key] = (media_type, size)
+            self.checksums[key] = checksum
+            self.total_bytes += size
+            self.evict()
+
+    # lookupで使用中のエントリのCRC32を返す
+    def checksum(self, key: str, file_path: str) -> int:
+        with self.lock:
+            checksum = self.checksums.get(key)
+        if checksum is None:
+            checksum = TCPConnection.checksum(file_path)
+            with self.lock:
+                self.checksums[key] = checksum
+        return checksum
+
+    # 予算を超えている間、長く使われていないエントリから削除する
+    def evict(self):
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key in self.pinned:
+                continue
+            media_type, size = self.entries.pop(key)
+            self.checksums.pop(key, None)
+            self.total_bytes -= size
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(key, media_type))
+            self.logger.info(f'Evicted cached result: {key}')
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(entries=len(self.entries), bytes=self.total_bytes, hits=self.hits, misses=self.misses)
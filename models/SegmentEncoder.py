@@ -0,0 +1,117 @@
+import ffmpeg
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from models.FFmpegProgress import FFmpegProgress
+from models.MediaProbe import MediaProbe
+from models.VideoProcessor import VideoProcessor
+
+
+# 長い動画をキーフレームで区切り、区間ごとに並列でエンコードしてからconcat demuxerで結合する
+class SegmentEncoder:
+    OPERATIONS = (VideoProcessor.COMPRESS, VideoProcessor.RESOLUTION, VideoProcessor.ASPECT_RATIO)
+    # このサイズ以上の入力を分割してエンコードする
+    THRESHOLD = 512 * 1024 ** 2
+    MIN_SEGMENT_SEC = 10
+
+    @staticmethod
+    # 映像をそのままコピーできる場合、範囲を切り出す（入力側でシークする）場合、2パスエンコードの場合は分割しない
+    def eligible(request: dict, input_file_path: str) -> bool:
+        if (request['operation'] not in SegmentEncoder.OPERATIONS
+                or os.path.getsize(input_file_path) < SegmentEncoder.THRESHOLD
+                or VideoProcessor.two_pass(request)):
+            return False
+        plan = VideoProcessor.plan(request, input_file_path)
+        return not plan['copy_video'] and plan['range'] is None
+
+    @staticmethod
+    # キーフレームの時刻と動画の長さを返す。パケットのフラグだけを見るのでデコードはしない
+    def probe_keyframes(input_file: str) -> tuple[list[float], float]:
+        probe = ffmpeg.probe(input_file, cmd="ffprobe", select_streams='v:0', show_entries='packet=pts_time,flags')
+        keyframes = sorted(float(packet['pts_time']) for packet in probe['packets']
+                           if 'K' in packet.get('flags', '') and packet.get('pts_time', 'N/A') != 'N/A')
+        return keyframes, float(probe['format']['duration'])
+
+    @staticmethod
+    # 均等に分けた時刻以降で最初のキーフレームを区間の境界にする
+    def split_points(keyframes: list[float], duration: float, segments: int) -> list[float]:
+        points = [0.0]
+        for i in range(1, segments):
+            target = duration * i / segments
+            point = next((keyframe for keyframe in keyframes if keyframe >= target), None)
+            if point is not None and point > points[-1]:
+                points.append(point)
+        return points
+
+    @staticmethod
+    # 変換後の拡張子と出力先のパスを返す。threadsはジョブの実行枠に割り当てられたスレッド数で、
+    # 同時に動かすffmpegのスレッド数の合計はその範囲に収める。他のジョブの実行枠のコアは使わない
+    def encode(request: dict, input_file_path: str, output_file_path: str, threads: int = 1,
+               segments: int = 0, progress=None) -> tuple[str, str]:
+        threads = max(1, threads)
+        keyframes, duration = SegmentEncoder.probe_keyframes(input_file_path)
+        if not segments:
+            segments = max(1, min(threads, int(duration // SegmentEncoder.MIN_SEGMENT_SEC)))
+        points = SegmentEncoder.split_points(keyframes, duration, segments)
+        workers = min(threads, len(points))
+        segment_threads = max(1, threads // workers)
+        logging.info(f'Encoding {input_file_path} in {len(points)} segments with {workers} workers x '
+                     f'{segment_threads} threads: {points}')
+
+        work_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(output_file_path) or '.')
+        try:
+            segment_paths = [os.path.join(os.path.abspath(work_dir), f'segment_{i:04d}.mp4')
+                             for i in range(len(points))]
+            ranges = zip(points, points[1:] + [None])
+            callbacks = SegmentEncoder.segment_progress(progress, len(points))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(SegmentEncoder.encode_segment, request, input_file_path, segment_path,
+                                           start, end, segment_threads, callback)
+                           for segment_path, (start, end), callback in zip(segment_paths, ranges, callbacks)]
+                for future in futures:
+                    future.result()
+
+            # 映像は区間ごとの結果をつなぎ、音声は元の入力からそのままコピーする
+            list_path = os.path.join(work_dir, 'segments.txt')
+            with open(list_path, 'w') as f:
+                f.writelines(f"file '{segment_path}'\n" for segment_path in segment_paths)
+            video = ffmpeg.input(list_path, format='concat', safe=0).video
+            audio = ffmpeg.input(input_file_path)['a?']
+            FFmpegProgress().run(ffmpeg.output(video, audio, output_file_path, c='copy'))
+            return 'mp4', output_file_path
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    @staticmethod
+    def encode_segment(request: dict, input_file_path: str, segment_path: str, start: float, end: float,
+                       threads: int, progress=None):
+        # 入力側でシークし、区間の映像だけをエンコードする
+        input_options = dict(ss=start) if end is None else dict(ss=start, t=end - start)
+        output, _, _ = VideoProcessor.build(request, input_file_path, segment_path, threads, input_options,
+                                            audio=False)
+        FFmpegProgress(progress).run(output)
+
+    @staticmethod
+    # 区間ごとのffmpegの進捗を、フレーム数、fps、速度を合計した1つのジョブの進捗にしてprogressに渡すcallbackを返す
+    def segment_progress(progress, count: int) -> list:
+        if progress is None:
+            return [None] * count
+        lock = threading.Lock()
+        latest = [{} for _ in range(count)]
+
+        def total(name: str, cast) -> float:
+            values = [MediaProbe.number(str(values.get(name, '')).rstrip('x'), cast) for values in latest]
+            return sum(value for value in values if value is not None)
+
+        def callback(i: int):
+            def update(values: dict):
+                with lock:
+                    latest[i] = values
+                    progress(dict(frame=str(total('frame', int)), fps=str(total('fps', float)),
+                                  speed=f'{total("speed", float)}x'))
+            return update
+
+        return [callback(i) for i in range(count)]
@@ -1,18 +1,53 @@
+import contextlib
+import hashlib
 import logging
 import os.path
 import socket
 import threading
+import zlib
 from concurrent.futures.thread import ThreadPoolExecutor
-from models.VideoProcessor import VideoProcessor
-from models.TCPConnection import TCPConnection
+from models.EncoderPreset import EncoderPreset
+from models.GifEncoder import GifEncoder
+from models.JobScheduler import JobScheduler, QueueFullError
+from models.MediaProbe import MediaProbe
+from models.Metrics import JobRecord, Metrics
+from models.ResultBuffer import MemoryBudget, ResultBuffer
+from models.ResultCache import ResultCache
+from models.SegmentEncoder import SegmentEncoder
+from models.Spool import Spool, SpoolFullError
+from models.UploadSession import UploadSession
+from models.VideoProcessor import InvalidRequestError, VideoProcessor
+from models.WorkerPool import WorkerPool
+from models.TCPConnection import ChunkCompressor, TCPConnection
 
 
 class Server(TCPConnection):
     LISTEN_NUM = 5
-    MAX_WORKERS = 10
+    # 接続ごとの送受信を受け持つスレッド数。変換はJobSchedulerが別に制限する
+    MAX_WORKERS = 64
+    # keepAliveの接続で次のリクエストを待つ秒数
+    KEEP_ALIVE_TIMEOUT = 30
 
-    def __init__(self, host: str, port: int, logger: logging.Logger):
-        super().__init__(host, port, logger)
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = TCPConnection.CHUNK_SIZE,
+                 cache: ResultCache = None, scheduler: JobScheduler = None, metrics: Metrics = None,
+                 budget: MemoryBudget = None, spool: Spool = None, pool: WorkerPool = None):
+        super().__init__(host, port, logger, chunk_size)
+        self.cache = cache if cache else ResultCache(logger)
+        self.scheduler = scheduler if scheduler else JobScheduler(logger)
+        self.metrics = metrics if metrics else Metrics()
+        self.budget = budget if budget else MemoryBudget()
+        self.spool = spool if spool else Spool(logger)
+        # 指定された場合、変換はworkerノードで行う
+        self.pool = pool
+        self.metrics.add_collector(Metrics.stats_collector('scheduler', self.scheduler.stats))
+        self.metrics.add_collector(Metrics.stats_collector('cache', self.cache.stats))
+        self.metrics.add_collector(Metrics.stats_collector('probe', MediaProbe.stats))
+        self.metrics.add_collector(Metrics.stats_collector('palette', GifEncoder.stats))
+        self.metrics.add_collector(EncoderPreset.collect)
+        self.metrics.add_collector(Metrics.stats_collector('memory', self.budget.stats))
+        self.metrics.add_collector(Metrics.stats_collector('spool', self.spool.stats))
+        if self.pool:
+            self.metrics.add_collector(self.pool.collect)
         self.executor = ThreadPoolExecutor(max_workers=Server.MAX_WORKERS)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
@@ -20,7 +55,15 @@ class Server(TCPConnection):
         self.sock.listen(Server.LISTEN_NUM)
 
     def run(self):
-        self.accept()
+        self.spool.start()
+        if self.pool:
+            self.pool.start()
+        try:
+            self.accept()
+        finally:
+            self.spool.stop()
+            if self.pool:
+                self.pool.stop()
 
     # クライアントの接続を待ち受ける
     def accept(self):
@@ -28,17 +71,103 @@ class Server(TCPConnection):
             while True:
                 client, address = self.sock.accept()
                 self.logger.info(f'Connection from {address} has been established!')
-                self.executor.submit(self.listen_to_client, client)
+                self.executor.submit(self.listen_to_client, client, address)
         except KeyboardInterrupt as e:
             self.logger.error(e, exc_info=True)
             self.sock.close()
             self.executor.shutdown(wait=True)
 
     # クライアントからのメッセージを待ち受ける
-    def listen_to_client(self, client: socket.socket):
+    # keepAliveのリクエストが成功した場合は接続を切らずに、同じ接続で次のリクエストを待つ
+    def listen_to_client(self, client: socket.socket, address: tuple = ()):
         try:
-            request, saved_file_name = self.receive_request(client)
-            self.process_request(client, request, saved_file_name)
+            header = None
+            while self.handle_request(client, address, header):
+                header = self.wait_next_request(client)
+                if header is None:
+                    break
+        finally:
+            client.close()
+            self.logger.info('Connection has been closed!')
+
+    # 次のリクエストのヘッダーを待つ。KEEP_ALIVE_TIMEOUT秒以内に届かないか、切断された場合はNone
+    def wait_next_request(self, client: socket.socket):
+        client.settimeout(Server.KEEP_ALIVE_TIMEOUT)
+        try:
+            return self.receive_exactly(client, Server.HEADER_SIZE)
+        except (socket.timeout, ConnectionError):
+            return None
+        finally:
+            client.settimeout(None)
+
+    # 1つのリクエストを処理し、同じ接続で次のリクエストを受け付けるかを返す
+    def handle_request(self, client: socket.socket, address: tuple, header: bytes = None) -> bool:
+        record = JobRecord(self.metrics, self.logger, ':'.join(map(str, address))).start()
+        try:
+            request, media_type, payload_size = self.receive_request(client, header)
+            # ハッシュだけが送られてきた場合、キャッシュにあればアップロードを省略する
+            # offsetがあれば、途中まで受信済みの変換結果の続きから送る
+            if Server.INPUT_HASH in request and payload_size == 0:
+                if request['operation'] == VideoProcessor.BATCH:
+                    sent = self.send_cached_batch_response(client, VideoProcessor.batch_requests(request),
+                                                           request[Server.INPUT_HASH])
+                else:
+                    sent = self.send_cached_response(client, ResultCache.make_key(request[Server.INPUT_HASH], request),
+                                                     int(request.get('offset', 0)))
+                if sent:
+                    return request.get(Server.KEEP_ALIVE, False)
+                # 変換待ちが詰まっている場合はアップロードさせずに断る
+                if self.scheduler.is_full():
+                    raise QueueFullError('Encode queue is full')
+                # ディスクに入りきらない場合もアップロードさせずに断る
+                self.spool.check(int(request.get(Server.UPLOAD_SIZE, 0)))
+                self.send_response(client, '', UploadSession.not_found_response(request, self.spool.session_dir), '')
+                request, media_type, payload_size = self.receive_request(client)
+            # streamingは失敗すると送受信の途中で切れるため、接続を使い回さない
+            # 標準入力から変換できるのはmoovが先頭にある入力だけで、それ以外は通常どおりファイルに受信してから変換する
+            head = b''
+            if request.get('streaming'):
+                head, streamable = self.receive_stream_head(client, payload_size)
+                if streamable:
+                    with self.spool.job(len(head)) as job_dir:
+                        with record.phase('probe'):
+                            plan = VideoProcessor.plan_stream(request, head, job_dir)
+                        self.scheduler.run(record.job(self.process_streaming_request), client, request,
+                                           payload_size, head, plan, priority=self.priority(request),
+                                           timeout=Server.TIMEOUT)
+                    return False
+                self.logger.info('The input has no moov at the beginning, receiving it before processing')
+            # 入力と変換途中のファイルはジョブ専用のディレクトリに置き、終わったらディレクトリごと削除する
+            upload_size = payload_size
+            if Server.SESSION_ID in request:
+                upload_size += int(request.get('offset', 0))
+            with self.spool.job(upload_size) as job_dir:
+                with record.phase('receive'):
+                    if Server.SESSION_ID in request:
+                        input_file_path, input_hash = self.receive_session_upload(client, request, media_type,
+                                                                                  payload_size, job_dir, head)
+                    else:
+                        hasher = hashlib.sha256()
+                        input_file_path = self.receive_upload(client, request, media_type, payload_size, hasher,
+                                                              job_dir, head)
+                        input_hash = hasher.hexdigest()
+                record.received(payload_size)
+                # GIFのパレットのキャッシュは入力のハッシュで引く
+                request[Server.INPUT_HASH] = input_hash
+                if request['operation'] == VideoProcessor.BATCH:
+                    self.process_batch_request(client, request, input_file_path, input_hash)
+                else:
+                    self.process_request(client, request, input_file_path, ResultCache.make_key(input_hash, request))
+            return request.get(Server.KEEP_ALIVE, False)
+        except QueueFullError as e:
+            self.logger.error(f'{e}: {self.scheduler.stats()}')
+            self.send_response(client, '', dict(status=503, message=str(e)), '')
+        except SpoolFullError as e:
+            self.logger.error(f'{e}: {self.spool.stats()}')
+            self.send_response(client, '', dict(status=507, message=str(e)), '')
+        except InvalidRequestError as e:
+            self.logger.error(f'Invalid request: {e}')
+            self.send_response(client, '', dict(status=400, message=str(e)), '')
         except Exception as e:
             self.logger.error(e, exc_info=True)
             self.send_response(client,
@@ -46,37 +175,276 @@ class Server(TCPConnection):
                                dict(status=500, message=str(e)),
                                '')
         finally:
-            client.close()
-            self.logger.info('Connection has been closed!')
+            record.finish()
+        return False
 
-    def process_request(self, client: socket.socket, request: dict, saved_file_name: str):
-        self.logger.info('Processing...')
-        # ファイルのパスを取得する
-        input_file_path = os.path.join(Server.DEST_DIR, saved_file_name)
-        output_file_path = os.path.join(Server.DEST_DIR, f'processed_{saved_file_name}')
+    def process_request(self, client: socket.socket, request: dict, input_file_path: str, cache_key: str):
+        # 変換結果は入力と同じジョブのディレクトリに書き出す
+        output_file_path = os.path.join(os.path.dirname(input_file_path),
+                                        f'processed_{os.path.basename(input_file_path)}')
+
+        if self.send_cached_response(client, cache_key):
+            return
+
+        # 変換できないパラメータは変換待ちに並ぶ前に断る
+        record = JobRecord.current.get()
+        with record.phase('probe'):
+            VideoProcessor.plan(request, input_file_path)
 
         # ファイルを処理する
-        media_type = VideoProcessor.process(request, input_file_path, output_file_path)
+        self.logger.info('Processing...')
+        if self.pool:
+            # workerノードで変換し、変換結果のファイルを受け取る
+            media_type, output_file_path = self.scheduler.run(record.job(self.pool.process), request,
+                                                              input_file_path, output_file_path,
+                                                              priority=self.priority(request),
+                                                              timeout=Server.TIMEOUT)
+        elif request['operation'] in VideoProcessor.PIPE_OPERATIONS:
+            # mp3とGIFはファイルに書き出さずにメモリに受け取る。大きすぎる場合だけファイルに書き出す
+            media_type = VideoProcessor.MEDIA_TYPES[request['operation']]
+            output_file_path = f'{os.path.splitext(output_file_path)[0]}.{media_type}'
+            buffer = ResultBuffer(self.budget, output_file_path)
+            try:
+                self.scheduler.run(record.job(VideoProcessor.process_to_buffer, progress=record.update_progress),
+                                   request, input_file_path, buffer, priority=self.priority(request),
+                                   timeout=Server.TIMEOUT)
+                if buffer.in_memory:
+                    self.send_memory_response(client, cache_key, media_type, buffer.data)
+                    return
+            finally:
+                buffer.release()
+        else:
+            # 大きな入力は区間ごとに並列でエンコードする
+            job = record.job(VideoProcessor.process, progress=record.update_progress)
+            if SegmentEncoder.eligible(request, input_file_path):
+                job = record.job(SegmentEncoder.encode, progress=record.update_progress)
+            media_type, output_file_path = self.scheduler.run(job, request, input_file_path, output_file_path,
+                                                              priority=self.priority(request),
+                                                              timeout=Server.TIMEOUT)
+
+        # 変換結果をキャッシュに移して送信する。途中で切れても続きから受け取り直せる
+        if not self.cache.put(cache_key, output_file_path, media_type):
+            self.send_response(client,
+                               media_type,
+                               dict(status=200, message='OK'),
+                               output_file_path)
+        elif not self.send_cached_response(client, cache_key, count=False):
+            raise RuntimeError('The result was evicted before it was sent')
+
+    # メモリにある変換結果をヘッダーからpayloadまで1回のsendmsgで送り、送った後にキャッシュに書き込む
+    def send_memory_response(self, client: socket.socket, cache_key: str, media_type: str, data: bytearray):
+        checksum = zlib.crc32(data)
+        response = dict(status=200, message='OK', offset=0, size=len(data), checksum=checksum)
+        buffers = self.memory_response(media_type, response, data)
+        record = JobRecord.current.get()
+        with record.phase('send'):
+            self.send_buffers(client, buffers)
+        record.sent(response, sum(len(buffer) for buffer in buffers[3:]))
+        self.logger.info(f'Result has been sent from memory! ({len(data)} bytes)')
+        try:
+            self.cache.put_data(cache_key, data, media_type, checksum)
+        except OSError as e:
+            self.logger.error(f'Failed to cache the result: {e}')
+
+    # 複数の操作を1回のデコードでまとめて変換し、変換結果を1つのレスポンスで続けて返す
+    def process_batch_request(self, client: socket.socket, request: dict, input_file_path: str, input_hash: str):
+        output_file_path = os.path.join(os.path.dirname(input_file_path),
+                                        f'processed_{os.path.basename(input_file_path)}')
+        # 今回変換した結果。key -> (パス, 拡張子)
+        outputs = {}
+
+        requests = VideoProcessor.batch_requests(request)
+        keys = [ResultCache.make_key(input_hash, sub_request) for sub_request in requests]
+        with contextlib.ExitStack() as stack:
+            # キャッシュにある変換結果は送信が終わるまで削除されないようにする
+            results = {}
+            for key in dict.fromkeys(keys):
+                cached = stack.enter_context(self.cache.lookup(key))
+                if cached is not None:
+                    results[key] = cached
+            missing = {key: sub_request for key, sub_request in zip(keys, requests) if key not in results}
+            if missing:
+                # 変換できないパラメータは変換待ちに並ぶ前に断る
+                record = JobRecord.current.get()
+                with record.phase('probe'):
+                    for sub_request in missing.values():
+                        VideoProcessor.plan(sub_request, input_file_path)
+                self.logger.info(f'Processing {len(missing)} of {len(requests)} operations...')
+                process_batch = self.pool.process_batch if self.pool else VideoProcessor.process_batch
+                processed = self.scheduler.run(record.job(process_batch, progress=record.update_progress),
+                                               list(missing.values()), input_file_path, output_file_path,
+                                               priority=self.priority(request), timeout=Server.TIMEOUT)
+                outputs = {key: (file_path, media_type)
+                           for key, (media_type, file_path) in zip(missing, processed)}
+                results.update(outputs)
+            self.send_batch_response(client, requests, keys, results)
+
+        # 送信した変換結果をキャッシュに移す
+        for key, (file_path, media_type) in outputs.items():
+            self.cache.put(key, file_path, media_type)
+
+    # 全ての操作の変換結果がキャッシュにある場合だけ返す
+    def send_cached_batch_response(self, client: socket.socket, requests: list[dict], input_hash: str) -> bool:
+        keys = [ResultCache.make_key(input_hash, sub_request) for sub_request in requests]
+        with contextlib.ExitStack() as stack:
+            results = {key: stack.enter_context(self.cache.lookup(key)) for key in dict.fromkeys(keys)}
+            if None in results.values():
+                return False
+            self.logger.info(f'Sending {len(requests)} cached results: {self.cache.stats()}')
+            self.send_batch_response(client, requests, keys, results)
+            return True
+
+    # resultsに各変換結果の拡張子と大きさを並べ、payloadにはその順に続けて送る
+    def send_batch_response(self, client: socket.socket, requests: list[dict], keys: list[str], results: dict):
+        file_paths = [results[key][0] for key in keys]
+        sizes = [os.path.getsize(file_path) for file_path in file_paths]
+        response = dict(status=200, message='OK', results=[
+            dict(operation=sub_request['operation'], mediaType=results[key][1], size=size)
+            for sub_request, key, size in zip(requests, keys, sizes)])
+        record = JobRecord.current.get()
+        with record.phase('send'):
+            self.send_files(client, '', response, file_paths)
+        record.sent(response, sum(sizes))
+
+    @staticmethod
+    def priority(request: dict) -> int:
+        return int(request.get('priority', JobScheduler.DEFAULT_PRIORITY))
 
-        # レスポンスを送信する
-        self.send_response(client,
-                           media_type,
-                           dict(status=200, message='OK'),
-                           output_file_path)
+    def send_cached_response(self, client: socket.socket, cache_key: str, offset: int = 0,
+                             count: bool = True) -> bool:
+        with self.cache.lookup(cache_key, count) as cached:
+            if cached is None:
+                return False
+            file_path, media_type = cached
+            self.logger.info(f'Sending cached result from {offset}: {cache_key} {self.cache.stats()}')
+            size = os.path.getsize(file_path)
+            if offset > size:
+                offset = 0
+            response = dict(status=200, message='OK', offset=offset, size=size,
+                            checksum=self.cache.checksum(cache_key, file_path))
+            self.send_response(client, media_type, response, file_path, offset)
+            return True
 
-        # ファイルを削除する
-        self.logger.info(f'Deleting files: {input_file_path} {output_file_path}')
-        os.remove(input_file_path)
-        os.remove(output_file_path)
+    # ジョブのディレクトリに入力を受信し、保存したパスを返す。headはpayloadのうち既に受信した先頭
+    def receive_upload(self, client: socket.socket, request: dict, media_type: str, payload_size: int, hasher,
+                       job_dir: str, head: bytes = b'') -> str:
+        input_file_path = os.path.join(job_dir, f'input.{media_type}')
+        self.logger.info(f'Saving file to {input_file_path}')
+        if request.get('transfer') == Server.CHUNKED:
+            self.receive_chunked_payload(client, input_file_path, hasher)
+            return input_file_path
+        with open(input_file_path, 'wb') as f, Spool.preallocated(f, payload_size):
+            f.write(head)
+            hasher.update(head)
+            self.copy_to_writer(client, f, payload_size - len(head), hasher)
+        self.logger.info('File has been received!')
+        return input_file_path
+
+    # 続きから受信し、受信済みの部分と合わせて入力のハッシュを確かめる
+    # ジョブのディレクトリに移した入力のパスと入力のハッシュを返す
+    def receive_session_upload(self, client: socket.socket, request: dict, media_type: str,
+                               payload_size: int, job_dir: str, head: bytes = b'') -> tuple[str, str]:
+        session = UploadSession(request[Server.SESSION_ID], self.spool.session_dir)
+        offset = int(request.get('offset', 0))
+        self.logger.info(f'Receiving session {session.session_id} from {offset}')
+        f, hasher = session.open(offset)
+        with f, Spool.preallocated(f, offset + payload_size):
+            f.write(head)
+            hasher.update(head)
+            self.copy_to_writer(client, f, payload_size - len(head), hasher)
+        input_file_path = os.path.join(job_dir, f'input.{media_type}')
+        session.complete(hasher, request.get(Server.INPUT_HASH), input_file_path)
+        self.logger.info('File has been received!')
+        return input_file_path, hasher.hexdigest()
+
+    # streamingの入力の先頭を、moovを読み終わるか、moovが先頭にないと分かるまで受信する
+    # 受信した先頭と、標準入力から変換できるかを返す
+    def receive_stream_head(self, client: socket.socket, payload_size: int) -> tuple[bytes, bool]:
+        head = b''
+        while True:
+            streamable, size = MediaProbe.stream_head(head)
+            if streamable is not None:
+                return head, streamable
+            if size > min(payload_size, MediaProbe.MAX_STREAM_HEAD):
+                return head, False
+            head += self.receive_exactly(client, size - len(head))
+
+    # ファイルを保存せず、受信したデータをffmpegに流し込みながら変換結果を順次返す。headはpayloadのうち既に受信した先頭
+    def process_streaming_request(self, client: socket.socket, request: dict, payload_size: int, head: bytes,
+                                  plan: dict, threads: int = 0):
+        self.logger.info('Processing (streaming)...')
+        record = JobRecord.current.get()
+        record.received(payload_size)
+        process, media_type = VideoProcessor.open_stream(request, plan, threads)
+        feeder = threading.Thread(target=self.feed_process, args=(client, process, head, payload_size))
+        feeder.start()
+        try:
+            # 最初の出力を待ち、何も出力せずに失敗した場合は通常のエラーレスポンスを返す
+            chunk_size = self.negotiated_chunk_size()
+            data = process.stdout.read1(chunk_size)
+            if not data:
+                feeder.join()
+                raise RuntimeError(f'ffmpeg exited with code {process.wait()}')
+            response = dict(status=200, message='OK', transfer=Server.CHUNKED)
+            self.send_header(client, media_type, response, '')
+            self.send_metadata(client, media_type, response)
+            compressor = ChunkCompressor(self.compresses(media_type))
+            while data:
+                buffers = compressor.encode(data)
+                self.send_buffers(client, buffers)
+                record.sent(response, len(buffers[1]))
+                data = process.stdout.read1(chunk_size)
+            feeder.join()
+            # 途中で失敗した場合は終端チャンクを送らずに接続を切り、クライアントに不完全なことを伝える
+            if process.wait() != 0:
+                self.logger.error(f'ffmpeg exited with code {process.returncode} while streaming')
+                return
+            self.send_chunk(client, b'')
+            self.logger.info('Streaming has been completed!')
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            feeder.join()
+
+    def feed_process(self, client: socket.socket, process, head: bytes, payload_size: int):
+        try:
+            process.stdin.write(head)
+            self.copy_to_writer(client, process.stdin, payload_size - len(head))
+        except (BrokenPipeError, ConnectionError, OSError) as e:
+            self.logger.error(f'Failed to feed ffmpeg: {e}')
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
 
-    def receive_request(self, client: socket.socket):
-        request_size, media_type_size, payload_size = self.receive_header(client)
+    def receive_request(self, client: socket.socket, header: bytes = None):
+        # リクエストを読めるまではv1として応答する
+        Server.negotiated.set(None)
+        request_size, media_type_size, payload_size = (self.unpack_header(header) if header
+                                                       else self.receive_header(client))
         self.logger.info(
             f'request_size: {request_size}, media_type_size: {media_type_size}, payload_size: {payload_size}')
-        request, saved_file_name = self.receive_body(client, request_size, media_type_size, payload_size)
-        self.logger.info(f'Request: {request}, file_name: {saved_file_name}')
-        return request, saved_file_name
+        request, media_type = self.receive_metadata(client, request_size, media_type_size)
+        self.logger.info(f'Request: {request}, media_type: {media_type}')
+        self.negotiate(request)
+        JobRecord.current.get().operation = request.get('operation')
+        return request, media_type, payload_size
 
-    def send_response(self, client: socket.socket, media_type: str, response: dict, file_path: str):
-        self.send_header(client, media_type, response, file_path)
-        self.send_body(client, media_type, response, file_path)
+    def send_response(self, client: socket.socket, media_type: str, response: dict, file_path: str,
+                      offset: int = 0):
+        record = JobRecord.current.get()
+        if file_path and self.compresses(media_type):
+            # 圧縮後の大きさは送るまでわからないため、チャンク形式で送る
+            response = dict(response, transfer=Server.CHUNKED)
+            with record.phase('send'):
+                self.send_header(client, media_type, response, '')
+                self.send_metadata(client, media_type, response)
+                sent = self.send_compressed_payload(client, file_path, offset)
+            record.sent(response, sent)
+            return
+        with record.phase('send'):
+            self.send_header(client, media_type, response, file_path, offset)
+            self.send_body(client, media_type, response, file_path, offset)
+        record.sent(response, os.path.getsize(file_path) - offset if file_path else 0)
@@ -0,0 +1,215 @@
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from models.TCPConnection import TCPConnection
+from models.UploadSession import UploadSession
+
+
+# ディスクの空きかクォータが足りず、アップロードを受け付けられない
+class SpoolFullError(Exception):
+    pass
+
+
+# アップロードと変換結果を置く領域を管理する。ジョブごとに専用のディレクトリを作り、終わったらディレクトリごと削除する
+# 受信を始める前に容量を確かめて予約し、残ったファイルは起動時と定期的にjanitorが削除する
+class Spool:
+    # TCPConnection.DEST_DIRの下に作る。DEST_DIRは起動時に変えられるため、パスはSpoolを作るときに決める
+    JOB_DIR_NAME = 'jobs'
+    # 実行中のジョブのディレクトリに置き、ジョブを持つプロセスが終わるまでflockでロックしておくファイル
+    LOCK_FILE = '.lock'
+    # ロックを取る前のジョブを削除しないよう、これより新しいディレクトリはjanitorが残す
+    GRACE_PERIOD = 60
+    # 予約の合計の上限（バイト）。0の場合は上限なし
+    QUOTA = 0
+    # ファイルシステムに常に残す空き容量
+    MIN_FREE = 1024 ** 3
+    # 変換結果の分として、入力の大きさに対してこの割合を追加で予約する
+    OUTPUT_RATIO = 1.0
+    JANITOR_INTERVAL = 600
+    # この時間更新されていない再開用の.partファイルは削除する
+    SESSION_TTL = 24 * 60 * 60
+
+    # job_dirとsession_dirを省略した場合は、作るときのTCPConnection.DEST_DIRの下を使う。同じjob_dirを複数のプロセスで使ってもよい
+    def __init__(self, logger: logging.Logger, quota: int = QUOTA, min_free: int = MIN_FREE, job_dir: str = None,
+                 session_dir: str = None):
+        self.logger = logger
+        self.job_dir = job_dir if job_dir else os.path.join(TCPConnection.DEST_DIR, Spool.JOB_DIR_NAME)
+        # 再開用の.partファイルを置くディレクトリ。UploadSessionに渡す
+        self.session_dir = (session_dir if session_dir
+                            else os.path.join(TCPConnection.DEST_DIR, UploadSession.SESSION_DIR_NAME))
+        self.quota = quota
+        self.min_free = min_free
+        self.lock = threading.Lock()
+        # ジョブのディレクトリ -> (入力の予約, 変換結果の予約)
+        self.jobs = {}
+        # ジョブのディレクトリ -> ロックしているLOCK_FILE
+        self.locks = {}
+        # 再開用に残っている.partファイルの合計。janitorが更新する
+        self.session_bytes = 0
+        self.rejected = 0
+        self.reclaimed = 0
+        self.stopped = threading.Event()
+
+    # 入力の大きさがsizeのジョブを受け付けられるかを確かめる。受け付けられない場合はSpoolFullError
+    def check(self, size: int):
+        with self.lock:
+            self.check_locked(size, int(size * Spool.OUTPUT_RATIO))
+
+    def check_locked(self, size: int, output_size: int):
+        reserved = sum(sum(reservation) for reservation in self.jobs.values())
+        if self.quota and reserved + self.session_bytes + size + output_size > self.quota:
+            self.rejected += 1
+            raise SpoolFullError(f'Spool quota exceeded: {reserved + self.session_bytes} of {self.quota} bytes '
+                                 f'are in use')
+        # 入力は受信前に確保するため空き容量から引かれている。まだ書き出していない変換結果の分を引いて比べる
+        os.makedirs(self.job_dir, exist_ok=True)
+        pending = sum(output for _, output in self.jobs.values())
+        free = shutil.disk_usage(self.job_dir).free - pending
+        if free - size - output_size < self.min_free:
+            self.rejected += 1
+            raise SpoolFullError(f'Not enough disk space: {free} bytes free for {size + output_size} bytes')
+
+    # 容量を予約し、ジョブのディレクトリを作って返す。使い終わったらreleaseを呼ぶ
+    def reserve(self, size: int) -> str:
+        output_size = int(size * Spool.OUTPUT_RATIO)
+        with self.lock:
+            self.check_locked(size, output_size)
+            # janitorが削除しないよう、作るのと同時に登録し、同じディレクトリを使う他のプロセスのためにロックする
+            job_dir = tempfile.mkdtemp(prefix='job_', dir=self.job_dir)
+            self.jobs[job_dir] = (size, output_size)
+            lock_file = open(os.path.join(job_dir, Spool.LOCK_FILE), 'w')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.locks[job_dir] = lock_file
+        return job_dir
+
+    def release(self, job_dir: str):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        with self.lock:
+            self.jobs.pop(job_dir, None)
+            lock_file = self.locks.pop(job_dir, None)
+        if lock_file:
+            lock_file.close()
+
+    @contextlib.contextmanager
+    def job(self, size: int):
+        job_dir = self.reserve(size)
+        try:
+            yield job_dir
+        finally:
+            self.release(job_dir)
+
+    # 受信を始める前にsizeバイトの領域を確保し、途中で容量が尽きないようにする
+    # glibcはfallocateに対応していないファイルシステムでは0を書き込んで確保するため、時間がかかる場合がある
+    @staticmethod
+    def allocate(f, size: int):
+        if size > 0:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise SpoolFullError(f'Not enough disk space for {size} bytes')
+                # fallocateも書き込みによる確保もできない場合は確保せずに受信する
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+
+    # 途中で切れた場合は受信した所までに戻す
+    @staticmethod
+    @contextlib.contextmanager
+    def truncated(f):
+        try:
+            yield f
+        finally:
+            f.truncate(f.tell())
+
+    # allocateしてからtruncatedで受信する。イベントループではallocateをrun_in_executorで呼び、truncatedだけを使う
+    @staticmethod
+    @contextlib.contextmanager
+    def preallocated(f, size: int):
+        Spool.allocate(f, size)
+        with Spool.truncated(f):
+            yield f
+
+    # 起動時に呼ぶ。残っているファイルを削除し、以降はJANITOR_INTERVALごとに削除する
+    def start(self):
+        self.clean()
+        threading.Thread(target=self.run_janitor, name='janitor', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run_janitor(self):
+        while not self.stopped.wait(Spool.JANITOR_INTERVAL):
+            try:
+                self.clean()
+            except OSError as e:
+                self.logger.error(f'Janitor failed: {e}')
+
+    # どのプロセスも実行していないジョブのディレクトリと、SESSION_TTLより古い.partファイルを削除する
+    def clean(self):
+        reclaimed = 0
+        os.makedirs(self.job_dir, exist_ok=True)
+        # 一覧を取る間に作られたジョブを削除しないよう、lockを取ったまま一覧を取る
+        with self.lock:
+            orphans = [os.path.join(self.job_dir, name) for name in os.listdir(self.job_dir)
+                       if os.path.join(self.job_dir, name) not in self.jobs]
+        for path in orphans:
+            if not Spool.abandoned(path):
+                continue
+            reclaimed += Spool.size(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+        session_bytes = 0
+        if os.path.isdir(self.session_dir):
+            expires = time.time() - Spool.SESSION_TTL
+            for name in os.listdir(self.session_dir):
+                path = os.path.join(self.session_dir, name)
+                stat = os.stat(path)
+                if stat.st_mtime < expires:
+                    os.remove(path)
+                    reclaimed += stat.st_size
+                else:
+                    session_bytes += stat.st_size
+        with self.lock:
+            self.session_bytes = session_bytes
+            self.reclaimed += reclaimed
+        if reclaimed:
+            self.logger.info(f'Janitor reclaimed {reclaimed} bytes')
+
+    # 同じjob_dirを使う他のプロセスのジョブは、そのプロセスがLOCK_FILEをロックしている
+    # 作られてからGRACE_PERIODが経ち、ロックされていないものだけを残ったものとみなす
+    @staticmethod
+    def abandoned(path: str) -> bool:
+        try:
+            if time.time() - os.path.getmtime(path) < Spool.GRACE_PERIOD:
+                return False
+            lock_file = open(os.path.join(path, Spool.LOCK_FILE), 'r')
+        except (FileNotFoundError, NotADirectoryError):
+            return os.path.exists(path)
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        return True
+
+    @staticmethod
+    def size(path: str) -> int:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(path) for name in names)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(jobs=len(self.jobs), reserved=sum(sum(reservation) for reservation in self.jobs.values()),
+                        session_bytes=self.session_bytes, rejected=self.rejected, reclaimed=self.reclaimed,
+                        quota=self.quota)
@@ -1,9 +1,14 @@
 from abc import ABCMeta, abstractmethod
+import contextlib
+import contextvars
 import json
 import logging
+import mmap
 import os
 import socket
 import struct
+import threading
+import zlib
 
 
 class TCPConnection(metaclass=ABCMeta):
@@ -12,91 +17,365 @@ class TCPConnection(metaclass=ABCMeta):
     REQUEST_SIZE = 16
     MEDIA_TYPE_SIZE = 1
     PAYLOAD_SIZE = 47
+    CHUNK_LENGTH_SIZE = 4
+
+    CHUNKED = 'chunked'
+    INPUT_HASH = 'inputHash'
+    SESSION_ID = 'sessionId'
+    # 問い合わせに含めるアップロードの大きさ。サーバーは受信する前に空き容量を確かめる
+    UPLOAD_SIZE = 'uploadSize'
+    # 成功した後も接続を切らずに、同じ接続で次のリクエストを送るためのキー
+    KEEP_ALIVE = 'keepAlive'
+    # バッチのレスポンスで、続けて送る変換結果ごとの大きさを並べるキー
+    RESULTS = 'results'
+
+    # v2: クライアントはリクエストにprotocol、受け付ける圧縮方式、受信したいチャンクの大きさを含める
+    # サーバーは決めた設定をレスポンスに含めて返す。protocolを含まないv1のクライアントには従来どおりに返す
+    PROTOCOL = 'protocol'
+    PROTOCOL_VERSION = 2
+    COMPRESSION = 'compression'
+    CHUNK_SIZE_KEY = 'chunkSize'
+    ZLIB = 'zlib'
+    # 圧縮して送る変換結果の種類。mp4は圧縮が効かないため対象にしない
+    COMPRESSIBLE_MEDIA_TYPES = ('mp3', 'gif')
+    COMPRESS_LEVEL = 1
+    # この大きさ以上のJSONは圧縮して送る
+    METADATA_COMPRESS_MIN = 1024
+    MIN_CHUNK_SIZE = 64 * 1024
+    # チャンクの長さの最上位ビットが立っている場合、そのチャンクはzlibで圧縮されている
+    COMPRESSED_CHUNK = 1 << 31
+
+    # 処理中のリクエストで相手と決めたv2の設定。v1の相手にはNone
+    negotiated = contextvars.ContextVar('negotiated', default=None)
 
     BUFFER_SIZE = 1400
+    CHUNK_SIZE = 1024 * 1024
     TIMEOUT = 60
 
     DEST_DIR = './dest'
 
-    def __init__(self, host: str, port: int, logger: logging.Logger):
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = CHUNK_SIZE):
         self.logger = logger
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.host = host
         self.port = port
+        self.chunk_size = chunk_size
+        # 受信用バッファはスレッドごとに確保して使い回す
+        self._local = threading.local()
 
     @abstractmethod
     def run(self):
         raise NotImplementedError
 
-    def send_header(self, sock: socket.socket, media_type: str, request: dict, file_path: str):
-        request_size = len(bytes(json.dumps(request), 'utf-8'))
+    # クライアントがリクエストに含めるv2の希望
+    def offer(self) -> dict:
+        return {TCPConnection.PROTOCOL: TCPConnection.PROTOCOL_VERSION, TCPConnection.COMPRESSION: [TCPConnection.ZLIB],
+                TCPConnection.CHUNK_SIZE_KEY: self.chunk_size}
+
+    # リクエストの希望とこちらの設定から、このリクエストの送受信に使う設定を決める
+    # チャンクの大きさは双方の小さい方にし、自分より新しいバージョンには自分のバージョンで答える
+    def negotiate(self, request: dict) -> dict:
+        version = int(request.get(TCPConnection.PROTOCOL, 1))
+        if version < 2:
+            TCPConnection.negotiated.set(None)
+            return None
+        chunk_size = int(request.get(TCPConnection.CHUNK_SIZE_KEY, self.chunk_size))
+        settings = {
+            TCPConnection.PROTOCOL: min(version, TCPConnection.PROTOCOL_VERSION),
+            TCPConnection.COMPRESSION: (TCPConnection.ZLIB
+                                        if TCPConnection.ZLIB in request.get(TCPConnection.COMPRESSION, ()) else None),
+            TCPConnection.CHUNK_SIZE_KEY: max(TCPConnection.MIN_CHUNK_SIZE, min(chunk_size, self.chunk_size)),
+        }
+        TCPConnection.negotiated.set(settings)
+        return settings
+
+    def negotiated_chunk_size(self) -> int:
+        settings = TCPConnection.negotiated.get()
+        return settings[TCPConnection.CHUNK_SIZE_KEY] if settings else self.chunk_size
+
+    # 相手がzlibを受け付け、圧縮が効く種類の場合だけ変換結果を圧縮して送る
+    @staticmethod
+    def compresses(media_type: str) -> bool:
+        settings = TCPConnection.negotiated.get()
+        return (settings is not None and settings[TCPConnection.COMPRESSION] == TCPConnection.ZLIB
+                and media_type in TCPConnection.COMPRESSIBLE_MEDIA_TYPES)
+
+    # v2の相手には決めた設定を含め、大きなJSONは圧縮する
+    @staticmethod
+    def encode_metadata(metadata: dict) -> bytes:
+        settings = TCPConnection.negotiated.get()
+        if settings:
+            metadata = dict(metadata, **settings)
+        data = bytes(json.dumps(metadata), 'utf-8')
+        if (settings and settings[TCPConnection.COMPRESSION] == TCPConnection.ZLIB
+                and len(data) >= TCPConnection.METADATA_COMPRESS_MIN):
+            data = zlib.compress(data, TCPConnection.COMPRESS_LEVEL)
+        return data
+
+    # JSONは必ず'{'で始まるため、それ以外はzlibで圧縮されたJSON
+    @staticmethod
+    def decode_metadata(data: bytes) -> dict:
+        if data[:1] != b'{':
+            data = zlib.decompress(data)
+        return json.loads(data.decode('utf-8'))
+
+    def send_header(self, sock: socket.socket, media_type: str, request: dict, file_path: str, offset: int = 0):
+        request_size = len(self.encode_metadata(request))
         media_type_size = len(bytes(media_type, 'utf-8')) if media_type else 0
-        payload_size = os.path.getsize(file_path) if file_path else 0
+        payload_size = os.path.getsize(file_path) - offset if file_path else 0
         self.logger.info(
             f'request_size: {request_size}, media_type_size: {media_type_size}, payload_size: {payload_size}')
-        packed_header = struct.pack(TCPConnection.HEADER_FORMAT,
-                                    int.to_bytes(request_size, TCPConnection.REQUEST_SIZE, 'big'),
-                                    int.to_bytes(media_type_size, TCPConnection.MEDIA_TYPE_SIZE, 'big'),
-                                    int.to_bytes(payload_size, TCPConnection.PAYLOAD_SIZE, 'big'))
-        sock.send(packed_header)
+        sock.sendall(self.pack_header(request_size, media_type_size, payload_size))
 
-    def send_body(self, sock: socket.socket, media_type: str, request: dict, file_path: str):
-        # jsonを送信する
-        json_data = json.dumps(request)
-        sock.send(bytes(json_data, 'utf-8'))
-        # media_typeを送信する
-        sock.send(bytes(media_type, 'utf-8'))
+    @staticmethod
+    def pack_header(request_size: int, media_type_size: int, payload_size: int) -> bytes:
+        return struct.pack(TCPConnection.HEADER_FORMAT,
+                           int.to_bytes(request_size, TCPConnection.REQUEST_SIZE, 'big'),
+                           int.to_bytes(media_type_size, TCPConnection.MEDIA_TYPE_SIZE, 'big'),
+                           int.to_bytes(payload_size, TCPConnection.PAYLOAD_SIZE, 'big'))
+
+    @staticmethod
+    def unpack_header(header: bytes) -> tuple[int, int, int]:
+        request_size_bytes, media_type_size_bytes, payload_size_bytes = struct.unpack(TCPConnection.HEADER_FORMAT,
+                                                                                      header)
+        request_size = int.from_bytes(request_size_bytes, 'big')
+        media_type_size = int.from_bytes(media_type_size_bytes, 'big')
+        payload_size = int.from_bytes(payload_size_bytes, 'big')
+        return request_size, media_type_size, payload_size
+
+    def send_body(self, sock: socket.socket, media_type: str, request: dict, file_path: str, offset: int = 0):
+        self.send_metadata(sock, media_type, request)
         # ファイルを読み込んで送信する
         if not os.path.exists(file_path):
             self.logger.info(f'File: {file_path} does not exist!')
             return
+        try:
+            self.send_payload(sock, file_path, offset)
+        # socketが例外を発生させたら接続を切る
+        except socket.error:
+            sock.close()
+
+    def send_metadata(self, sock: socket.socket, media_type: str, request: dict):
+        # jsonを送信する
+        sock.sendall(self.encode_metadata(request))
+        # media_typeを送信する
+        sock.sendall(bytes(media_type, 'utf-8'))
+
+    def send_payload(self, sock: socket.socket, file_path: str, offset: int = 0):
+        # sendfileでカーネル内でファイルをコピーして送信する（使えない環境ではsendにフォールバックする）
         with open(file_path, 'rb') as f:
-            try:
-                # self.buffer_size分ずつファイルを読み込んで送信する
-                while True:
-                    data = f.read(TCPConnection.BUFFER_SIZE)
-                    if data:
-                        sock.send(data)
-                    else:
-                        self.logger.info('File has been sent!')
-                        break
-            # socketが例外を発生させたら接続を切る
-            except socket.error:
-                sock.close()
+            sent = sock.sendfile(f, offset)
+        self.logger.info(f'File has been sent! ({sent} bytes)')
+
+    def send_files(self, sock: socket.socket, media_type: str, response: dict, file_paths: list[str]):
+        # 複数のファイルを1つのpayloadとして続けて送る
+        request_size = len(self.encode_metadata(response))
+        media_type_size = len(bytes(media_type, 'utf-8'))
+        payload_size = sum(os.path.getsize(file_path) for file_path in file_paths)
+        self.logger.info(
+            f'request_size: {request_size}, media_type_size: {media_type_size}, payload_size: {payload_size}')
+        sock.sendall(self.pack_header(request_size, media_type_size, payload_size))
+        self.send_metadata(sock, media_type, response)
+        for file_path in file_paths:
+            self.send_payload(sock, file_path)
+
+    def receive_results(self, sock: socket.socket, response: dict, base_name: str) -> list[str]:
+        # バッチのレスポンスのpayloadを、resultsの大きさの順に切り分けて保存する
+        os.makedirs(TCPConnection.DEST_DIR, exist_ok=True)
+        file_names = []
+        for i, result in enumerate(response[TCPConnection.RESULTS]):
+            file_name = f'{base_name}_{i}_{result["operation"]}.{result["mediaType"]}'
+            self.logger.info(f'Saving file to {file_name}')
+            self.receive_payload(sock, os.path.join(TCPConnection.DEST_DIR, file_name), result['size'])
+            file_names.append(file_name)
+        return file_names
 
     def receive_header(self, sock: socket.socket) -> tuple[int, int, int]:
         self.logger.info('Waiting for header...')
-        header = sock.recv(TCPConnection.HEADER_SIZE)
-        request_size_bytes, media_type_size_bytes, payload_size_bytes = struct.unpack(TCPConnection.HEADER_FORMAT,
-                                                                                      header)
-        request_size = int.from_bytes(request_size_bytes, 'big')
-        media_type_size = int.from_bytes(media_type_size_bytes, 'big')
-        payload_size = int.from_bytes(payload_size_bytes, 'big')
-        return request_size, media_type_size, payload_size
+        # 接続を使い回すと前のレスポンスの直後に読むため、ヘッダーがそろうまで受信する
+        header = self.receive_exactly(sock, TCPConnection.HEADER_SIZE)
+        return self.unpack_header(header)
 
     def receive_body(self, sock: socket.socket, request_size: int, media_type_size: int, payload_size: int) -> tuple[
             dict, str,]:
-        # jsonを受信する
-        request_bytes = sock.recv(request_size)
-        request_string = request_bytes.decode('utf-8')
-        # dictに変換する
-        request = json.loads(request_string)
-
-        # メディアタイプを受信する
-        media_type_bytes = sock.recv(media_type_size)
-        media_type = media_type_bytes.decode('utf-8')
+        request, media_type = self.receive_metadata(sock, request_size, media_type_size)
+        file_name = self.receive_file(sock, request, media_type, payload_size)
+        return request, file_name
 
-        # ファイルを受信する
-        address, port = sock.getsockname()
-        file_name = f'{address}_{port}.' + media_type
+    def receive_file(self, sock: socket.socket, request: dict, media_type: str, payload_size: int,
+                     hasher=None, file_name: str = None, offset: int = 0) -> str:
+        # ファイルを受信する。offsetがあれば既に受信した部分の続きに書き込む
+        if not file_name:
+            address, port = sock.getsockname()
+            file_name = f'{address}_{port}.' + media_type
         if not os.path.exists(TCPConnection.DEST_DIR):
             os.makedirs(TCPConnection.DEST_DIR)
         file_path = os.path.join(TCPConnection.DEST_DIR, file_name)
         self.logger.info(f'Saving file to {file_path}')
-        with open(file_path, 'wb') as f:
-            while payload_size > 0:
-                data = sock.recv(TCPConnection.BUFFER_SIZE)
-                f.write(data)
-                payload_size -= len(data)
+        if request.get('transfer') == TCPConnection.CHUNKED:
+            self.receive_chunked_payload(sock, file_path, hasher, offset)
+        else:
+            self.receive_payload(sock, file_path, payload_size, hasher, offset)
+        return file_name
+
+    def receive_metadata(self, sock: socket.socket, request_size: int, media_type_size: int) -> tuple[dict, str]:
+        # jsonを受信し、dictに変換する
+        request = self.decode_metadata(self.receive_exactly(sock, request_size))
+
+        # メディアタイプを受信する
+        media_type_bytes = self.receive_exactly(sock, media_type_size)
+        media_type = media_type_bytes.decode('utf-8')
+        return request, media_type
+
+    @staticmethod
+    def receive_exactly(sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            received = sock.recv(size - len(data))
+            if not received:
+                raise ConnectionError(f'Connection closed with {size - len(data)} bytes remaining')
+            data += received
+        return bytes(data)
+
+    def receive_payload(self, sock: socket.socket, file_path: str, payload_size: int, hasher=None, offset: int = 0):
+        # 使い回しのバッファにrecv_intoで直接受信し、コピーせずに書き込む
+        with open(file_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            self.copy_to_writer(sock, f, payload_size, hasher)
             self.logger.info('File has been received!')
-        return request, file_name
+
+    # チャンク形式: 4バイトの長さ + データを繰り返し、長さ0のチャンクで終端する
+    def send_chunk(self, sock: socket.socket, data: bytes):
+        length = int.to_bytes(len(data), TCPConnection.CHUNK_LENGTH_SIZE, 'big')
+        self.send_buffers(sock, [length, data])
+
+    @staticmethod
+    def send_buffers(sock: socket.socket, buffers: list):
+        # 複数のバッファをsendmsgでまとめて送信し、送りきれなかった分は続きから送る
+        views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        while views:
+            sent = sock.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views:
+                views[0] = views[0][sent:]
+
+    # 圧縮し、チャンク形式で終端まで送る。圧縮はmmapしたファイルを直接読み、圧縮が効かなくなった後はsendfileで送る
+    def send_compressed_payload(self, sock: socket.socket, file_path: str, offset: int = 0) -> int:
+        compressor = ChunkCompressor(True)
+        chunk_size = self.negotiated_chunk_size()
+        size = os.path.getsize(file_path)
+        sent = 0
+        with open(file_path, 'rb') as f, TCPConnection.map_file(f, size) as mapped:
+            for start in range(offset, size, chunk_size):
+                count = min(chunk_size, size - start)
+                if compressor.enabled:
+                    with memoryview(mapped)[start:start + count] as view:
+                        buffers = compressor.encode(view)
+                        self.send_buffers(sock, buffers)
+                        sent += len(buffers[1])
+                else:
+                    sock.sendall(int.to_bytes(count, TCPConnection.CHUNK_LENGTH_SIZE, 'big'))
+                    sock.sendfile(f, start, count)
+                    sent += count
+        self.send_chunk(sock, b'')
+        self.logger.info(f'File has been sent! ({sent} bytes for {size - offset} bytes)')
+        return sent
+
+    # 空のファイルはmmapできない
+    @staticmethod
+    def map_file(f, size: int):
+        if size == 0:
+            return contextlib.nullcontext(b'')
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # メモリにある変換結果のレスポンスを、ヘッダーからpayloadまで1回のsendmsgで送れるバッファのリストにする
+    def memory_response(self, media_type: str, response: dict, data) -> list:
+        view = memoryview(data)
+        if self.compresses(media_type):
+            response = dict(response, transfer=TCPConnection.CHUNKED)
+            compressor = ChunkCompressor(True)
+            chunk_size = self.negotiated_chunk_size()
+            payload = []
+            for start in range(0, len(view), chunk_size):
+                payload.extend(compressor.encode(view[start:start + chunk_size]))
+            payload.append(int.to_bytes(0, TCPConnection.CHUNK_LENGTH_SIZE, 'big'))
+            payload_size = 0
+        else:
+            payload = [view]
+            payload_size = len(view)
+        metadata = self.encode_metadata(response)
+        media_type_bytes = bytes(media_type, 'utf-8')
+        return [self.pack_header(len(metadata), len(media_type_bytes), payload_size), metadata,
+                media_type_bytes] + payload
+
+    def receive_chunked_payload(self, sock: socket.socket, file_path: str, hasher=None, offset: int = 0):
+        with open(file_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                length = int.from_bytes(self.receive_exactly(sock, TCPConnection.CHUNK_LENGTH_SIZE), 'big')
+                if length == 0:
+                    break
+                if length & TCPConnection.COMPRESSED_CHUNK:
+                    data = zlib.decompress(self.receive_exactly(sock, length & ~TCPConnection.COMPRESSED_CHUNK))
+                    f.write(data)
+                    if hasher:
+                        hasher.update(data)
+                else:
+                    self.copy_to_writer(sock, f, length, hasher)
+            self.logger.info('File has been received!')
+
+    def copy_to_writer(self, sock: socket.socket, writer, size: int, hasher=None):
+        # socketからsizeバイト読み込み、writerに書き込む。hasherがあれば受信しながらハッシュを計算する
+        view = self._receive_buffer()
+        while size > 0:
+            received = sock.recv_into(view, min(size, len(view)))
+            if received == 0:
+                raise ConnectionError(f'Connection closed with {size} bytes remaining')
+            writer.write(view[:received])
+            if hasher:
+                hasher.update(view[:received])
+            size -= received
+
+    # ファイルの先頭sizeバイト（省略時は全体）のCRC32。再開時に双方が持つデータが一致するかを確かめる
+    @staticmethod
+    def checksum(file_path: str, size: int = None) -> int:
+        crc = 0
+        remaining = os.path.getsize(file_path) if size is None else size
+        with open(file_path, 'rb') as f:
+            while remaining > 0:
+                data = f.read(min(remaining, TCPConnection.CHUNK_SIZE))
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+        return crc
+
+    def _receive_buffer(self) -> memoryview:
+        view = getattr(self._local, 'buffer', None)
+        if view is None or len(view) != self.chunk_size:
+            view = memoryview(bytearray(self.chunk_size))
+            self._local.buffer = view
+        return view
+
+
+# チャンク形式のデータを作る。圧縮しても小さくならなくなったら、以降のチャンクは圧縮せずに送る
+class ChunkCompressor:
+    # 圧縮後の大きさがこの割合を超える場合は圧縮が効いていないとみなす
+    RATIO = 0.9
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+
+    # [長さ, データ]を返す
+    def encode(self, data: bytes) -> list[bytes]:
+        if self.enabled:
+            compressed = zlib.compress(data, TCPConnection.COMPRESS_LEVEL)
+            if len(compressed) <= len(data) * ChunkCompressor.RATIO:
+                return [int.to_bytes(len(compressed) | TCPConnection.COMPRESSED_CHUNK, TCPConnection.CHUNK_LENGTH_SIZE,
+                                     'big'), compressed]
+            self.enabled = False
+        return [int.to_bytes(len(data), TCPConnection.CHUNK_LENGTH_SIZE, 'big'), data]
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import uuid
+from models.TCPConnection import TCPConnection
+
+
+# 途中で切れたアップロードを続きから再開するためのセッション。受信途中のデータはsession_dirの.partファイルに残す
+# session_dirはサーバーのSpoolが持ち、janitorが古い.partファイルを削除する
+class UploadSession:
+    SESSION_DIR_NAME = 'sessions'
+
+    def __init__(self, session_id: str, session_dir: str):
+        # パスに使うため、UUID以外は受け付けない
+        self.session_id = uuid.UUID(session_id).hex
+        self.session_dir = session_dir
+        self.path = os.path.join(session_dir, f'{self.session_id}.part')
+
+    # キャッシュにない場合のレスポンス。セッションがあれば、アップロードをどこから再開すればよいかを含める
+    @staticmethod
+    def not_found_response(request: dict, session_dir: str) -> dict:
+        response = dict(status=404, message='Not Found')
+        if TCPConnection.SESSION_ID in request:
+            response.update(UploadSession(request[TCPConnection.SESSION_ID], session_dir).status())
+        return response
+
+    # 既に受信済みのバイト数
+    def held(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    # 再開の問い合わせに返す情報
+    def status(self) -> dict:
+        held = self.held()
+        return dict(offset=held, checksum=TCPConnection.checksum(self.path, held) if held else 0)
+
+    # offsetから書き込むファイルと、先頭からoffsetまでを読み込んだハッシュを返す
+    def open(self, offset: int):
+        os.makedirs(self.session_dir, exist_ok=True)
+        if offset > self.held():
+            raise ValueError(f'Invalid offset {offset}: only {self.held()} bytes have been received')
+        hasher = hashlib.sha256()
+        f = open(self.path, 'r+b' if offset else 'wb')
+        while f.tell() < offset:
+            hasher.update(f.read(min(offset - f.tell(), TCPConnection.CHUNK_SIZE)))
+        f.truncate()
+        return f, hasher
+
+    # 受信したデータのハッシュを確かめてから保存先に移す
+    def complete(self, hasher, input_hash: str, file_path: str):
+        if input_hash and hasher.hexdigest() != input_hash:
+            self.discard()
+            raise ValueError('Checksum mismatch: the uploaded file is corrupted')
+        os.replace(self.path, file_path)
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,5 +1,22 @@
+import contextlib
 import ffmpeg
+import glob
 import logging
+import math
+import os
+import subprocess
+import time
+from fractions import Fraction
+from models.EncoderPreset import EncoderPreset
+from models.FFmpegProgress import FFmpegProgress
+from models.GifEncoder import GifEncoder
+from models.MediaProbe import MediaProbe
+from models.TCPConnection import TCPConnection
+
+
+# 入力に対して変換できないパラメータが指定された
+class InvalidRequestError(Exception):
+    pass
 
 
 class VideoProcessor:
@@ -8,71 +25,504 @@ class VideoProcessor:
     ASPECT_RATIO = "aspectRatioChange"
     AUDIO = "audioExtract"
     GIF = "gifConvert"
+    # 1回のアップロードで複数の操作を行う。params['operations']に各操作のリクエストを並べる
+    BATCH = "batch"
+    MEDIA_TYPES = {AUDIO: 'mp3', GIF: 'gif'}
+    # パイプに書き出してメモリに受け取れる操作。mp4はパイプに書き出すとfragmented MP4になるため対象にしない
+    PIPE_OPERATIONS = (AUDIO, GIF)
+
+    STREAM_INPUT = 'pipe:0'
+    STREAM_OUTPUT = 'pipe:1'
+    # パイプに書き出せるよう、mp4はfragmented MP4にする
+    STREAM_FORMATS = {
+        'mp4': dict(format='mp4', movflags='frag_keyframe+empty_moov'),
+        'mp3': dict(format='mp3'),
+        'gif': dict(format='gif'),
+    }
+    # targetSizeMBで音声を再エンコードする場合のビットレート
+    AUDIO_BITRATE = 128000
+    # targetSizeMBのうちコンテナのオーバーヘッドに残す割合
+    CONTAINER_OVERHEAD = 0.02
+    MIN_VIDEO_BITRATE = 32000
+    # mp4にそのままコピーできる音声コーデック
+    MP4_AUDIO_CODECS = ('aac', 'mp3')
+    # クロマがサブサンプリングされたピクセルフォーマットは、幅と高さが偶数でないとエンコードできない
+    SUBSAMPLED_PIX_FMTS = ('yuv420p', 'yuvj420p', 'nv12')
+    MAX_DIMENSION = 16384
+
+    @staticmethod
+    # 変換後の拡張子と出力先のパスを返す。progressにはffmpegの進捗が渡される
+    def process(request: dict, input_file_path: str, output_file_path: str, threads: int = 0,
+                progress=None) -> tuple[str, str]:
+        started = time.monotonic()
+        if VideoProcessor.two_pass(request):
+            VideoProcessor.process_two_pass(request, input_file_path, output_file_path, threads, progress)
+            VideoProcessor.record(request, input_file_path, output_file_path, threads, time.monotonic() - started)
+            return 'mp4', output_file_path
+        output, media_type, output_file_path = VideoProcessor.build(request, input_file_path, output_file_path,
+                                                                    threads)
+        FFmpegProgress(progress).run(output)
+        VideoProcessor.record(request, input_file_path, output_file_path, threads, time.monotonic() - started)
+        return media_type, output_file_path
+
+    @staticmethod
+    # targetSizeMBのcompressは2パスでエンコードする
+    def two_pass(request: dict) -> bool:
+        return request['operation'] == VideoProcessor.COMPRESS and \
+            request.get('params', {}).get('targetSizeMB') is not None
+
+    @staticmethod
+    # 1パス目は映像だけを解析して統計を書き出し、2パス目でその統計を使ってtargetSizeMBに収める
+    def process_two_pass(request: dict, input_file_path: str, output_file_path: str, threads: int = 0,
+                         progress=None):
+        plan = VideoProcessor.plan(request, input_file_path)
+        passlog = f'{output_file_path}.passlog'
+        try:
+            for number in (1, 2):
+                output_file = os.devnull if number == 1 else output_file_path
+                output_options = dict(EncoderPreset.options(plan['preset'], number, passlog))
+                if number == 1:
+                    output_options['format'] = 'null'
+                output = VideoProcessor.output(request, input_file_path, output_file, threads, audio=number == 2,
+                                               plan=plan, output_options=output_options)
+                logging.info(f'Pass {number}: {" ".join(output.get_args())}')
+                FFmpegProgress(progress).run(output)
+        finally:
+            for file_path in glob.glob(f'{glob.escape(passlog)}*'):
+                os.remove(file_path)
+
+    @staticmethod
+    # 映像を再エンコードしたmp4について、プリセットごとのエンコード時間と出力サイズを集計する
+    def record(request: dict, input_file_path: str, output_file_path: str, threads: int, seconds: float):
+        if request['operation'] in VideoProcessor.MEDIA_TYPES or not os.path.exists(output_file_path):
+            return
+        plan = VideoProcessor.plan(request, input_file_path)
+        if plan['copy_video']:
+            return
+        EncoderPreset.record(plan['preset'], threads, seconds, os.path.getsize(output_file_path),
+                             VideoProcessor.media_seconds(plan))
+
+    @staticmethod
+    # エンコードする動画の長さ。切り出す場合はその範囲の長さ
+    def media_seconds(plan: dict) -> float:
+        duration = plan['info']['duration'] or 0.0
+        if plan['range'] is None:
+            return duration
+        start, end = plan['range']
+        return max(0.0, (min(end, duration) if end is not None and duration else end or duration) - start)
+
+    @staticmethod
+    # 実行するffmpegの出力と変換後の拡張子、出力先のパスを返す
+    # input_optionsとaudioはmp4を出力する操作（分割エンコードの対象）にだけ適用される
+    def build(request: dict, input_file_path: str, output_file_path: str, threads: int = 0,
+              input_options: dict = None, audio: bool = True) -> tuple[ffmpeg.nodes.OutputStream, str, str]:
+        plan = VideoProcessor.plan(request, input_file_path)
+        media_type = VideoProcessor.MEDIA_TYPES.get(request['operation'], 'mp4')
+        if media_type != 'mp4':
+            output_file_path = output_file_path.replace('.mp4', f'.{media_type}')
+            input_options, audio = None, True
+        # presetやcrfなどの省略できるパラメータも渡すため、リクエストをそのまま使う
+        output = VideoProcessor.output(request, input_file_path, output_file_path, threads, input_options, audio,
+                                       plan)
+        logging.info(f'{request["operation"]} {input_file_path} to {output_file_path}: {request.get("params", {})}')
+        return output, media_type, output_file_path
+
+    @staticmethod
+    # 変換結果をファイルに書き出さず、パイプからbuffer（ResultBuffer）に受け取る。変換後の拡張子を返す
+    def process_to_buffer(request: dict, input_file_path: str, buffer, threads: int = 0, progress=None) -> str:
+        media_type = VideoProcessor.MEDIA_TYPES[request['operation']]
+        try:
+            with VideoProcessor.palette(request) as palette:
+                output = VideoProcessor.output(request, input_file_path, VideoProcessor.STREAM_OUTPUT, threads,
+                                               palette=palette)
+                FFmpegProgress(progress).run(output, buffer)
+        finally:
+            buffer.close()
+        return media_type
+
+    @staticmethod
+    # GIFのパレットをキャッシュから探す。GIF以外と、入力のハッシュが分からない場合は(None, None)
+    def palette(request: dict):
+        if request['operation'] != VideoProcessor.GIF:
+            return contextlib.nullcontext((None, None))
+        return GifEncoder.palette(request.get(TCPConnection.INPUT_HASH), request['params']['startSec'],
+                                  request['params']['endSec'])
+
+    @staticmethod
+    # 操作ごとの(拡張子, 出力先のパス)を返す
+    def process_batch(requests: list[dict], input_file_path: str, output_file_path: str, threads: int = 0,
+                      progress=None) -> list[tuple[str, str]]:
+        output, results = VideoProcessor.build_batch(requests, input_file_path, output_file_path, threads)
+        FFmpegProgress(progress).run(output)
+        return results
+
+    @staticmethod
+    # 複数の操作を1つのffmpegで実行する。入力は1度だけデコードし、加工する映像と音声をsplit/asplitで各出力に分ける
+    # コピーする映像と音声は入力のストリームをそのまま割り当てる
+    def build_batch(requests: list[dict], input_file_path: str, output_file_path: str,
+                    threads: int = 0) -> tuple[ffmpeg.nodes.OutputStream, list[tuple[str, str]]]:
+        plans = [VideoProcessor.plan(request, input_file_path) for request in requests]
+        if any(VideoProcessor.two_pass(request) for request in requests):
+            raise InvalidRequestError('targetSizeMB is not supported in a batch')
+        # 全ての操作が範囲を切り出す場合は、最も早いstartまでシークして共有し、各操作はtrimで切り出す
+        offset, input_options = 0.0, {}
+        if all(plan['range'] is not None for plan in plans):
+            offset = min(plan['range'][0] for plan in plans)
+            ends = [plan['range'][1] for plan in plans]
+            input_options = VideoProcessor.seek((offset, None if None in ends else max(ends)))
+        stream = ffmpeg.input(input_file_path, **input_options)
+        split_video = [request['operation'] != VideoProcessor.AUDIO and not plan['copy_video']
+                       for request, plan in zip(requests, plans)]
+        use_audio = [request['operation'] != VideoProcessor.GIF and plan['info']['audio'] is not None
+                     for request, plan in zip(requests, plans)]
+        split_audio = [audio and not plan['copy_audio'] for audio, plan in zip(use_audio, plans)]
+        videos = iter(VideoProcessor.split(stream.video, sum(split_video), 'split'))
+        audios = iter(VideoProcessor.split(stream.audio, sum(split_audio), 'asplit'))
+
+        root, _ = os.path.splitext(output_file_path)
+        outputs, results = [], []
+        for i, (request, plan) in enumerate(zip(requests, plans)):
+            media_type = VideoProcessor.MEDIA_TYPES.get(request['operation'], 'mp4')
+            file_path = f'{root}_{i}.{media_type}'
+            video = next(videos) if split_video[i] else stream.video
+            audio = (next(audios) if split_audio[i] else stream.audio) if use_audio[i] else None
+            trim = None
+            if plan['range'] is not None:
+                start, end = plan['range']
+                trim = (start - offset, None if end is None else end - offset)
+            streams, options = VideoProcessor.apply(request, video, audio, plan, trim)
+            outputs.append(ffmpeg.output(*streams, file_path, threads=threads, **options))
+            results.append((media_type, file_path))
+        output = ffmpeg.merge_outputs(*outputs)
+        logging.info(f'Batch of {len(requests)} operations: {" ".join(output.get_args())}')
+        return output, results
+
+    @staticmethod
+    # ストリームをcount個に分ける。1つだけなら分けずにそのまま使う
+    def split(stream, count: int, filter_name: str) -> list:
+        if count <= 1:
+            return [stream] * count
+        node = stream.filter_multi_output(filter_name, count)
+        return [node.stream(i) for i in range(count)]
+
+    @staticmethod
+    # バッチのリクエストから各操作のリクエストを取り出す
+    def batch_requests(request: dict) -> list[dict]:
+        operations = request.get('params', {}).get('operations')
+        if not isinstance(operations, list) or not operations:
+            raise InvalidRequestError('A batch request needs at least one operation')
+        if any(not isinstance(operation, dict) or operation.get('operation') == VideoProcessor.BATCH
+               for operation in operations):
+            raise InvalidRequestError(f'Invalid operations: {operations}')
+        return [dict(operation=operation.get('operation'), params=operation.get('params', {}))
+                for operation in operations]
+
+    @staticmethod
+    # 変換結果を左右する設定を、サーバーの設定（既定のプリセットとCRF、GIFの上限）を反映して入力によらずに決める
+    # ResultCacheのキーに使い、サーバーの設定を変えた後は以前の設定で変換した結果を返さない
+    def settings(request: dict) -> dict:
+        operation = request.get('operation')
+        params = {name: value for name, value in request.get('params', {}).items() if value is not None}
+        settings = dict(operation=operation, params={name: str(value) for name, value in params.items()})
+        if operation == VideoProcessor.GIF:
+            # 上限を超えるfpsと幅は上限と同じ変換結果になる。不正な値はplanで断るため、そのままにする
+            with contextlib.suppress(TypeError, ValueError):
+                fps, width = GifEncoder.limits(params)
+                settings['params'].update(fps=str(float(fps)), width=str(int(width)))
+        elif operation in (VideoProcessor.COMPRESS, VideoProcessor.RESOLUTION, VideoProcessor.ASPECT_RATIO):
+            preset = params.get('preset') or EncoderPreset.DEFAULT
+            encoder = EncoderPreset.PRESETS.get(preset, {})
+            settings['params']['preset'] = str(preset)
+            settings['encoder'] = encoder
+            if operation == VideoProcessor.COMPRESS:
+                # compressRateは映像のビットレートが分からない入力とstreamingで既定のCRFから換算する
+                settings['defaultCrf'] = EncoderPreset.DEFAULT_CRF.get(encoder.get('vcodec'))
+                settings['audioBitrate'] = VideoProcessor.AUDIO_BITRATE
+        return settings
 
     @staticmethod
-    # 変換後の拡張子を返す
-    def process(request: dict, input_file_path: str, output_file_path: str) -> str:
-        if request['operation'] == VideoProcessor.COMPRESS:
-            VideoProcessor.compress(input_file_path, output_file_path, request['params']['compressRate'])
-            return 'mp4'
-        elif request['operation'] == VideoProcessor.RESOLUTION:
-            VideoProcessor.change_resolution(input_file_path, output_file_path, request['params']['width'],
-                                             request['params']['height'])
-            return 'mp4'
-        elif request['operation'] == VideoProcessor.ASPECT_RATIO:
-            VideoProcessor.change_aspect_ratio(input_file_path, output_file_path, request['params']['aspectRatio'])
-            return 'mp4'
-        elif request['operation'] == VideoProcessor.AUDIO:
-            output_file_path = output_file_path.replace('.mp4', '.mp3')
-            VideoProcessor.change_audio(input_file_path, output_file_path)
-            return 'mp3'
-        elif request['operation'] == VideoProcessor.GIF:
-            output_file_path = output_file_path.replace('.mp4', '.gif')
-            VideoProcessor.convert_to_gif(input_file_path, output_file_path, request['params']['startSec'],
-                                          request['params']['endSec'])
-            return 'gif'
+    # 入力のprobeの結果でパラメータを検証し、再エンコードせずにコピーできるストリームを決める
+    # 変換できないパラメータはエンコードを始める前にInvalidRequestErrorで断る
+    def plan(request: dict, input_file_path: str) -> dict:
+        info = MediaProbe.probe(input_file_path)
+        operation = request['operation']
+        params = request.get('params', {})
+        video, audio = info['video'], info['audio']
+        if operation not in (VideoProcessor.COMPRESS, VideoProcessor.RESOLUTION, VideoProcessor.ASPECT_RATIO,
+                             VideoProcessor.AUDIO, VideoProcessor.GIF):
+            raise InvalidRequestError(f'Unknown request type: {operation}')
+        # 切り出す場合はフレーム単位で正確に切るため、映像も音声もコピーしない
+        time_range = VideoProcessor.time_range(params, info['duration'], required=operation == VideoProcessor.GIF)
+        if operation == VideoProcessor.AUDIO:
+            if audio is None:
+                raise InvalidRequestError('The input has no audio stream')
+            return dict(info=info, range=time_range, copy_video=False,
+                        copy_audio=audio['codec'] == 'mp3' and time_range is None)
+        if video is None:
+            raise InvalidRequestError('The input has no video stream')
+
+        # 映像を再エンコードする場合のプリセット
+        preset = params.get('preset') or EncoderPreset.DEFAULT
+        if preset not in EncoderPreset.PRESETS:
+            raise InvalidRequestError(f'Unknown preset: {preset}')
+        copy_video = False
+        video_bitrate = None
+        if operation == VideoProcessor.COMPRESS:
+            modes = [name for name in ('compressRate', 'crf', 'targetSizeMB') if params.get(name) is not None]
+            if len(modes) != 1:
+                raise InvalidRequestError('compress needs exactly one of compressRate, crf and targetSizeMB')
+            if modes[0] == 'compressRate':
+                rate = VideoProcessor.param(params, 'compressRate', float)
+                if not 0 < rate <= 1:
+                    raise InvalidRequestError(f'compressRate must be in (0, 1]: {rate}')
+                copy_video = rate == 1
+            elif modes[0] == 'crf':
+                crf = VideoProcessor.param(params, 'crf', int)
+                if not 0 <= crf <= 51:
+                    raise InvalidRequestError(f'crf must be in [0, 51]: {crf}')
+            else:
+                video_bitrate = VideoProcessor.target_bitrate(params, info, time_range)
+        elif operation == VideoProcessor.RESOLUTION:
+            width = VideoProcessor.param(params, 'width', int)
+            height = VideoProcessor.param(params, 'height', int)
+            if not (0 < width <= VideoProcessor.MAX_DIMENSION and 0 < height <= VideoProcessor.MAX_DIMENSION):
+                raise InvalidRequestError(f'Invalid resolution: {width}x{height}')
+            if video['pix_fmt'] in VideoProcessor.SUBSAMPLED_PIX_FMTS and (width % 2 or height % 2):
+                raise InvalidRequestError(f'Resolution must be even for {video["pix_fmt"]}: {width}x{height}')
+            copy_video = (width, height) == (video['width'], video['height'])
+        elif operation == VideoProcessor.ASPECT_RATIO:
+            aspect_ratio = VideoProcessor.ratio(str(params.get('aspectRatio')))
+            if aspect_ratio is None:
+                raise InvalidRequestError(f'Invalid aspectRatio: {params.get("aspectRatio")}')
+            copy_video = aspect_ratio == VideoProcessor.ratio(video['display_aspect_ratio'])
         else:
-            raise Exception(f'Unknown request type: {request["type"]}')
+            # fpsとwidthは省略でき、指定してもGifEncoderの上限までになる。幅はGifEncoder.limitsと同じく整数にする
+            for name, cast in (('fps', float), ('width', int)):
+                if params.get(name) is not None and not 0 < VideoProcessor.param(params, name, cast) < math.inf:
+                    raise InvalidRequestError(f'Invalid {name}: {params[name]}')
+        copy_audio = audio is not None and audio['codec'] in VideoProcessor.MP4_AUDIO_CODECS
+        return dict(info=info, range=time_range, copy_video=copy_video and time_range is None,
+                    copy_audio=copy_audio and time_range is None, preset=preset, video_bitrate=video_bitrate)
+
+    @staticmethod
+    # streamingで受信した入力の先頭（moovまで）をjob_dirに書き出してprobeし、通常の変換と同じくパラメータを検証する
+    def plan_stream(request: dict, head: bytes, job_dir: str) -> dict:
+        head_file_path = os.path.join(job_dir, 'head.mp4')
+        with open(head_file_path, 'wb') as f:
+            f.write(head)
+        return VideoProcessor.plan(request, head_file_path)
+
+    @staticmethod
+    # targetSizeMBに収まる映像のビットレート。音声とコンテナのオーバーヘッドの分を引く
+    def target_bitrate(params: dict, info: dict, time_range: tuple = None) -> int:
+        target = VideoProcessor.param(params, 'targetSizeMB', float)
+        if not target > 0:
+            raise InvalidRequestError(f'targetSizeMB must be positive: {target}')
+        plan = dict(info=info, range=time_range)
+        seconds = VideoProcessor.media_seconds(plan)
+        if not seconds:
+            raise InvalidRequestError('targetSizeMB needs an input with a known duration')
+        audio_bitrate = 0
+        if info['audio'] is not None:
+            copy_audio = info['audio']['codec'] in VideoProcessor.MP4_AUDIO_CODECS and time_range is None
+            audio_bitrate = (copy_audio and info['audio']['bit_rate']) or VideoProcessor.AUDIO_BITRATE
+        bits = target * 1024 ** 2 * 8 * (1 - VideoProcessor.CONTAINER_OVERHEAD)
+        video_bitrate = int(bits / seconds - audio_bitrate)
+        if video_bitrate < VideoProcessor.MIN_VIDEO_BITRATE:
+            raise InvalidRequestError(f'targetSizeMB is too small for {seconds:.1f} seconds: {target}')
+        return video_bitrate
+
+    @staticmethod
+    # startSecとendSecから切り出す範囲(start, end)を返す。endがNoneの場合は最後まで
+    # gifConvert以外はどちらも省略でき、省略した場合は入力全体（None）
+    def time_range(params: dict, duration: float = None, required: bool = False):
+        if not required and params.get('startSec') is None and params.get('endSec') is None:
+            return None
+        start = VideoProcessor.param(params, 'startSec', float) if required or params.get('startSec') is not None \
+            else 0.0
+        end = VideoProcessor.param(params, 'endSec', float) if required or params.get('endSec') is not None else None
+        if not 0 <= start or (end is not None and not start < end):
+            raise InvalidRequestError(f'Invalid range: {start} - {end}')
+        if duration is not None and start >= duration:
+            raise InvalidRequestError(f'startSec exceeds the duration {duration}: {start}')
+        return start, end
+
+    @staticmethod
+    # 入力側でstartの手前のキーフレームにシークし、startまでのフレームはデコードして捨てる。endより後は読まない
+    def seek(time_range: tuple) -> dict:
+        start, end = time_range
+        return dict(ss=start) if end is None else dict(ss=start, t=end - start)
+
+    @staticmethod
+    # 映像（audio=Trueの場合は音声）の[start, end)を切り出し、時刻を0から始める
+    def trim(stream, start: float, end: float = None, audio: bool = False):
+        options = dict(start=start) if end is None else dict(start=start, end=end)
+        if audio:
+            return stream.filter('atrim', **options).filter('asetpts', 'PTS-STARTPTS')
+        return stream.trim(**options).setpts('PTS-STARTPTS')
+
+    @staticmethod
+    def param(params: dict, name: str, cast):
+        try:
+            return cast(params[name])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidRequestError(f'Invalid {name}: {params.get(name)}')
+
+    @staticmethod
+    # 'W:H'を比に変換する。変換できない場合はNone
+    def ratio(value: str):
+        width, _, height = (value or '').partition(':')
+        try:
+            ratio = Fraction(Fraction(width), Fraction(height))
+        except (ValueError, ZeroDivisionError):
+            return None
+        return ratio if ratio > 0 else None
+
+    @staticmethod
+    # ffmpeg-pythonは':'を二重にエスケープしてしまうため、setdarには'W/H'で渡す
+    def dar(aspect_ratio: str) -> str:
+        ratio = VideoProcessor.ratio(str(aspect_ratio))
+        if ratio is None:
+            raise InvalidRequestError(f'Invalid aspectRatio: {aspect_ratio}')
+        return f'{ratio.numerator}/{ratio.denominator}'
+
+    @staticmethod
+    # 1つの操作について、入力の映像と音声から出力するストリームとffmpegのオプションを作る
+    # 映像や音声をコピーする場合は、加工していない入力のストリームを渡す。audioがNoneの場合は音声を出力しない
+    # trimは入力をシークしていない（他の操作と共有している）場合に、入力の時刻で切り出す範囲
+    def apply(request: dict, video, audio, plan: dict, trim: tuple = None) -> tuple[list, dict]:
+        params = request.get('params', {})
+        if request['operation'] == VideoProcessor.AUDIO:
+            if trim is not None:
+                audio = VideoProcessor.trim(audio, *trim, audio=True)
+            # 元の音声がmp3であれば再エンコードしない
+            return [audio], dict(format='mp3', acodec='copy') if plan['copy_audio'] else dict(format='mp3')
+        if trim is not None:
+            video = VideoProcessor.trim(video, *trim)
+            if audio is not None and request['operation'] != VideoProcessor.GIF:
+                audio = VideoProcessor.trim(audio, *trim, audio=True)
+        if request['operation'] == VideoProcessor.GIF:
+            # GIFは音声を持てない
+            video, _ = GifEncoder.filter(video, *GifEncoder.limits(params, plan['info']['video']))
+            return [video], dict(format='gif')
+
+        options = {}
+        if plan['copy_video']:
+            options['vcodec'] = 'copy'
+        else:
+            options.update(EncoderPreset.options(plan['preset']))
+            if request['operation'] == VideoProcessor.COMPRESS:
+                if plan['video_bitrate']:
+                    options['video_bitrate'] = plan['video_bitrate']
+                elif params.get('crf') is not None:
+                    options['crf'] = int(params['crf'])
+                else:
+                    # 映像のビットレートが分からない入力はコンテナ全体のビットレートを使い、それもなければCRFに換算する
+                    default_bitrate = plan['info']['video']['bit_rate'] or plan['info']['bit_rate']
+                    if default_bitrate:
+                        options['video_bitrate'] = int(default_bitrate * float(params['compressRate']))
+                    else:
+                        options['crf'] = VideoProcessor.crf_for_rate(params['compressRate'],
+                                                                     EncoderPreset.codec(plan['preset']))
+            elif request['operation'] == VideoProcessor.RESOLUTION:
+                video = video.filter("scale", params['width'], params['height'])
+            else:
+                video = video.filter("setdar", VideoProcessor.dar(params['aspectRatio']))
+        streams = [video]
+        if audio is not None:
+            streams.append(audio)
+            if plan['copy_audio']:
+                options['acodec'] = 'copy'
+            elif plan['video_bitrate']:
+                options['audio_bitrate'] = VideoProcessor.AUDIO_BITRATE
+        return streams, options
+
+    @staticmethod
+    # 入力ファイルから1つの操作のffmpegの出力を作る
+    def output(request: dict, input_file: str, output_file: str, threads: int = 0, input_options: dict = None,
+               audio: bool = True, plan: dict = None, palette: tuple = (None, None),
+               output_options: dict = None) -> ffmpeg.nodes.OutputStream:
+        plan = plan or VideoProcessor.plan(request, input_file)
+        if request['operation'] == VideoProcessor.GIF:
+            return GifEncoder.output(input_file, output_file, request['params'], plan['info']['video'], threads,
+                                     palette)
+        if plan['range'] is not None:
+            input_options = dict(input_options or {}, **VideoProcessor.seek(plan['range']))
+        stream = ffmpeg.input(input_file, **(input_options or {}))
+        source_audio = stream.audio if audio and plan['info']['audio'] is not None else None
+        streams, options = VideoProcessor.apply(request, stream.video, source_audio, plan)
+        return ffmpeg.output(*streams, output_file, threads=threads, **dict(options, **(output_options or {})))
+
+    @staticmethod
+    # 標準入力から読み込み標準出力に書き出すffmpegを起動し、プロセスと変換後の拡張子を返す
+    def open_stream(request: dict, plan: dict, threads: int = 0) -> tuple[subprocess.Popen, str]:
+        output, media_type = VideoProcessor.build_stream(request, plan, threads)
+        return output.run_async(pipe_stdin=True, pipe_stdout=True), media_type
+
+    @staticmethod
+    # 標準入力から読み込み標準出力に書き出すffmpegの出力と変換後の拡張子を返す
+    # planは受信した入力の先頭（moovまで）をprobeしたもの。映像と音声の有無やパラメータは通常の変換と同じく検証済み
+    def build_stream(request: dict, plan: dict, threads: int = 0) -> tuple[ffmpeg.nodes.OutputStream, str]:
+        params = request.get('params', {})
+        # 標準入力はシークできず、途中で読むのをやめると送信側が詰まるため、切り出しはgifConvertだけ受け付ける
+        if request['operation'] != VideoProcessor.GIF and plan['range'] is not None:
+            raise InvalidRequestError('startSec and endSec are not supported with streaming')
+        if VideoProcessor.two_pass(request):
+            raise InvalidRequestError('targetSizeMB is not supported with streaming')
+        # 先頭だけのprobeではビットレートが分からないため、圧縮率はCRFに換算する
+        if request['operation'] == VideoProcessor.COMPRESS and params.get('compressRate') is not None \
+                and not plan['copy_video']:
+            crf = VideoProcessor.crf_for_rate(params['compressRate'], EncoderPreset.codec(plan['preset']))
+            request = dict(request, params=dict(params, compressRate=None, crf=crf))
+        media_type = VideoProcessor.MEDIA_TYPES.get(request['operation'], 'mp4')
+        stream = ffmpeg.input(VideoProcessor.STREAM_INPUT)
+        audio = stream.audio if plan['info']['audio'] is not None else None
+        # 標準入力はシークできないため、gifConvertはtrimで切り出す
+        streams, options = VideoProcessor.apply(request, stream.video, audio, plan, plan['range'])
+        output = ffmpeg.output(*streams, VideoProcessor.STREAM_OUTPUT, threads=threads,
+                               **dict(options, **VideoProcessor.STREAM_FORMATS[media_type]))
+        logging.info(f'Streaming {request["operation"]}: {" ".join(output.get_args())}')
+        return output, media_type
+
+    @staticmethod
+    # ビットレートが半分になるごとにCRFを6上げる
+    def crf_for_rate(compression_rate: float, vcodec: str = 'libx264') -> int:
+        crf = EncoderPreset.DEFAULT_CRF[vcodec] - 6 * math.log2(float(compression_rate))
+        return max(0, min(51, round(crf)))
 
     @staticmethod
-    def compress(input_file: str, output_file: str, compression_rate: float):
+    def compress(input_file: str, output_file: str, compression_rate: float, threads: int = 0,
+                 input_options: dict = None, audio: bool = True, plan: dict = None) -> ffmpeg.nodes.OutputStream:
         logging.info(f'Compressing {input_file} to {output_file} with compression rate {compression_rate}')
-        probe = ffmpeg.probe(input_file, cmd="ffprobe")
-        video_info = next(s for s in probe["streams"] if s["codec_type"] == "video")
-        default_bitrate: int = int(video_info["bit_rate"])
-        compressed_bitrate: int = int(default_bitrate * float(compression_rate))
-        stream = ffmpeg.input(input_file).output(
-            output_file, video_bitrate=compressed_bitrate
-        )
-        ffmpeg.run(stream, overwrite_output=True)
+        request = dict(operation=VideoProcessor.COMPRESS, params=dict(compressRate=compression_rate))
+        return VideoProcessor.output(request, input_file, output_file, threads, input_options, audio, plan)
 
     @staticmethod
-    def change_resolution(input_file: str, output_file: str, width: int, height: int):
+    def change_resolution(input_file: str, output_file: str, width: int, height: int, threads: int = 0,
+                          input_options: dict = None, audio: bool = True,
+                          plan: dict = None) -> ffmpeg.nodes.OutputStream:
         logging.info(f'Changing resolution of {input_file} to {output_file} with width {width} and height {height}')
-        stream = ffmpeg.input(input_file)
-        video = stream.filter("scale", width, height)
-        audio = stream.audio
-        ffmpeg.output(video, audio, output_file).run(overwrite_output=True)
+        request = dict(operation=VideoProcessor.RESOLUTION, params=dict(width=width, height=height))
+        return VideoProcessor.output(request, input_file, output_file, threads, input_options, audio, plan)
 
     @staticmethod
-    def change_aspect_ratio(input_file: str, output_file: str, aspect_ratio: str):
+    def change_aspect_ratio(input_file: str, output_file: str, aspect_ratio: str, threads: int = 0,
+                            input_options: dict = None, audio: bool = True,
+                            plan: dict = None) -> ffmpeg.nodes.OutputStream:
         logging.info(f'Changing aspect ratio of {input_file} to {output_file} with aspect ratio {aspect_ratio}')
-        input_stream = ffmpeg.input(input_file)
-        video = input_stream.filter("setdar", aspect_ratio)
-        audio = input_stream.audio
-        ffmpeg.output(video, audio, output_file).run(overwrite_output=True)
+        request = dict(operation=VideoProcessor.ASPECT_RATIO, params=dict(aspectRatio=aspect_ratio))
+        return VideoProcessor.output(request, input_file, output_file, threads, input_options, audio, plan)
 
     @staticmethod
-    def change_audio(input_file: str, output_file: str):
+    def change_audio(input_file: str, output_file: str, threads: int = 0,
+                     plan: dict = None) -> ffmpeg.nodes.OutputStream:
         logging.info(f'Changing audio of {input_file} to {output_file}')
-        ffmpeg.input(input_file).output(output_file, format="mp3").run(overwrite_output=True)
+        request = dict(operation=VideoProcessor.AUDIO)
+        return VideoProcessor.output(request, input_file, output_file, threads, plan=plan)
 
     @staticmethod
-    def convert_to_gif(input_file: str, output_file: str, start_sec: int, end_sec: int):
+    def convert_to_gif(input_file: str, output_file: str, start_sec: int, end_sec: int, threads: int = 0,
+                       plan: dict = None) -> ffmpeg.nodes.OutputStream:
         logging.info(f'Converting {input_file} to {output_file} with start {start_sec} and end {end_sec}')
-        stream = ffmpeg.input(input_file)
-        video = stream.trim(start=start_sec, end=end_sec).setpts("PTS-STARTPTS")
-        audio = stream.filter("atrim", start=start_sec, end=end_sec).filter(
-            "asetpts", "PTS-STARTPTS"
-        )
-        ffmpeg.output(video, audio, output_file, format="gif").run()
+        request = dict(operation=VideoProcessor.GIF, params=dict(startSec=start_sec, endSec=end_sec))
+        return VideoProcessor.output(request, input_file, output_file, threads, plan=plan)
@@ -1,20 +1,41 @@
+import collections
 import logging
 import tkinter as tk
 
 
+# ログはどのスレッドからでもキューに溜めるだけにし、FLUSH_INTERVALミリ秒ごとにTkのスレッドでまとめて書き込む
+# 大きなファイルの送受信中にログが多くても、Tkのイベントループに1件ずつ処理を積まない
 class WidgetLogger(logging.Handler):
+    FLUSH_INTERVAL = 100
+    # ウィジェットに残す行数。古い行から削除する
+    MAX_LINES = 1000
+
     def __init__(self, widget):
         logging.Handler.__init__(self)
         self.setLevel(logging.INFO)
         self.widget = widget
         self.widget.config(state='disabled')
+        # dequeのappendとpopleftはスレッドセーフ
+        self.pending = collections.deque()
+        self.widget.after(WidgetLogger.FLUSH_INTERVAL, self.write_pending)
 
     def emit(self, record):
-        msg = self.format(record) + '\n'
-        self.widget.after(0, self.append_text, msg)
+        self.pending.append(self.format(record))
+
+    def write_pending(self):
+        lines = []
+        while self.pending:
+            lines.append(self.pending.popleft())
+        if lines:
+            self.append_text('\n'.join(lines[-WidgetLogger.MAX_LINES:]) + '\n')
+        self.widget.after(WidgetLogger.FLUSH_INTERVAL, self.write_pending)
 
     def append_text(self, msg):
         self.widget.config(state='normal')
         self.widget.insert(tk.END, msg)
+        # 末尾の改行の後に空の行があるため、行数は'end'の行番号より2少ない
+        excess = int(self.widget.index(tk.END).split('.')[0]) - 2 - WidgetLogger.MAX_LINES
+        if excess > 0:
+            self.widget.delete('1.0', f'{excess + 1}.0')
         self.widget.see(tk.END)
         self.widget.config(state='disabled')
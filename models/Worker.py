@@ -0,0 +1,140 @@
+import concurrent.futures
+import functools
+import logging
+import os.path
+import socket
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from models.JobScheduler import JobScheduler, QueueFullError
+from models.SegmentEncoder import SegmentEncoder
+from models.Spool import Spool, SpoolFullError
+from models.VideoProcessor import InvalidRequestError, VideoProcessor
+from models.TCPConnection import TCPConnection
+
+
+# フロントのサーバーから変換だけを受け付けるノード。フレーミングはクライアントとサーバーの間と同じ
+# 1つの接続で入力を1つ受信して変換し、変換結果をレスポンスのpayloadで返す。キャッシュと再開はフロントのサーバーが受け持つ
+class Worker(TCPConnection):
+    LISTEN_NUM = 16
+    MAX_WORKERS = 64
+    # 生存と負荷を確かめるリクエストのoperation。payloadはなく、JobSchedulerの状態を返す
+    HEARTBEAT = 'heartbeat'
+    # 変換待ちが詰まっている場合は待たずに断り、フロントに別のworkerへ送らせる
+    QUEUE_TIMEOUT = 0
+    # payloadのないジョブ（uploadSizeを含む）に対し、受け付けられる場合に返すステータス。フロントはこの後に入力を送る
+    CONTINUE = 100
+    # 変換中に送るステータス。フロントはこれが届かない状態が続くとworkerが止まったとみなす
+    PROCESSING = 102
+    # 変換待ちの間か、ffmpegの進捗が進んでいる間、この秒数ごとにPROCESSINGを送る
+    KEEPALIVE_INTERVAL = 10
+
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = TCPConnection.CHUNK_SIZE,
+                 scheduler: JobScheduler = None, spool: Spool = None):
+        super().__init__(host, port, logger, chunk_size)
+        self.scheduler = scheduler if scheduler else JobScheduler(logger)
+        # 同じホストのフロントや他のworkerのジョブを削除しないよう、ポートごとのディレクトリを使う
+        self.spool = spool if spool else Spool(logger, job_dir=Worker.job_dir(port),
+                                               session_dir=Worker.session_dir(port))
+        self.executor = ThreadPoolExecutor(max_workers=Worker.MAX_WORKERS)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+
+        self.sock.listen(Worker.LISTEN_NUM)
+
+    @staticmethod
+    def job_dir(port: int) -> str:
+        return os.path.join(TCPConnection.DEST_DIR, f'worker_{port}')
+
+    # workerは再開を受け付けないが、janitorがフロントの.partファイルを削除しないよう別のディレクトリにする
+    @staticmethod
+    def session_dir(port: int) -> str:
+        return os.path.join(TCPConnection.DEST_DIR, f'worker_{port}_sessions')
+
+    def run(self):
+        self.spool.start()
+        try:
+            while True:
+                client, address = self.sock.accept()
+                self.executor.submit(self.handle_request, client)
+        except KeyboardInterrupt as e:
+            self.logger.error(e, exc_info=True)
+            self.sock.close()
+            self.executor.shutdown(wait=True)
+        finally:
+            self.spool.stop()
+
+    def handle_request(self, client: socket.socket):
+        try:
+            request_size, media_type_size, payload_size = self.receive_header(client)
+            request, media_type = self.receive_metadata(client, request_size, media_type_size)
+            if request.get('operation') == Worker.HEARTBEAT:
+                self.send_status(client, dict(status=200, message='OK', **self.scheduler.stats()))
+                return
+            # 入力を受信する前に変換枠と容量を確かめ、断る場合はフロントに入力を送らせずに別のworkerへ回させる
+            if TCPConnection.UPLOAD_SIZE in request and payload_size == 0:
+                if self.scheduler.is_full():
+                    raise QueueFullError('Encode queue is full')
+                self.spool.check(int(request[TCPConnection.UPLOAD_SIZE]))
+                self.send_status(client, dict(status=Worker.CONTINUE, message='Continue'))
+                request_size, media_type_size, payload_size = self.receive_header(client)
+                request, media_type = self.receive_metadata(client, request_size, media_type_size)
+            self.logger.info(f'Job: {request}, media_type: {media_type}, payload_size: {payload_size}')
+            with self.spool.job(payload_size) as job_dir:
+                input_file_path = os.path.join(job_dir, f'input.{media_type}')
+                with open(input_file_path, 'wb') as f, Spool.preallocated(f, payload_size):
+                    self.copy_to_writer(client, f, payload_size)
+                output_file_path = os.path.join(job_dir, f'processed_input.{media_type}')
+                if request['operation'] == VideoProcessor.BATCH:
+                    self.process_batch_request(client, request, input_file_path, output_file_path)
+                else:
+                    self.process_request(client, request, input_file_path, output_file_path)
+        except QueueFullError as e:
+            self.logger.error(f'{e}: {self.scheduler.stats()}')
+            self.send_status(client, dict(status=503, message=str(e)))
+        except SpoolFullError as e:
+            self.logger.error(f'{e}: {self.spool.stats()}')
+            self.send_status(client, dict(status=507, message=str(e)))
+        except InvalidRequestError as e:
+            self.logger.error(f'Invalid request: {e}')
+            self.send_status(client, dict(status=400, message=str(e)))
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            self.send_status(client, dict(status=500, message=str(e)))
+        finally:
+            client.close()
+
+    def process_request(self, client: socket.socket, request: dict, input_file_path: str, output_file_path: str):
+        # 大きな入力はworkerの中でも区間ごとに並列でエンコードする
+        job = SegmentEncoder.encode if SegmentEncoder.eligible(request, input_file_path) else VideoProcessor.process
+        media_type, output_file_path = self.run_job(client, job, request, input_file_path, output_file_path)
+        response = dict(status=200, message='OK')
+        self.send_header(client, media_type, response, output_file_path)
+        self.send_body(client, media_type, response, output_file_path)
+
+    def process_batch_request(self, client: socket.socket, request: dict, input_file_path: str,
+                              output_file_path: str):
+        requests = VideoProcessor.batch_requests(request)
+        results = self.run_job(client, VideoProcessor.process_batch, requests, input_file_path, output_file_path)
+        response = dict(status=200, message='OK', results=[
+            dict(operation=sub_request['operation'], mediaType=media_type, size=os.path.getsize(file_path))
+            for sub_request, (media_type, file_path) in zip(requests, results)])
+        self.send_files(client, '', response, [file_path for _, file_path in results])
+
+    # JobSchedulerで実行して結果を待つ。待つ間、変換待ちか進捗が進んでいればKEEPALIVE_INTERVALごとにPROCESSINGを送る
+    # ffmpegが止まった場合も送らなくなるため、フロントはタイムアウトして別のworkerでやり直す
+    def run_job(self, client: socket.socket, fn, *args):
+        progressed = threading.Event()
+        future = self.scheduler.submit(functools.partial(fn, progress=lambda values: progressed.set()), *args,
+                                       timeout=Worker.QUEUE_TIMEOUT)
+        while True:
+            try:
+                return future.result(timeout=Worker.KEEPALIVE_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if progressed.is_set() or not future.running():
+                    progressed.clear()
+                    self.send_status(client, dict(status=Worker.PROCESSING, message='Processing'))
+
+    # payloadのないレスポンスを返す
+    def send_status(self, client: socket.socket, response: dict):
+        self.send_header(client, '', response, '')
+        self.send_metadata(client, '', response)
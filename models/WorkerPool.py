@@ -0,0 +1,225 @@
+import contextlib
+import contextvars
+import logging
+import os
+import socket
+import threading
+from models.JobScheduler import QueueFullError
+from models.TCPConnection import TCPConnection
+from models.VideoProcessor import InvalidRequestError, VideoProcessor
+from models.Worker import Worker
+
+
+# 変換を受け付けられるworkerがない。サーバーは変換待ちが詰まっている場合と同じく503を返す
+class WorkerUnavailableError(QueueFullError):
+    pass
+
+
+# 1台のworkerへの接続。ジョブごとに接続し直し、入力を送って変換結果を受け取る
+class WorkerNode(TCPConnection):
+    CONNECT_TIMEOUT = 2
+    # ジョブの接続で何も届かない状態がこの秒数続いたら、workerが止まったとみなしてsocket.timeoutにする
+    # workerは変換中もWorker.KEEPALIVE_INTERVALごとにWorker.PROCESSINGを送る
+    IDLE_TIMEOUT = 120
+
+    def __init__(self, host: str, port: int, logger: logging.Logger, chunk_size: int = TCPConnection.CHUNK_SIZE):
+        super().__init__(host, port, logger, chunk_size)
+        # 同時に複数のジョブを送るため、接続はconnectで作る
+        self.sock.close()
+        self.alive = False
+        # heartbeatで報告された変換枠の数と、実行中と待機中のジョブの数
+        self.capacity = 1
+        self.reported = 0
+        # このサーバーから送って変換結果を待っているジョブの数
+        self.inflight = 0
+        self.dispatched = 0
+        self.failures = 0
+
+    def __str__(self):
+        return f'{self.host}:{self.port}'
+
+    # 他のフロントから送られたジョブも数えるため、heartbeatの報告とこのサーバーから送っている数の多い方を使う
+    def load(self) -> float:
+        return max(self.inflight, self.reported) / self.capacity
+
+    def run(self):
+        return self.heartbeat()
+
+    def connect(self, timeout: float = None) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port), timeout=WorkerNode.CONNECT_TIMEOUT)
+        sock.settimeout(timeout)
+        return sock
+
+    # workerのJobSchedulerの状態を返す。応答がない場合はOSError
+    def heartbeat(self) -> dict:
+        request = dict(operation=Worker.HEARTBEAT)
+        with self.connect(WorkerNode.CONNECT_TIMEOUT) as sock:
+            self.send_header(sock, '', request, '')
+            self.send_metadata(sock, '', request)
+            response, _, _ = self.receive_response(sock)
+        return response
+
+    def process(self, request: dict, input_file_path: str, output_file_path: str) -> tuple[str, str]:
+        with self.connect(WorkerNode.IDLE_TIMEOUT) as sock:
+            response, media_type, payload_size = self.send_job(sock, request, input_file_path)
+            output_file_path = f'{os.path.splitext(output_file_path)[0]}.{media_type}'
+            self.receive_payload(sock, output_file_path, payload_size)
+        return media_type, output_file_path
+
+    # 変換結果はVideoProcessor.build_batchと同じく'<output_file_pathの拡張子を除いた部分>_<i>.<拡張子>'に保存する
+    def process_batch(self, requests: list[dict], input_file_path: str,
+                      output_file_path: str) -> list[tuple[str, str]]:
+        request = dict(operation=VideoProcessor.BATCH, params=dict(operations=requests))
+        root = os.path.splitext(output_file_path)[0]
+        results = []
+        with self.connect(WorkerNode.IDLE_TIMEOUT) as sock:
+            response, _, _ = self.send_job(sock, request, input_file_path)
+            for i, result in enumerate(response[WorkerNode.RESULTS]):
+                file_path = f'{root}_{i}.{result["mediaType"]}'
+                self.receive_payload(sock, file_path, result['size'])
+                results.append((result['mediaType'], file_path))
+        return results
+
+    # 入力を送り、変換が終わってレスポンスが届くまで待つ
+    # 先にpayloadなしで送り、workerが受け付けた場合だけ入力を送る。断られた場合は入力を送らずに別のworkerでやり直せる
+    def send_job(self, sock: socket.socket, request: dict, input_file_path: str) -> tuple[dict, str, int]:
+        # 変換を待つ間に相手のホストが落ちても気づけるようにする
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        media_type = os.path.splitext(input_file_path)[1][1:]
+        precheck = dict(request, **{TCPConnection.UPLOAD_SIZE: os.path.getsize(input_file_path)})
+        self.send_header(sock, media_type, precheck, '')
+        self.send_metadata(sock, media_type, precheck)
+        self.receive_response(sock)
+        self.send_header(sock, media_type, request, input_file_path)
+        self.send_metadata(sock, media_type, request)
+        # send_bodyは送信の失敗を握りつぶすため、payloadは直接送ってworkerが落ちたことを呼び出し元に伝える
+        self.send_payload(sock, input_file_path)
+        return self.receive_response(sock)
+
+    # 変換中に届くWorker.PROCESSINGは読み飛ばす
+    def receive_response(self, sock: socket.socket) -> tuple[dict, str, int]:
+        response = dict(status=Worker.PROCESSING)
+        while response['status'] == Worker.PROCESSING:
+            request_size, media_type_size, payload_size = self.receive_header(sock)
+            response, media_type = self.receive_metadata(sock, request_size, media_type_size)
+        if response['status'] == 400:
+            raise InvalidRequestError(response['message'])
+        if response['status'] in (503, 507):
+            raise WorkerUnavailableError(f'Worker {self} is busy: {response["message"]}')
+        if response['status'] not in (200, Worker.CONTINUE):
+            raise RuntimeError(f'Worker {self} failed: {response["message"]}')
+        return response, media_type, payload_size
+
+
+# フロントのサーバーが変換を送るworkerの集まり。最も負荷の低いworkerに送り、落ちたworkerの分は別のworkerでやり直す
+# heartbeatで定期的に生存と負荷を確かめ、落ちていたworkerが応答すれば再び送る
+class WorkerPool:
+    HEARTBEAT_INTERVAL = 5
+    # workerが落ちたか混雑している場合に、別のworkerでやり直す回数
+    MAX_RETRIES = 2
+
+    def __init__(self, logger: logging.Logger, addresses: list[tuple[str, int]],
+                 chunk_size: int = TCPConnection.CHUNK_SIZE):
+        self.logger = logger
+        self.nodes = [WorkerNode(host, port, logger, chunk_size) for host, port in addresses]
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.stopped = threading.Event()
+
+    # 'host:port,host:port'の形式
+    @staticmethod
+    def parse(value: str) -> list[tuple[str, int]]:
+        addresses = []
+        for address in value.split(','):
+            host, port = address.strip().rsplit(':', 1)
+            addresses.append((host, int(port)))
+        return addresses
+
+    # 起動時に呼ぶ。全てのworkerを確かめてから、以降はHEARTBEAT_INTERVALごとに確かめる
+    def start(self):
+        self.check()
+        threading.Thread(target=self.run_heartbeat, name='heartbeat', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(WorkerPool.HEARTBEAT_INTERVAL):
+            self.check()
+
+    def check(self):
+        for node in self.nodes:
+            try:
+                stats = node.heartbeat()
+            except Exception as e:
+                if node.alive:
+                    self.logger.warning(f'Worker {node} is down: {e}')
+                with self.lock:
+                    node.alive = False
+                continue
+            with self.lock:
+                if not node.alive:
+                    self.logger.info(f'Worker {node} is up: {stats["workers"]} workers')
+                node.alive = True
+                node.capacity = max(1, stats['workers'])
+                node.reported = stats['running'] + stats['queue_depth']
+
+    # JobSchedulerから呼ぶ。VideoProcessor.processと同じ引数を受け取り、変換はworkerで行う
+    def process(self, request: dict, input_file_path: str, output_file_path: str, threads: int = 0,
+                progress=None) -> tuple[str, str]:
+        return self.dispatch(lambda node: node.process(request, input_file_path, output_file_path))
+
+    def process_batch(self, requests: list[dict], input_file_path: str, output_file_path: str, threads: int = 0,
+                      progress=None) -> list[tuple[str, str]]:
+        return self.dispatch(lambda node: node.process_batch(requests, input_file_path, output_file_path))
+
+    # 最も負荷の低いworkerで実行する。接続が切れたworkerは次のheartbeatまで落ちたものとして扱う
+    # パラメータの誤りやffmpegの失敗は、別のworkerでも同じ結果になるためやり直さない
+    def dispatch(self, fn):
+        tried = []
+        for attempt in range(WorkerPool.MAX_RETRIES + 1):
+            with self.acquire(tried) as node:
+                try:
+                    # JobRecord.jobが引き継いだクライアントとのv2の設定（TCPConnection.negotiated）を使わないよう、
+                    # workerとの送受信は新しいcontextで行う
+                    result = contextvars.Context().run(fn, node)
+                    with self.lock:
+                        node.dispatched += 1
+                    return result
+                except WorkerUnavailableError as e:
+                    self.logger.warning(f'{e} ({attempt + 1}/{WorkerPool.MAX_RETRIES + 1})')
+                except OSError as e:
+                    self.logger.warning(f'Worker {node} failed ({attempt + 1}/{WorkerPool.MAX_RETRIES + 1}): {e}')
+                    with self.lock:
+                        node.alive = False
+                        node.failures += 1
+            tried.append(node)
+            with self.lock:
+                self.retried += 1
+        raise WorkerUnavailableError(f'No worker could process the job in {WorkerPool.MAX_RETRIES + 1} attempts')
+
+    # まだ試していない生きているworkerのうち、最も負荷の低いものを選ぶ
+    @contextlib.contextmanager
+    def acquire(self, tried: list):
+        with self.lock:
+            nodes = [node for node in self.nodes if node.alive and node not in tried]
+            if not nodes:
+                raise WorkerUnavailableError('No worker is available')
+            node = min(nodes, key=WorkerNode.load)
+            node.inflight += 1
+        try:
+            yield node
+        finally:
+            with self.lock:
+                node.inflight -= 1
+
+    # Metricsのcollector。workerのアドレスをラベルにする
+    def collect(self) -> list:
+        with self.lock:
+            samples = [('worker_retried', {}, self.retried)]
+            for node in self.nodes:
+                labels = dict(worker=str(node))
+                samples.extend((f'worker_{name}', labels, value) for name, value in (
+                    ('up', int(node.alive)), ('capacity', node.capacity), ('inflight', node.inflight),
+                    ('reported', node.reported), ('dispatched', node.dispatched), ('failures', node.failures)))
+        return samples
@@ -2,7 +2,17 @@ from dotenv import load_dotenv
 import logging
 import os
 import sys
+from models.AsyncServer import AsyncServer
+from models.EncoderPreset import EncoderPreset
+from models.GifEncoder import GifEncoder
+from models.JobScheduler import AsyncJobScheduler, JobScheduler
+from models.Metrics import Metrics
+from models.ResultBuffer import MemoryBudget
+from models.ResultCache import ResultCache
+from models.SegmentEncoder import SegmentEncoder
 from models.Server import Server
+from models.Spool import Spool
+from models.WorkerPool import WorkerNode, WorkerPool
 
 
 def main():
@@ -10,6 +20,28 @@ def main():
     load_dotenv()
     server_ip = os.getenv('SERVER_IP')
     server_port = os.getenv('SERVER_PORT')
+    chunk_size = int(os.getenv('CHUNK_SIZE', Server.CHUNK_SIZE))
+    cache_dir = os.getenv('CACHE_DIR', ResultCache.CACHE_DIR)
+    cache_max_bytes = int(os.getenv('CACHE_MAX_BYTES', ResultCache.MAX_BYTES))
+    encode_workers = int(os.getenv('ENCODE_WORKERS', 0))
+    threads_per_job = int(os.getenv('THREADS_PER_JOB', JobScheduler.THREADS_PER_JOB))
+    max_queue = int(os.getenv('MAX_QUEUE', JobScheduler.MAX_QUEUE))
+    server_mode = os.getenv('SERVER_MODE', 'async')
+    SegmentEncoder.THRESHOLD = int(os.getenv('SEGMENT_THRESHOLD', SegmentEncoder.THRESHOLD))
+    GifEncoder.MAX_FPS = float(os.getenv('GIF_MAX_FPS', GifEncoder.MAX_FPS))
+    GifEncoder.MAX_WIDTH = int(os.getenv('GIF_MAX_WIDTH', GifEncoder.MAX_WIDTH))
+    GifEncoder.PALETTE_DIR = os.getenv('PALETTE_DIR', GifEncoder.PALETTE_DIR)
+    EncoderPreset.DEFAULT = os.getenv('ENCODER_PRESET', EncoderPreset.DEFAULT)
+    if EncoderPreset.DEFAULT not in EncoderPreset.PRESETS:
+        sys.exit(f'ENCODER_PRESET must be one of {", ".join(EncoderPreset.PRESETS)}: {EncoderPreset.DEFAULT}')
+    metrics_port = int(os.getenv('METRICS_PORT', 0))
+    small_result_max = int(os.getenv('SMALL_RESULT_MAX', MemoryBudget.MAX_RESULT))
+    result_memory_budget = int(os.getenv('RESULT_MEMORY_BUDGET', MemoryBudget.LIMIT))
+    spool_quota = int(os.getenv('SPOOL_QUOTA', Spool.QUOTA))
+    spool_min_free = int(os.getenv('SPOOL_MIN_FREE', Spool.MIN_FREE))
+    Spool.SESSION_TTL = int(os.getenv('SESSION_TTL', Spool.SESSION_TTL))
+    workers = os.getenv('WORKERS')
+    WorkerNode.IDLE_TIMEOUT = float(os.getenv('WORKER_IDLE_TIMEOUT', WorkerNode.IDLE_TIMEOUT))
 
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
@@ -25,8 +57,31 @@ def main():
     stderr_handler.setLevel(logging.WARNING)
     logger.addHandler(stderr_handler)
 
+    # メトリクスをローカルのHTTPで公開する
+    metrics = Metrics()
+    if metrics_port:
+        metrics.serve('127.0.0.1', metrics_port)
+        logger.info(f'Metrics: http://127.0.0.1:{metrics_port}/metrics')
+
     # サーバーを起動する
-    server = Server(server_ip, int(server_port), logger)
+    cache = ResultCache(logger, cache_dir, cache_max_bytes)
+    budget = MemoryBudget(result_memory_budget, small_result_max)
+    spool = Spool(logger, spool_quota, spool_min_free)
+    pool = None
+    if workers:
+        # 変換はworkerノードに送る。同時に送るジョブの数は、workerがこのホストと同じコア数を持つものとして決める
+        pool = WorkerPool(logger, WorkerPool.parse(workers), chunk_size)
+        if not encode_workers:
+            encode_workers = len(pool.nodes) * JobScheduler.capacity(0, threads_per_job)[0]
+    if server_mode == 'thread':
+        # 従来のスレッドで接続を扱うサーバー
+        scheduler = JobScheduler(logger, encode_workers, threads_per_job, max_queue)
+        server = Server(server_ip, int(server_port), logger, chunk_size, cache, scheduler, metrics, budget,
+                        spool, pool)
+    else:
+        scheduler = AsyncJobScheduler(logger, encode_workers, threads_per_job, max_queue)
+        server = AsyncServer(server_ip, int(server_port), logger, chunk_size, cache, scheduler, metrics, budget,
+                             spool, pool)
     server.run()
 
 
@@ -0,0 +1,55 @@
+from dotenv import load_dotenv
+import logging
+import os
+import sys
+from models.EncoderPreset import EncoderPreset
+from models.GifEncoder import GifEncoder
+from models.JobScheduler import JobScheduler
+from models.SegmentEncoder import SegmentEncoder
+from models.Spool import Spool
+from models.Worker import Worker
+
+
+def main():
+    # 環境変数を読み込む。同じホストで複数のworkerを動かす場合はWORKER_PORTを起動ごとに変える
+    load_dotenv()
+    worker_ip = os.getenv('WORKER_IP', '0.0.0.0')
+    worker_port = int(os.getenv('WORKER_PORT', 6000))
+    chunk_size = int(os.getenv('CHUNK_SIZE', Worker.CHUNK_SIZE))
+    encode_workers = int(os.getenv('ENCODE_WORKERS', 0))
+    threads_per_job = int(os.getenv('THREADS_PER_JOB', JobScheduler.THREADS_PER_JOB))
+    max_queue = int(os.getenv('MAX_QUEUE', JobScheduler.MAX_QUEUE))
+    SegmentEncoder.THRESHOLD = int(os.getenv('SEGMENT_THRESHOLD', SegmentEncoder.THRESHOLD))
+    GifEncoder.MAX_FPS = float(os.getenv('GIF_MAX_FPS', GifEncoder.MAX_FPS))
+    GifEncoder.MAX_WIDTH = int(os.getenv('GIF_MAX_WIDTH', GifEncoder.MAX_WIDTH))
+    GifEncoder.PALETTE_DIR = os.getenv('PALETTE_DIR', GifEncoder.PALETTE_DIR)
+    EncoderPreset.DEFAULT = os.getenv('ENCODER_PRESET', EncoderPreset.DEFAULT)
+    if EncoderPreset.DEFAULT not in EncoderPreset.PRESETS:
+        sys.exit(f'ENCODER_PRESET must be one of {", ".join(EncoderPreset.PRESETS)}: {EncoderPreset.DEFAULT}')
+    spool_quota = int(os.getenv('SPOOL_QUOTA', Spool.QUOTA))
+    spool_min_free = int(os.getenv('SPOOL_MIN_FREE', Spool.MIN_FREE))
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # 情報（INFO）レベルのログを標準出力に出力するハンドラー
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setLevel(logging.INFO)
+    stdout_handler.addFilter(lambda record: record.levelno <= logging.INFO)
+    logger.addHandler(stdout_handler)
+
+    # 警告（WARNING）以上のログを標準エラー出力に出力するハンドラー
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    logger.addHandler(stderr_handler)
+
+    # workerを起動する
+    scheduler = JobScheduler(logger, encode_workers, threads_per_job, max_queue)
+    spool = Spool(logger, spool_quota, spool_min_free, Worker.job_dir(worker_port), Worker.session_dir(worker_port))
+    worker = Worker(worker_ip, worker_port, logger, chunk_size, scheduler, spool)
+    logger.info(f'Worker is listening on {worker_ip}:{worker_port}')
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()